@@ -15,6 +15,7 @@ __author__ = 'matth'
 import threading
 import traceback
 import sys
+import errno
 import subprocess
 import time
 import uuid
@@ -24,12 +25,28 @@ import argparse
 import shlex
 import os
 import jsonrpc
+from jsonrpc.exceptions import JSONRPCDispatchException
+from jsonrpc.utils import is_invalid_params
 import queue
 import pkgutil
-from processfamily.threads import stop_threads
+import socket
+from processfamily.threads import stop_threads_parallel, filter_threads
+from processfamily.profiler import SamplingProfiler
+from processfamily.watchdog import StallWatchdog
 from processfamily.processes import kill_process, process_exists, set_process_affinity, cpu_count
+from processfamily.processes import get_process_memory_info
+from processfamily.launcher import get_shim_cmd
+from processfamily.rpc import RPCError, RPCTimeoutError, ChildTerminatedError, ServerBusyError, SERVER_BUSY
+from processfamily.rpc import PARSE_ERROR, INVALID_REQUEST, METHOD_NOT_FOUND, INVALID_PARAMS, INTERNAL_ERROR, SERVER_ERROR
+from processfamily.rpc import error_from_response, DeadlineScheduler, DispatchPool, RPCStats
+from processfamily import tracing
+from processfamily import framing
+from processfamily import unixsocket
+from processfamily import shm
+from concurrent.futures import Future
 import signal
 import functools
+import collections
 
 if sys.platform.startswith('win'):
     import win32job
@@ -41,9 +58,15 @@ if sys.platform.startswith('win'):
     from processfamily import win32Popen
 else:
     from . import ctypes_prctl as prctl
+    from processfamily.iomux import IOMultiplexer, LineReader
+    from processfamily.exitwatch import ExitWatcher
+    from processfamily.metrics import ChildMetricsCollector
 
 SIGNAL_NAMES = {getattr(signal, k): k for k in dir(signal) if k.startswith("SIG")}
 
+#subprocess.Popen can set the process group without a preexec_fn from Python 3.11
+_POPEN_SUPPORTS_PROCESS_GROUP = sys.version_info >= (3, 11)
+
 logger = logging.getLogger("processfamily")
 
 class JobObjectAssignError(Exception):
@@ -52,6 +75,13 @@ class JobObjectAssignError(Exception):
         self.cause = cause
         self.already_in_job = already_in_job
 
+class ChildSpawnError(Exception):
+    """Raised when one or more child processes could not be launched during a concurrent spawn"""
+    def __init__(self, message, errors):
+        super(ChildSpawnError, self).__init__(message)
+        #A dict of child_index -> the exception raised while launching that child
+        self.errors = errors
+
 def start_child_process(child_process_instance):
     host = _ChildProcessHost(child_process_instance)
     host.run()
@@ -75,6 +105,14 @@ class ChildProcess(object):
 
     """
 
+    RPC_DISPATCH_POOL_SIZE = None  # If set, RPC requests are handled by a fixed pool of this many threads, rather than a new thread each
+    RPC_DISPATCH_QUEUE_SIZE = 1000  # The number of requests that can wait for a pool thread before further requests are rejected as busy
+    WATCHDOG_INTERVAL = None  # If set, a heartbeat thread wakes this often (in seconds) to detect stalls, e.g. a thread holding the GIL
+    WATCHDOG_STALL_THRESHOLD = 1.0  # Stalls longer than this (in seconds) are reported to the parent, with the stacks of all the threads
+    STOP_WAIT_FOR_RUN = 3.0  # Seconds to wait for run() to return after stop() is called
+    STOP_WAIT_FOR_THREADS = 10.0  # Seconds to then wait for other non-daemon threads to finish before trying to force them to stop
+    STOP_TIMEOUT_FRACTION = 0.8  # The waits above are cut short to end by this fraction of the parent's stop timeout (if it sends one)
+
     def init(self):
         """
         Do any initialisation. The parent will wait for this to be complete before considering the process to be
@@ -95,6 +133,15 @@ class ChildProcess(object):
         :param timeout The number of milliseconds that the parent process will wait before killing this process.
         """
 
+    def register_rpc_methods(self, dispatcher):
+        """
+        Register any methods that the parent process can call (with ProcessFamily.call) on the given
+        jsonrpc.Dispatcher, e.g. dispatcher["do_work"] = self.do_work
+
+        This is called before init(), and the methods may be called from any thread. The names "stop",
+        "wait_for_start", "get_dispatch_stats", "ping", "start_profiler" and "stop_profiler" are reserved.
+        """
+
 class _ArgumentParser(argparse.ArgumentParser):
 
     def exit(self, status=0, message=None):
@@ -113,8 +160,24 @@ class _ChildProcessHost(object):
         self._started_event = threading.Event()
         self._stopped_event = threading.Event()
         self.dispatcher = jsonrpc.Dispatcher()
+        self.child_process.register_rpc_methods(self.dispatcher)
         self.dispatcher["stop"] = self._respond_immediately_for_stop
         self.dispatcher["wait_for_start"] = self._wait_for_start
+        self.dispatcher["get_dispatch_stats"] = self._get_dispatch_stats
+        self.dispatcher["ping"] = self._ping
+        self.dispatcher["start_profiler"] = self._start_profiler
+        self.dispatcher["stop_profiler"] = self._stop_profiler
+        #Requests are dispatched straight from the dispatcher's dict of methods (which later changes to the
+        #dispatcher still update)
+        self._methods = self.dispatcher.method_map
+        self._profiler = None
+        self._watchdog = None
+        if child_process.WATCHDOG_INTERVAL:
+            self._watchdog = StallWatchdog(self._report_stall, child_process.WATCHDOG_INTERVAL,
+                                           child_process.WATCHDOG_STALL_THRESHOLD)
+        self._dispatch_pool = None
+        if child_process.RPC_DISPATCH_POOL_SIZE:
+            self._dispatch_pool = DispatchPool(child_process.RPC_DISPATCH_POOL_SIZE, child_process.RPC_DISPATCH_QUEUE_SIZE)
 
         self.stdin = sys.stdin
         sys.stdin = open(os.devnull, 'r')
@@ -123,14 +186,37 @@ class _ChildProcessHost(object):
         sys.stdout = open(os.devnull, 'w')
 
         self._stdout_lock = threading.RLock()
+        #Set once the parent has negotiated binary frames, after which they are used in both directions
+        self._serializer = None
+        #Set if the parent talks to this process over a unix socket, rather than stdin and stdout
+        self._socket = None
+        self._socket_assembler = None
+        socket_fd = os.environ.pop(unixsocket.SOCKET_FD_ENV_VAR, None)
+        if socket_fd is not None:
+            self._socket = socket.socket(socket.AF_UNIX, socket.SOCK_SEQPACKET, fileno=int(socket_fd))
+            self._socket.set_inheritable(False)
+            self._socket_assembler = unixsocket.MessageAssembler()
+        #Set if the parent passes large payloads in shared memory: params arrive in its segments, and payloads of
+        #results of at least this many bytes are put in segments from this process's pool
+        shm_threshold = os.environ.pop(shm.THRESHOLD_ENV_VAR, None)
+        shm_pool_size = os.environ.pop(shm.POOL_SIZE_ENV_VAR, None)
+        self._shm_threshold = int(shm_threshold) if shm_threshold else None
+        self._shm_pool = shm.SegmentPool(int(shm_pool_size)) if self._shm_threshold else None
+        self._shm_attached = shm.AttachedSegments()
+        self._shm_lock = threading.Lock()
+        self._shm_detach_names = []
         self._sys_in_thread = threading.Thread(target=self._sys_in_thread_target, name="pf_%s_stdin" % repr(child_process))
         self._sys_in_thread.daemon = True
         self._should_stop = False
+        self._stop_timeout = None
+        self._stop_requested_time = None
 
     def run(self):
         #This is in the main thread
         try:
             self._sys_in_thread.start()
+            if self._watchdog is not None:
+                self._watchdog.start()
             try:
                 if self._should_stop:
                     return
@@ -146,23 +232,80 @@ class _ChildProcessHost(object):
             raise
         finally:
             self._stopped_event.set()
+            if self._shm_pool is not None:
+                #The parent may not have read the last results yet, so it destroys their segments
+                self._shm_pool.close(hand_over_in_use=True)
 
     def _wait_for_start(self):
         self._started_event.wait()
         return 0
 
+    def _get_dispatch_stats(self):
+        if self._dispatch_pool is None:
+            return {"pool_size": None}
+        return self._dispatch_pool.get_stats()
+
+    def _ping(self):
+        return 0
+
+    def _report_stall(self, stall):
+        logger.warning("Stalled for %.3fs", stall["latency"])
+        self._send_notification("stall", stall)
+
+    def _start_profiler(self, interval=0.01, max_stacks=10000, max_depth=100):
+        if self._profiler is not None:
+            self._profiler.stop()
+        self._profiler = SamplingProfiler(interval=interval, max_stacks=max_stacks, max_depth=max_depth)
+        self._profiler.start()
+        logger.info("Started the sampling profiler (interval %ss)", interval)
+        return 0
+
+    def _stop_profiler(self):
+        profiler, self._profiler = self._profiler, None
+        if profiler is None:
+            return None
+        profiler.stop()
+        logger.info("Stopped the sampling profiler after %d samples", profiler.samples)
+        return {
+            "samples": profiler.samples,
+            "truncated_samples": profiler.truncated_samples,
+            "collapsed_stacks": profiler.get_collapsed_stacks(),
+        }
+
     def _sys_in_thread_target(self):
         should_continue = True
         while should_continue:
             try:
-                line = self.stdin.readline()
-                if not line:
-                    should_continue = False
+                if self._socket is not None:
+                    message = unixsocket.recv_message(self._socket, self._socket_assembler)
+                    if message is None:
+                        should_continue = False
+                    else:
+                        try:
+                            should_continue = self._handle_command_message(*message)
+                        except Exception as e:
+                            logger.error("Error handling processfamily command on input: %s\n%s", e,  _traceback_str())
+                elif self._serializer is None:
+                    line = self.stdin.readline()
+                    if not line:
+                        should_continue = False
+                    else:
+                        try:
+                            should_continue = self._handle_command_line(line)
+                        except Exception as e:
+                            logger.error("Error handling processfamily command on input: %s\n%s", e,  _traceback_str())
                 else:
-                    try:
-                        should_continue = self._handle_command_line(line)
-                    except Exception as e:
-                        logger.error("Error handling processfamily command on input: %s\n%s", e,  _traceback_str())
+                    payload = framing.read_frame(self.stdin.buffer)
+                    if payload is None:
+                        should_continue = False
+                    else:
+                        try:
+                            should_continue = self._handle_command_frame(payload)
+                        except Exception as e:
+                            logger.error("Error handling processfamily command on input: %s\n%s", e,  _traceback_str())
+            except EOFError as e:
+                logger.error("Input for processfamily ended part way through a frame: %s", e)
+                should_continue = False
             except Exception as e:
                 logger.error("Exception reading input for processfamily: %s\n%s", e,  _traceback_str())
                 # This is a bit ugly, but I'm not sure what kind of error could cause this exception to occur,
@@ -170,28 +313,97 @@ class _ChildProcessHost(object):
                 time.sleep(5)
 
         self._should_stop = True
-        self._started_event.wait(1)
+        self._shutdown()
+
+    def _shutdown(self):
+        #Each phase ends early once there is nothing left to wait for. If the parent sent a stop timeout, they all
+        #end in time to leave the rest of it for forcing threads to stop before the parent kills this process
+        deadline = None
+        if self._stop_timeout is not None:
+            deadline = self._stop_requested_time + self.child_process.STOP_TIMEOUT_FRACTION * self._stop_timeout
+        def phase_end_time(seconds):
+            end_time = time.time() + seconds
+            return end_time if deadline is None else min(end_time, deadline)
+        def remaining(end_time):
+            return max(0, end_time - time.time())
+
+        self._started_event.wait(remaining(phase_end_time(1)))
         stop_thread = threading.Thread(target=self._stop_thread_target, name="pf_%s_stop" % repr(self.child_process))
         stop_thread.daemon = True
         stop_thread.start()
-        self._stopped_event.wait(3)
-        #Give her ten seconds to stop
+        self._stopped_event.wait(remaining(phase_end_time(self.child_process.STOP_WAIT_FOR_RUN)))
+        #Wait for any other non-daemon threads (which would keep this process alive) to finish
         #This will not actually stop the process from terminating as this is a daemon thread
-        time.sleep(10)
+        end_time = phase_end_time(self.child_process.STOP_WAIT_FOR_THREADS)
+        for thread in self._find_non_daemon_threads():
+            thread.join(remaining(end_time))
+        if self._stopped_event.is_set() and not self._find_non_daemon_threads():
+            return
         #Now try and force things
-        stop_threads()
+        if self._stop_timeout is None:
+            report = stop_threads_parallel()
+        else:
+            wait = min(1.0, (1 - self.child_process.STOP_TIMEOUT_FRACTION) * self._stop_timeout / 5)
+            report = stop_threads_parallel(global_wait=wait, thread_wait=wait)
+        logger.info("Stopped the remaining threads: %r", report)
+
+    def _find_non_daemon_threads(self):
+        main_thread = threading.main_thread()
+        return [t for t in filter_threads(threading.enumerate()) if not t.daemon and t is not main_thread and t.is_alive()]
 
     def _stop_thread_target(self):
+        timeout = None
+        if self._stop_timeout is not None:
+            timeout = int(max(0, self._stop_requested_time + self._stop_timeout - time.time()) * 1000)
         try:
-            self.child_process.stop()
+            self.child_process.stop(timeout=timeout)
         except Exception as e:
             logger.error("Error handling processfamily stop command: %s\n%s", e,  _traceback_str())
 
-    def _respond_immediately_for_stop(self):
+    def _respond_immediately_for_stop(self, timeout=None):
         logger.info("Received stop instruction from parent process")
+        if timeout is not None:
+            self._stop_requested_time = time.time()
+            self._stop_timeout = timeout / 1000.0
         self._should_stop = True
         return 0
 
+    def _send_notification(self, method, params):
+        """Sends a JSON-RPC notification (a request without an id) to the parent process"""
+        self._send_message({"jsonrpc": "2.0", "method": method, "params": params})
+
+    def _send_error(self, request_id, code, message):
+        self._send_message({"jsonrpc": "2.0", "error": {"code": code, "message": message}, "id": request_id})
+
+    def _send_message(self, msg):
+        """Sends a response or notification dict to the parent, as a JSON line or a frame depending on the mode"""
+        if self._socket is not None:
+            data = json.dumps(msg).encode('utf8')
+            with self._stdout_lock:
+                unixsocket.send_message(self._socket, data)
+            return
+        serializer = self._serializer
+        data = self._encode_message(serializer, msg)
+        with self._stdout_lock:
+            if serializer is not self._serializer:
+                #The mode changed while this was being encoded
+                serializer = self._serializer
+                data = self._encode_message(serializer, msg)
+            if serializer is None:
+                #json.dumps escapes any new lines, so this does not need the check in _send_response
+                logger.debug("Sending response: %s", data)
+                self.stdout.write(data + "\n")
+                self.stdout.flush()
+            else:
+                for chunk in data:
+                    self.stdout.buffer.write(chunk)
+                self.stdout.buffer.flush()
+
+    def _encode_message(self, serializer, msg):
+        if serializer is None:
+            return json.dumps(msg)
+        return framing.encode_frame(serializer, msg)
+
     def _send_response(self, rsp):
         if rsp:
             if '\n' in rsp:
@@ -204,7 +416,7 @@ class _ChildProcessHost(object):
     def _handle_command_line(self, line):
         try:
             line = line.strip()
-            if not line.startswith('{'):
+            if not line.startswith('{') and not line.startswith('['):
                 args = self.command_arg_parser.parse_args(shlex.split(line))
                 request = {
                     'jsonrpc': '2.0',
@@ -214,50 +426,260 @@ class _ChildProcessHost(object):
                     request['id'] = args.json_rpc_id
                 if args.params:
                     request['params'] = args.params
-                line = json.dumps(request)
             else:
                 request = json.loads(line)
-            request_id = json.dumps(request.get("id"))
         except Exception as e:
             logger.error("Error parsing command string: %s\n%s", e, _traceback_str())
-            self._send_response('{"jsonrpc": "2.0", "error": {"code": -32700, "message": "Parse error"}, "id": null}')
+            self._send_error(None, PARSE_ERROR, "Parse error")
             return True
+        return self._handle_request(request)
 
+    def _handle_command_message(self, data, fds):
+        try:
+            request = json.loads(data.decode('utf8'))
+        except Exception as e:
+            logger.error("Error parsing command message: %s\n%s", e, _traceback_str())
+            unixsocket.close_fds(fds)
+            self._send_error(None, PARSE_ERROR, "Parse error")
+            return True
+        return self._handle_request(request, fds)
+
+    def _handle_command_frame(self, payload):
+        try:
+            request = self._serializer.loads(payload)
+        except Exception as e:
+            logger.error("Error parsing command frame: %s\n%s", e, _traceback_str())
+            self._send_error(None, PARSE_ERROR, "Parse error")
+            return True
+        return self._handle_request(request)
+
+    def _handle_request(self, request, fds=None):
+        """Handles a parsed request; fds are any file descriptors that were passed along with it"""
+        self._handle_shm_names(request)
+        if fds and (not isinstance(request, dict) or request.get('method') in ('stop', 'negotiate_framing', 'get_dispatch_stats')):
+            logger.warning("Closing file descriptors passed with a request that does not take them")
+            unixsocket.close_fds(fds)
+            fds = None
+        if isinstance(request, list):
+            self._handle_batch_request(request)
+            return True
+        if not isinstance(request, dict):
+            self._send_error(None, INVALID_REQUEST, "Invalid Request")
+            return True
         if request.get('method') == 'stop':
             #I have to process the stop method in this thread!
 
             #This is a bit lame - but I'm just using this to form a valid response and send it immediately
             #
-            self._dispatch_rpc_call(line, request_id)
+            self._dispatch_rpc_call(request)
             return False
+        elif request.get('method') == 'negotiate_framing':
+            #This changes how the rest of the input is read, so it has to be processed in this thread
+            self._negotiate_framing(request)
+            return True
+        elif request.get('method') == 'get_dispatch_stats':
+            #This is answered immediately, so that it still works when the dispatch queue is full
+            self._dispatch_rpc_call(request)
+            return True
+        elif self._dispatch_pool is not None:
+            if not self._dispatch_pool.submit(self._dispatch_rpc_call_thread_target, request, fds):
+                logger.warning("Rejecting %s request: the dispatch queue is full", request.get('method'))
+                if fds:
+                    unixsocket.close_fds(fds)
+                if request.get('id') is not None:
+                    self._send_error(request.get('id'), SERVER_BUSY, "Server busy")
+            return True
         else:
             #Others should be processed from a new thread:
-            threading.Thread(target=self._dispatch_rpc_call_thread_target, args=(line, request_id)).start()
+            threading.Thread(target=self._dispatch_rpc_call_thread_target, args=(request, fds)).start()
             return True
 
-    def _dispatch_rpc_call(self, line, request_id):
+    def _handle_shm_names(self, request):
+        #Along with its next request, the parent sends the names of its segments that it has destroyed, and of this
+        #process's segments that it has finished reading
+        for r in (request if isinstance(request, list) else [request]):
+            if not isinstance(r, dict):
+                continue
+            if r.get('pf_shm_detach'):
+                self._shm_attached.detach(r['pf_shm_detach'])
+            if r.get('pf_shm_release') and self._shm_pool is not None:
+                destroyed = self._shm_pool.release_names(r['pf_shm_release'])
+                if destroyed:
+                    with self._shm_lock:
+                        self._shm_detach_names.extend(destroyed)
+
+    def _handle_batch_request(self, requests):
+        """Dispatches each request in a JSON-RPC batch as usual, and sends all of their responses as one array"""
+        if not requests:
+            self._send_error(None, INVALID_REQUEST, "Invalid Request")
+            return
+        batch = _BatchResponses(self, len(requests))
+        for request in requests:
+            if not isinstance(request, dict) or request.get('method') in ('stop', 'negotiate_framing'):
+                #These change the state of the host, so they have to be sent on their own
+                batch.add({"jsonrpc": "2.0", "error": {"code": INVALID_REQUEST, "message": "Invalid Request"}, "id": None})
+            elif request.get('method') == 'get_dispatch_stats':
+                self._dispatch_batch_call(request, batch)
+            elif self._dispatch_pool is not None:
+                if not self._dispatch_pool.submit(self._dispatch_batch_call, request, batch):
+                    logger.warning("Rejecting %s request: the dispatch queue is full", request.get('method'))
+                    batch.add({"jsonrpc": "2.0", "error": {"code": SERVER_BUSY, "message": "Server busy"},
+                               "id": request['id']} if 'id' in request else None)
+            else:
+                threading.Thread(target=self._dispatch_batch_call, args=(request, batch)).start()
+
+    def _dispatch_batch_call(self, request, batch):
+        rsp = None
         try:
-            rsp = jsonrpc.JSONRPCResponseManager.handle(line, self.dispatcher)
+            rsp = self._call_method(request)
+        except Exception as e:
+            logger.error("Error handling command string: %s\n%s", e, _traceback_str())
+            if 'id' in request:
+                rsp = {"jsonrpc": "2.0", "error": {"code": INTERNAL_ERROR, "message": "Error handling request"},
+                       "id": request['id']}
+        finally:
+            batch.add(rsp)
+
+    def _negotiate_framing(self, request):
+        params = request.get('params') or {}
+        name = params.get('serializer') if isinstance(params, dict) else (params[0] if params else None)
+        try:
+            if self._serializer is not None:
+                raise ValueError("Binary frames are already in use")
+            if self._socket is not None:
+                raise ValueError("Binary frames are not used over a unix socket")
+            if not hasattr(self.stdin, 'buffer') or not hasattr(self.stdout, 'buffer'):
+                raise ValueError("The standard streams have no binary buffers")
+            serializer = framing.get_serializer(name)
+        except ValueError as e:
+            logger.warning("Could not use binary frames with %s: %s", name, e)
+            self._send_error(request.get('id'), INVALID_PARAMS, str(e))
+            return
+        with self._stdout_lock:
+            #This response is the last JSON line; everything after it in both directions is a frame
+            self._send_message({"jsonrpc": "2.0", "result": serializer.name, "id": request.get('id')})
+            self._serializer = serializer
+        logger.info("Using binary frames with %s", serializer.name)
+
+    def _dispatch_rpc_call(self, request, fds=None):
+        try:
+            rsp = self._call_method(request, fds)
             if rsp is not None:
-                self._send_response(rsp.json)
+                self._send_message(rsp)
         except Exception as e:
             logger.error("Error handling command string: %s\n%s", e, _traceback_str())
-            self._send_response('{"jsonrpc": "2.0", "error": {"code": 32603, "message": "Error handling request"}, "id": %s}'%request_id)
+            self._send_error(request.get('id'), INTERNAL_ERROR, "Error handling request")
+
+    def _call_method(self, request, fds=None):
+        """Calls the method for a parsed request, returning the response dict (or None for a notification). The
+        errors are the same as the jsonrpc package's JSONRPCResponseManager would send. If file descriptors were
+        passed with the request, the method is called with them as an fds keyword argument, and is responsible for
+        closing them (unless it can't be called). Payloads passed in shared memory are memoryviews (or numpy arrays)
+        of the parent's segments, which are only valid until the method returns"""
+        method_name = request.get('method')
+        params = request.get('params')
+        if not isinstance(method_name, str) or not isinstance(params, (list, dict, type(None))):
+            if fds:
+                unixsocket.close_fds(fds)
+            return {"jsonrpc": "2.0", "error": {"code": INVALID_REQUEST, "message": "Invalid Request"}, "id": None}
+        method = self._methods.get(method_name)
+        error = None
+        if method is None:
+            if fds:
+                unixsocket.close_fds(fds)
+            error = {"code": METHOD_NOT_FOUND, "message": "Method not found"}
+        elif request.get('pf_shm'):
+            try:
+                params = shm.decode_payloads(params, self._shm_attached.get_buffer)
+            except FileNotFoundError as e:
+                #The parent destroys the segments for the params of a call that has timed out
+                logger.warning("The params of a %s request are no longer in shared memory: %s", method_name, e)
+                if fds:
+                    unixsocket.close_fds(fds)
+                error = {"code": INVALID_PARAMS, "message": "The params are no longer in shared memory"}
+        if error is None:
+            args, kwargs = (params, {}) if isinstance(params, list) else ((), params or {})
+            if fds:
+                kwargs = dict(kwargs, fds=fds)
+            try:
+                result = method(*args, **kwargs)
+            except JSONRPCDispatchException as e:
+                error = e.error._data
+            except Exception as e:
+                logger.error("Error in RPC method %s: %s\n%s", method_name, e, _traceback_str())
+                data = {"type": type(e).__name__, "args": e.args, "message": str(e)}
+                if isinstance(e, TypeError) and is_invalid_params(method, *args, **kwargs):
+                    if fds:
+                        unixsocket.close_fds(fds)
+                    error = {"code": INVALID_PARAMS, "message": "Invalid params", "data": data}
+                else:
+                    error = {"code": SERVER_ERROR, "message": "Server error", "data": data}
+            else:
+                if 'id' not in request:
+                    return None
+                if self._shm_threshold:
+                    return self._get_shm_response(request['id'], result)
+                return {"jsonrpc": "2.0", "result": result, "id": request['id']}
+        if 'id' not in request:
+            return None
+        return {"jsonrpc": "2.0", "error": error, "id": request['id']}
 
-    def _dispatch_rpc_call_thread_target(self, line, request_id):
+    def _get_shm_response(self, request_id, result):
+        """Returns the response for a result, with any large payloads in it put in segments for the parent to read,
+        and the names of any segments that have been destroyed since the last one"""
+        segments = []
+        try:
+            result = shm.encode_payloads(result, self._shm_threshold, self._shm_pool.acquire, segments)
+        except Exception:
+            for segment in segments:
+                self._shm_pool.release(segment)
+            raise
+        rsp = {"jsonrpc": "2.0", "result": result, "id": request_id}
+        if segments:
+            rsp["pf_shm"] = [segment.name for segment in segments]
+        with self._shm_lock:
+            detach_names, self._shm_detach_names = self._shm_detach_names, []
+        if detach_names:
+            rsp["pf_shm_detach"] = detach_names
+        return rsp
+
+    def _dispatch_rpc_call_thread_target(self, request, fds=None):
         try:
-            self._dispatch_rpc_call(line, request_id)
+            self._dispatch_rpc_call(request, fds)
         except Exception as e:
             logger.error("Error handling command string: %s\n%s", e, _traceback_str())
 
 
+class _BatchResponses(object):
+    """Collects the responses to the requests in a JSON-RPC batch, and sends them together once they are all done"""
+
+    def __init__(self, host, count):
+        self.host = host
+        self.remaining = count
+        self.responses = []
+        self.lock = threading.Lock()
+
+    def add(self, response):
+        """Adds the response to one of the requests (None for a notification)"""
+        with self.lock:
+            if response is not None:
+                self.responses.append(response)
+            self.remaining -= 1
+            if self.remaining:
+                return
+        if self.responses:
+            self.host._send_message(self.responses)
+
+
 class ChildCommsStrategy(object):
     """
     A proxy to the child process that can be used from the parent process
     """
     MONITOR_STDOUT = True
     SENDS_STDOUT_RESPONSES = False
+    USES_SOCKET = False  # The family gives each child one end of a unix socket pair (see ProcessFamilyUnixSocketRPCProtocolStrategy)
     CAN_WAIT_FOR_TERMINATE = True
+    CAN_WATCH_FOR_EXIT = True
 
     def __init__(self, process_instance, echo_std_err, child_index, process_family):
         if type(self) == ChildCommsStrategy:
@@ -269,17 +691,62 @@ class ChildCommsStrategy(object):
 
         self._rsp_queues_lock = threading.RLock()
         self._rsp_queues = {}
+        self._rsp_futures = {}
         self._stdin_lock = threading.RLock()
+        #Calls waiting to be written together (if the family has an RPC_BATCH_INTERVAL)
+        self._batch_lock = threading.Lock()
+        self._batch = []
+        #If the family has a SHARED_MEMORY_THRESHOLD: the segments holding the large payloads of pending calls'
+        #params, the child's segments with payloads of results, and the names of segments that have been destroyed,
+        #and of the child's segments that have been read, since the last request was sent
+        self._shm_pool = None
+        self._shm_attached = None
+        if self.process_family.SHARED_MEMORY_THRESHOLD and self.SENDS_STDOUT_RESPONSES:
+            self._shm_pool = shm.SegmentPool(self.process_family.SHARED_MEMORY_POOL_SIZE)
+            self._shm_attached = shm.AttachedSegments()
+        self._shm_call_segments = {}
+        self._shm_detach_names = []
+        self._shm_release_names = []
+        self.call_count = 0
+        self.rpc_stats = RPCStats()
+        self._command_response_events = {}
+
+        self.healthy = True
+        self.missed_heartbeats = 0
+        self._heartbeat_future = None
+        self._heartbeat_latencies = collections.deque(maxlen=self.process_family.HEARTBEAT_LATENCY_SAMPLES)
+
+        self._exit_event = threading.Event()
+        self._exit_lock = threading.Lock()
+        self._exit_callbacks = []
+        self.exit_detection = None
+        exit_watcher = self.process_family._get_exit_watcher()
+        if exit_watcher is not None and self.CAN_WATCH_FOR_EXIT:
+            self.exit_detection = exit_watcher.watch(self._process_instance, self._handle_exit)
+
+        #Set (by strategies that negotiate them) once the child's output after the current line is binary frames
+        self._frame_serializer = None
+        self._sys_out_reader = None
 
         self.echo_std_err = echo_std_err
+        self._sys_err_closed_event = threading.Event()
+        io_multiplexer = self.process_family._get_io_multiplexer()
         if self.echo_std_err:
-            self._sys_err_thread = threading.Thread(target=self._sys_err_thread_target, name="pf_%s_stderr" % self.name)
-            self._sys_err_thread.daemon = True
-            self._sys_err_thread.start()
+            if io_multiplexer is not None:
+                LineReader(io_multiplexer, self._process_instance.stderr.fileno(), self._handle_sys_err_line,
+                           self._handle_sys_err_closed)
+            else:
+                self._sys_err_thread = threading.Thread(target=self._sys_err_thread_target, name="pf_%s_stderr" % self.name)
+                self._sys_err_thread.daemon = True
+                self._sys_err_thread.start()
         if self.MONITOR_STDOUT:
-            self._sys_out_thread = threading.Thread(target=self._sys_out_thread_target, name="pf_%s_stdout" % self.name)
-            self._sys_out_thread.daemon = True
-            self._sys_out_thread.start()
+            if io_multiplexer is not None:
+                self._sys_out_reader = LineReader(io_multiplexer, self._process_instance.stdout.fileno(),
+                                                  self._handle_sys_out_line, self._handle_sys_out_eof)
+            else:
+                self._sys_out_thread = threading.Thread(target=self._sys_out_thread_target, name="pf_%s_stdout" % self.name)
+                self._sys_out_thread.daemon = True
+                self._sys_out_thread.start()
 
     def __repr__(self):
         return "%s (%s: %r)" % (self.name, type(self).__name__, self._process_instance)
@@ -290,7 +757,17 @@ class ChildCommsStrategy(object):
 
     def is_stopped(self):
         """return whether the governed process has stopped"""
-        return self._process_instance.poll() is not None
+        return self._exit_event.is_set() or self._process_instance.poll() is not None
+
+    def add_exit_callback(self, callback):
+        """Calls callback(child_comms_strategy) once the child process has exited, or immediately if it already has.
+        The callback is called from a background thread and must not block. Unless exit_detection is set, exits are
+        only noticed when the child's stdout closes"""
+        with self._exit_lock:
+            if self._exit_callbacks is not None:
+                self._exit_callbacks.append(callback)
+                return
+        callback(self)
 
     @staticmethod
     def get_popen_streams(echo_std_err):
@@ -313,69 +790,269 @@ class ChildCommsStrategy(object):
         yield
         yield
 
+    def call(self, method, params=None, timeout=None):
+        """Calls an RPC method on the child, returning a concurrent.futures.Future for the result"""
+        raise NotImplementedError("%s does not support RPC calls" % type(self).__name__)
+
+    def call_batch(self, calls, timeout=None):
+        """Calls several RPC methods on the child at once, given a list of (method, params). Returns a list of
+        concurrent.futures.Future for the results"""
+        raise NotImplementedError("%s does not support RPC calls" % type(self).__name__)
+
+    def flush_batch(self):
+        """Writes any calls that are waiting to be sent in a batch"""
+
+    @property
+    def pending_call_count(self):
+        """The number of RPC calls that have been sent to the child but not yet answered"""
+        with self._rsp_queues_lock:
+            return len(self._rsp_futures)
+
+    def send_heartbeat(self, timeout):
+        """Checks that the child is responsive, if the strategy supports it. Heartbeats are not sent while one is
+        still waiting for a response"""
+
+    def get_health(self):
+        """Returns a dict of whether this child is healthy, the number of heartbeats it has missed in a row, and the
+        percentiles of its recent heartbeat round trip times (in seconds, or None if there are none yet)"""
+        latencies = sorted(self._heartbeat_latencies)
+        health = {"healthy": self.healthy, "missed_heartbeats": self.missed_heartbeats, "samples": len(latencies)}
+        for p in (50, 90, 99):
+            health["p%d" % p] = latencies[min(len(latencies) - 1, len(latencies) * p // 100)] if latencies else None
+        return health
+
     def _sys_err_thread_target(self):
         while True:
             try:
                 line = self._process_instance.stderr.readline()
                 if not line:
                     break
-                try:
-                    self.process_family.handle_sys_err_line(self.child_index, line)
-                except Exception as e:
-                    logger.error("Error handling %s stderr output: %s\n%s", self.name, e,  _traceback_str())
+                self._handle_sys_err_line(line)
             except Exception as e:
                 logger.error("Exception reading stderr output for %s: %s\n%s", self.name, e,  _traceback_str())
                 # This is a bit ugly, but I'm not sure what kind of error could cause this exception to occur,
                 # so it might get in to a tight loop which I want to avoid
                 time.sleep(5)
+        self._handle_sys_err_closed()
+
+    def _handle_sys_err_line(self, line):
+        try:
+            self.process_family.handle_sys_err_line(self.child_index, line)
+        except Exception as e:
+            logger.error("Error handling %s stderr output: %s\n%s", self.name, e,  _traceback_str())
+
+    def _handle_sys_err_closed(self):
         logger.debug("Subprocess stderr closed")
+        self._sys_err_closed_event.set()
 
     def _sys_out_thread_target(self):
+        while True:
+            try:
+                line = self._process_instance.stdout.readline()
+                if not line:
+                    break
+                self._handle_sys_out_line(line)
+                if self._frame_serializer is not None:
+                    self._read_sys_out_frames()
+                    break
+            except Exception as e:
+                logger.error("Exception reading stdout output for %s: %s\n%s", self.name, e,  _traceback_str())
+                # This is a bit ugly, but I'm not sure what kind of error could cause this exception to occur,
+                # so it might get in to a tight loop which I want to avoid
+                time.sleep(5)
+        self._handle_sys_out_closed()
+
+    def _read_sys_out_frames(self):
+        while True:
+            try:
+                payload = framing.read_frame(self._process_instance.stdout)
+            except EOFError as e:
+                logger.error("Stdout output for %s ended part way through a frame: %s", self.name, e)
+                return
+            if payload is None:
+                return
+            self._handle_sys_out_frame(payload)
+
+    def _handle_sys_out_line(self, line):
+        try:
+            if self.SENDS_STDOUT_RESPONSES:
+                self._handle_response_line(line)
+            else:
+                self.process_family.handle_sys_out_line(self.child_index, line)
+        except Exception as e:
+            logger.error("Error handling %s stdout output: %s\n%s", self.name, e,  _traceback_str())
+        if self._frame_serializer is not None and self._sys_out_reader is not None:
+            self._sys_out_reader.switch_to_frames(self._handle_sys_out_frame)
+
+    def _handle_sys_out_frame(self, payload):
+        try:
+            self._handle_response(self._frame_serializer.loads(payload))
+        except Exception as e:
+            logger.error("Error handling %s stdout frame: %s\n%s", self.name, e,  _traceback_str())
+
+    def _handle_sys_out_eof(self):
+        if self.exit_detection is None:
+            #Waiting for the process to terminate must not hold up the I/O multiplexer thread
+            t = threading.Thread(target=self._handle_sys_out_closed, name="pf_%s_stdout_closed" % self.name)
+            t.daemon = True
+            t.start()
+            return
+        logger.debug("Subprocess stdout closed - expecting termination")
+        rpc_deadlines = self.process_family._get_rpc_deadlines()
+        deadline = rpc_deadlines.schedule(time.time() + 5, self._finish_sys_out_closed)
+
+        def exit_callback(child):
+            rpc_deadlines.cancel(deadline)
+            self._finish_sys_out_closed()
+        self.add_exit_callback(exit_callback)
+
+    def _handle_sys_out_closed(self):
         try:
-            while True:
-                try:
-                    line = self._process_instance.stdout.readline()
-                    if not line:
-                        break
-                    try:
-                        if self.SENDS_STDOUT_RESPONSES:
-                            self._handle_response_line(line)
-                        else:
-                            self.process_family.handle_sys_out_line(self.child_index, line)
-                    except Exception as e:
-                        logger.error("Error handling %s stdout output: %s\n%s", self.name, e,  _traceback_str())
-                except Exception as e:
-                    logger.error("Exception reading stdout output for %s: %s\n%s", self.name, e,  _traceback_str())
-                    # This is a bit ugly, but I'm not sure what kind of error could cause this exception to occur,
-                    # so it might get in to a tight loop which I want to avoid
-                    time.sleep(5)
             logger.debug("Subprocess stdout closed - expecting termination")
-            start_time = time.time()
-            while self._process_instance.poll() is None and time.time() - start_time < 5:
-                time.sleep(0.1)
-            if self.echo_std_err:
-                self._sys_err_thread.join(5)
-            if self._process_instance.poll() is None:
-                logger.error("Stdout stream closed for %s, but process is not terminated (PID:%s)", self.name, self.pid)
+            if self.exit_detection is not None:
+                self._exit_event.wait(5)
             else:
-                logger.info("%s terminated (return code: %d)", self.name, self._process_instance.returncode)
+                start_time = time.time()
+                while self._process_instance.poll() is None and time.time() - start_time < 5:
+                    time.sleep(0.1)
+            if self.echo_std_err:
+                self._sys_err_closed_event.wait(5)
         finally:
-            #Unstick any waiting command threads:
-            with self._rsp_queues_lock:
-                for q in list(self._rsp_queues.values()):
-                    if q.empty():
-                        q.put_nowait(None)
-                self._rsp_queues = None
+            self._finish_sys_out_closed()
+
+    def _finish_sys_out_closed(self):
+        with self._rsp_queues_lock:
+            if self._rsp_queues is None:
+                return
+            rsp_queues = list(self._rsp_queues.values())
+            self._rsp_queues = None
+            rsp_futures = list(self._rsp_futures.values())
+            self._rsp_futures = {}
+            shm_release_names, self._shm_release_names = self._shm_release_names, []
+        if self._shm_attached is not None:
+            #The child has left the segments with results that it was waiting for this process to read
+            self._shm_attached.close()
+            shm.unlink_segments(shm_release_names)
+        if self._process_instance.poll() is None:
+            logger.error("Stdout stream closed for %s, but process is not terminated (PID:%s)", self.name, self.pid)
+        else:
+            logger.info("%s terminated (return code: %d)", self.name, self._process_instance.returncode)
+            self._handle_exit()
+        #Unstick any waiting command threads:
+        for q in rsp_queues:
+            if q.empty():
+                q.put_nowait(None)
+        for future, deadline, start_time in rsp_futures:
+            self._fail_future(future, deadline, ChildTerminatedError("%s terminated before responding" % self.name))
+
+    def _handle_exit(self):
+        self._exit_event.set()
+        self._close_shm_pool()
+        with self._exit_lock:
+            callbacks, self._exit_callbacks = self._exit_callbacks, None
+        if callbacks is None:
+            return
+        self.process_family._record_lifecycle_event(tracing.EXITED, self.child_index, self.pid)
+        for callback in callbacks:
+            try:
+                callback(self)
+            except Exception as e:
+                logger.error("Error in exit callback for %s: %s\n%s", self.name, e, _traceback_str())
+        self.process_family._notify_child_exit()
 
     def _handle_response_line(self, line):
-        rsp = json.loads(line)
+        self._handle_response(json.loads(line))
+
+    def _handle_response(self, rsp):
+        if isinstance(rsp, list):
+            #The responses to a batch request
+            for r in rsp:
+                self._handle_response(r)
+            return
         if "id" in rsp:
+            if rsp.get("pf_shm") or rsp.get("pf_shm_detach"):
+                rsp = self._read_shm_payloads(rsp)
             with self._rsp_queues_lock:
                 if self._rsp_queues is None:
                     return
                 rsp_queue = self._rsp_queues.get(rsp["id"], None)
+                rsp_future = self._rsp_futures.pop(rsp["id"], None) if rsp_queue is None else None
+                segments = self._shm_call_segments.pop(rsp["id"], None) if self._shm_call_segments else None
+                if rsp_future is not None and rsp_future[2] is not None:
+                    self.rpc_stats.record_response(time.time() - rsp_future[2], "error" in rsp)
+                event_name = self._command_response_events.pop(rsp["id"], None) if rsp_queue is not None else None
+            if segments:
+                #The child is done with the params
+                self._release_shm_segments(segments)
+            if event_name is not None:
+                #Recorded as the response arrives, rather than when it is waited for
+                self.process_family._record_lifecycle_event(event_name, self.child_index, self.pid)
             if rsp_queue is not None:
                 rsp_queue.put_nowait(rsp)
+            elif rsp_future is not None:
+                future, deadline, start_time = rsp_future
+                if deadline is not None:
+                    self.process_family._get_rpc_deadlines().cancel(deadline)
+                if "error" in rsp:
+                    future.set_exception(error_from_response(rsp["error"]))
+                else:
+                    future.set_result(rsp.get("result"))
+        elif "method" in rsp:
+            self.process_family.handle_child_notification(self.child_index, rsp["method"], rsp.get("params"))
+
+    def _read_shm_payloads(self, rsp):
+        """Returns the response with copies of the payloads of the result in place of their descriptors"""
+        if rsp.get("pf_shm_detach"):
+            self._shm_attached.detach(rsp["pf_shm_detach"])
+        if not rsp.get("pf_shm"):
+            return rsp
+        try:
+            return dict(rsp, result=shm.decode_payloads(rsp.get("result"), self._shm_attached.get_buffer, copy=True))
+        except Exception as e:
+            logger.error("Error reading the result from %s in shared memory: %s\n%s", self.name, e, _traceback_str())
+            return {"jsonrpc": "2.0", "error": {"code": INTERNAL_ERROR, "message": "Could not read the result in shared "
+                                                "memory: %s" % e}, "id": rsp["id"]}
+        finally:
+            #The child can reuse the segments once it has been told that they have been read
+            with self._rsp_queues_lock:
+                child_gone = self._rsp_queues is None
+                if not child_gone:
+                    self._shm_release_names.extend(rsp["pf_shm"])
+            if child_gone:
+                shm.unlink_segments(rsp["pf_shm"])
+
+    def _release_shm_segments(self, segments, reuse=True):
+        """Returns the segments to the pool (or destroys them, if the child may still be using them), and remembers
+        the names of any that were destroyed, to tell the child"""
+        names = []
+        for segment in segments:
+            if reuse:
+                names.extend(self._shm_pool.release(segment))
+            else:
+                names.append(self._shm_pool.discard(segment))
+        if names:
+            with self._rsp_queues_lock:
+                self._shm_detach_names.extend(names)
+
+    def _add_shm_names(self, cmd):
+        """Adds the names of segments destroyed, and of the child's segments read, since the last request to cmd"""
+        with self._rsp_queues_lock:
+            detach_names, self._shm_detach_names = self._shm_detach_names, []
+            release_names, self._shm_release_names = self._shm_release_names, []
+        if detach_names:
+            cmd["pf_shm_detach"] = detach_names
+        if release_names:
+            cmd["pf_shm_release"] = release_names
+
+    def _close_shm_pool(self):
+        """Destroys the segments for params, once the child has exited"""
+        if self._shm_pool is not None:
+            self._shm_pool.close()
+
+    def _fail_future(self, future, deadline, exception):
+        if deadline is not None:
+            self.process_family._get_rpc_deadlines().cancel(deadline)
+        future.set_exception(exception)
 
 #We need to keep the job handle in a global variable so that can't go out of scope and result in our process
 #being killed
@@ -422,29 +1099,177 @@ class ProcessFamilyRPCProtocolStrategy(ChildCommsStrategy):
         finally:
             self._cleanup_queue(response_id)
         if response is None:
-            poll_result = self._process_instance.poll()
-            if poll_result is None:
-                logger.error("Timed out waiting for %s (PID %d) to complete initialisation",
-                             self.name, self.pid)
-            else:
-                logger.error("%s terminated with response code %d before completing initialisation",
-                             self.name, poll_result)
+            self._log_startup_failure()
+
+    def _log_startup_failure(self):
+        poll_result = self._process_instance.poll()
+        if poll_result is None:
+            logger.error("Timed out waiting for %s (PID %d) to complete initialisation",
+                         self.name, self.pid)
+        else:
+            logger.error("%s terminated with response code %d before completing initialisation",
+                         self.name, poll_result)
 
     def stop_child(self, end_time):
         """generator method to send stop to child, with the first yield after sending the shutdown command,
         the next after receiving a response, and stopping after cleanup"""
         response_id = str(uuid.uuid4())
+        #Calls that were made before stopping are sent first
+        self.flush_batch()
         try:
-            yield self._send_command_req(response_id, "stop")
+            #The child uses the timeout (in milliseconds) to budget its shutdown before it would be killed
+            timeout = int(max(0, end_time - time.time()) * 1000)
+            yield self._send_command_req(response_id, "stop", {"timeout": timeout})
             yield self._wait_for_response(response_id, end_time - time.time())
         finally:
             self._cleanup_queue(response_id)
 
-    def _send_command_req(self, response_id, command, params=None):
+    def call(self, method, params=None, timeout=None):
+        """Calls an RPC method on the child, returning a concurrent.futures.Future for the result. The future
+        raises an RPCError if the child responds with an error, RPCTimeoutError if there is no response within
+        timeout seconds, or ChildTerminatedError if the child stops before responding"""
+        return self._call(method, params, timeout)
+
+    def call_batch(self, calls, timeout=None):
+        """Calls several RPC methods on the child with a single JSON-RPC batch request, given a list of
+        (method, params). Returns a list of concurrent.futures.Future for the results, as for call"""
+        futures = []
+        cmds = []
+        for method, params in calls:
+            future, cmd = self._start_call(method, params, timeout)
+            futures.append(future)
+            if cmd is not None:
+                cmds.append(cmd)
+        if cmds:
+            self._write_calls(cmds)
+        return futures
+
+    def flush_batch(self):
+        with self._batch_lock:
+            batch, self._batch = self._batch, []
+        if batch:
+            self._write_calls(batch)
+
+    def send_heartbeat(self, timeout):
+        if self._heartbeat_future is not None and not self._heartbeat_future.done():
+            return
+        start_time = time.time()
+        #Heartbeats are not counted as calls (for RECYCLE_CALL_LIMIT)
+        self._heartbeat_future = self._call("ping", timeout=timeout, count_call=False)
+        self._heartbeat_future.add_done_callback(functools.partial(self._handle_heartbeat_response, start_time))
+
+    def _handle_heartbeat_response(self, start_time, future):
+        e = future.exception()
+        if isinstance(e, ChildTerminatedError):
+            return
+        if isinstance(e, RPCTimeoutError):
+            self.missed_heartbeats += 1
+            logger.warning("%s missed a heartbeat (%d in a row)", self.name, self.missed_heartbeats)
+            if self.healthy and self.missed_heartbeats >= self.process_family.HEARTBEAT_MAX_MISSED:
+                self.healthy = False
+                self.process_family._handle_child_health_change(self)
+            return
+        #Any response (even an error, e.g. if the child is busy) means that the child is still processing requests
+        self._heartbeat_latencies.append(time.time() - start_time)
+        self.missed_heartbeats = 0
+        if not self.healthy:
+            self.healthy = True
+            self.process_family._handle_child_health_change(self)
+
+    def _call(self, method, params=None, timeout=None, count_call=True):
+        future, cmd = self._start_call(method, params, timeout, count_call)
+        if cmd is None:
+            return future
+        if self.process_family.RPC_BATCH_INTERVAL:
+            self._queue_call(cmd)
+        else:
+            self._write_calls([cmd])
+        return future
+
+    def _start_call(self, method, params=None, timeout=None, count_call=True):
+        """Registers a call, returning its future and the request to send (or None if the child has terminated)"""
+        future = Future()
+        future.set_running_or_notify_cancel()
+        response_id = str(uuid.uuid4())
+        deadline = None
+        segments = []
+        if self._shm_pool is not None and params is not None:
+            try:
+                params = shm.encode_payloads(params, self.process_family.SHARED_MEMORY_THRESHOLD,
+                                             self._shm_pool.acquire, segments)
+            except Exception as e:
+                self._release_shm_segments(segments, reuse=False)
+                future.set_exception(ChildTerminatedError("%s has terminated" % self.name)
+                                     if self._rsp_queues is None else e)
+                return future, None
         with self._rsp_queues_lock:
             if self._rsp_queues is None:
-                return
-            self._rsp_queues[response_id] = queue.Queue()
+                future.set_exception(ChildTerminatedError("%s has terminated" % self.name))
+                terminated = True
+            else:
+                terminated = False
+                if timeout is not None:
+                    deadline = self.process_family._get_rpc_deadlines().schedule(
+                        time.time() + timeout, functools.partial(self._call_timed_out, response_id, method, timeout))
+                #Only counted calls are included in call_count and rpc_stats
+                self._rsp_futures[response_id] = (future, deadline, time.time() if count_call else None)
+                if count_call:
+                    self.call_count += 1
+                if segments:
+                    self._shm_call_segments[response_id] = segments
+        if terminated:
+            self._release_shm_segments(segments, reuse=False)
+            return future, None
+        cmd = self._get_command(response_id, method, params)
+        if segments:
+            cmd["pf_shm"] = True
+        self._add_shm_names(cmd)
+        return future, cmd
+
+    def _queue_call(self, cmd):
+        with self._batch_lock:
+            self._batch.append(cmd)
+            first = len(self._batch) == 1
+            batch = None
+            if len(self._batch) >= self.process_family.RPC_BATCH_MAX_SIZE:
+                batch, self._batch = self._batch, []
+        if batch is not None:
+            self._write_calls(batch)
+        elif first:
+            self.process_family._schedule_batch_flush(self)
+
+    def _write_calls(self, cmds, fds=None):
+        """Writes the requests for calls (as a batch if there is more than one), failing them if it can't"""
+        try:
+            self._write_command_req(self._encode_command_req(cmds[0] if len(cmds) == 1 else cmds), fds=fds)
+        except Exception as e:
+            for cmd in cmds:
+                with self._rsp_queues_lock:
+                    rsp_future = self._rsp_futures.pop(cmd["id"], None) if self._rsp_queues is not None else None
+                    segments = self._shm_call_segments.pop(cmd["id"], None)
+                if segments:
+                    self._release_shm_segments(segments, reuse=False)
+                if rsp_future is not None:
+                    self._fail_future(rsp_future[0], rsp_future[1], e)
+
+    def _call_timed_out(self, response_id, method, timeout):
+        with self._rsp_queues_lock:
+            rsp_future = self._rsp_futures.pop(response_id, None) if self._rsp_queues is not None else None
+            if rsp_future is not None and rsp_future[2] is not None:
+                self.rpc_stats.record_timeout()
+            segments = self._shm_call_segments.pop(response_id, None)
+        if segments:
+            #The child may still be reading the params, so these segments are not reused
+            self._release_shm_segments(segments, reuse=False)
+        if rsp_future is not None:
+            rsp_future[0].set_exception(RPCTimeoutError(
+                "Timed out after %ss waiting for %s to respond to %s" % (timeout, self.name, method)))
+
+    def _get_command_req(self, response_id, command, params=None):
+        """Returns a list of the bytes-like chunks to write for the request"""
+        return self._encode_command_req(self._get_command(response_id, command, params))
+
+    def _get_command(self, response_id, command, params=None):
         cmd = {
             "method": command,
             "id": response_id,
@@ -452,22 +1277,55 @@ class ProcessFamilyRPCProtocolStrategy(ChildCommsStrategy):
         }
         if params is not None:
             cmd["params"] = params
+        return cmd
 
+    def _encode_command_req(self, cmd):
+        """Returns a list of the bytes-like chunks to write for a request (or a list of requests, as a batch)"""
+        if self._frame_serializer is not None:
+            return framing.encode_frame(self._frame_serializer, cmd)
         req = json.dumps(cmd)
         if '\n' in req:
             raise ValueError('Invalid request string (new lines are not allowed): "%r"' % req)
+        return [("%s\n" % req).encode('utf8')]
 
+    def _write_command_req(self, req, close_stdin=False, fds=None):
         try:
             with self._stdin_lock:
-                self._process_instance.stdin.write(("%s\n" % req).encode('utf8'))
-                self._process_instance.stdin.flush()
-                if command == 'stop':
-                    #Now close the stream - we are done
-                    self._process_instance.stdin.close()
+                self._write_to_child(req, close_stdin, fds)
         except Exception as e:
             if self._process_instance.poll() is None:
                 #The process is running, so something is wrong:
                 raise
+            if not close_stdin:
+                raise ChildTerminatedError("%s has terminated" % self.name)
+
+    def _write_to_child(self, req, close_stdin, fds):
+        if fds:
+            raise ValueError("%s cannot pass file descriptors" % type(self).__name__)
+        for chunk in req:
+            self._process_instance.stdin.write(chunk)
+        self._process_instance.stdin.flush()
+        if close_stdin:
+            #Now close the stream - we are done
+            self._process_instance.stdin.close()
+
+    def _send_command_req(self, response_id, command, params=None):
+        with self._rsp_queues_lock:
+            if self._rsp_queues is None:
+                return
+            self._rsp_queues[response_id] = queue.Queue()
+            event_name = {"wait_for_start": tracing.READY, "stop": tracing.STOP_ACKED}.get(command)
+            if event_name is not None:
+                self._command_response_events[response_id] = event_name
+        cmd = self._get_command(response_id, command, params)
+        if command == 'stop':
+            #So that the child destroys the segments with results that have been read before it exits
+            self._add_shm_names(cmd)
+        req = self._encode_command_req(cmd)
+        try:
+            self._write_command_req(req, close_stdin=command == 'stop')
+        except ChildTerminatedError:
+            pass
 
     def _wait_for_response(self, response_id, timeout):
         with self._rsp_queues_lock:
@@ -488,6 +1346,150 @@ class ProcessFamilyRPCProtocolStrategy(ChildCommsStrategy):
         with self._rsp_queues_lock:
             if self._rsp_queues is not None:
                 self._rsp_queues.pop(response_id, None)
+            self._command_response_events.pop(response_id, None)
+
+
+class ProcessFamilyBinaryRPCProtocolStrategy(ProcessFamilyRPCProtocolStrategy):
+    """
+    The RPC protocol, but with length prefixed binary frames (serialized with the family's BINARY_RPC_SERIALIZER)
+    rather than JSON lines once the child has started, so params and results can be any type the serializer supports
+    (e.g. bytes). If the child does not accept the serializer, JSON lines are used instead.
+    """
+    _framing_negotiation_id = None
+
+    def monitor_child_startup(self, end_time):
+        """generator method to monitor process startup, with the first yield after negotiating the framing,
+        the next after receiving a response, and stopping after cleanup"""
+        serializer_name = self.process_family.BINARY_RPC_SERIALIZER
+        negotiation_id = str(uuid.uuid4())
+        response_id = str(uuid.uuid4())
+        try:
+            framing.get_serializer(serializer_name)
+        except ValueError as e:
+            logger.warning("Not using binary frames for %s: %s", self.name, e)
+            negotiation_id = None
+        try:
+            if negotiation_id is not None:
+                self._framing_negotiation_id = negotiation_id
+                yield self._send_command_req(negotiation_id, "negotiate_framing", {"serializer": serializer_name})
+                response = self._wait_for_response(negotiation_id, end_time - time.time())
+                if response is not None and "error" in response:
+                    logger.warning("%s did not accept binary frames (using JSON lines): %s",
+                                   self.name, response["error"].get("message"))
+            else:
+                response = {}
+                yield
+            if response is not None:
+                self._send_command_req(response_id, "wait_for_start")
+                response = self._wait_for_response(response_id, end_time - time.time())
+            yield response
+        finally:
+            if negotiation_id is not None:
+                self._cleanup_queue(negotiation_id)
+            self._cleanup_queue(response_id)
+        if response is None:
+            self._log_startup_failure()
+
+    def _handle_response(self, rsp):
+        if "result" in rsp and rsp.get("id") is not None and rsp.get("id") == self._framing_negotiation_id:
+            #The child sends frames after this response, so the reader has to switch before it reads any more
+            self._frame_serializer = framing.get_serializer(rsp["result"])
+            logger.debug("Using binary frames with %s for %s", rsp["result"], self.name)
+        super(ProcessFamilyBinaryRPCProtocolStrategy, self)._handle_response(rsp)
+
+
+class ProcessFamilyUnixSocketRPCProtocolStrategy(ProcessFamilyRPCProtocolStrategy):
+    """
+    The RPC protocol over a SOCK_SEQPACKET unix socket pair, rather than the child's stdin and stdout (not on
+    Windows). Messages are not limited to a line or by the pipe buffer size, and file descriptors (e.g. accepted client
+    sockets or memfds) can be passed to the child with call_with_fds.
+    """
+    MONITOR_STDOUT = False
+    USES_SOCKET = True
+
+    def __init__(self, process_instance, echo_std_err, child_index, process_family):
+        #Given to the Popen instance by ProcessFamily._launch_child_process
+        self._socket = process_instance.processfamily_socket
+        self._socket_assembler = unixsocket.MessageAssembler()
+        super(ProcessFamilyUnixSocketRPCProtocolStrategy, self).__init__(
+            process_instance, echo_std_err, child_index, process_family)
+        io_multiplexer = self.process_family._get_io_multiplexer()
+        if io_multiplexer is not None:
+            io_multiplexer.register(self._socket.fileno(), self._handle_socket_readable)
+        else:
+            self._socket_thread = threading.Thread(target=self._socket_thread_target, name="pf_%s_socket" % self.name)
+            self._socket_thread.daemon = True
+            self._socket_thread.start()
+
+    @staticmethod
+    def get_popen_streams(echo_std_err):
+        """Returns kwargs for stdin, stdout and stderr to pass to subprocess.Popen"""
+        streams = {"stdin": open(os.devnull, 'r'), "stdout": open(os.devnull, 'w'), "stderr": subprocess.PIPE}
+        if not echo_std_err:
+            streams["stderr"] = open(os.devnull, 'w')
+        return streams
+
+    def call_with_fds(self, method, params=None, fds=(), timeout=None):
+        """Calls an RPC method on the child, passing it copies of the given file descriptors, which the method gets
+        (as numbers in the child) in an fds keyword argument; it is responsible for closing them. The caller can close
+        its own copies once this returns. Returns a concurrent.futures.Future for the result, as for call"""
+        future, cmd = self._start_call(method, params, timeout)
+        if cmd is not None:
+            self._write_calls([cmd], fds=list(fds))
+        return future
+
+    def _encode_command_req(self, cmd):
+        #Messages have no delimiter, so new lines are allowed
+        return [json.dumps(cmd).encode('utf8')]
+
+    def _write_to_child(self, req, close_stdin, fds):
+        unixsocket.send_message(self._socket, req[0] if len(req) == 1 else b''.join(req), fds or ())
+        if close_stdin:
+            self._socket.shutdown(socket.SHUT_WR)
+
+    def _socket_thread_target(self):
+        while True:
+            try:
+                message = unixsocket.recv_message(self._socket, self._socket_assembler)
+            except Exception as e:
+                logger.error("Exception reading from the socket for %s: %s\n%s", self.name, e,  _traceback_str())
+                break
+            if message is None:
+                break
+            self._handle_socket_message(*message)
+        self._handle_sys_out_closed()
+
+    def _handle_socket_readable(self):
+        while True:
+            try:
+                packet, fds = unixsocket.recv_packet(self._socket, socket.MSG_DONTWAIT)
+            except (IOError, OSError) as e:
+                if e.errno in (errno.EAGAIN, errno.EWOULDBLOCK, errno.EINTR):
+                    return
+                logger.error("Exception reading from the socket for %s: %s", self.name, e)
+                packet = b''
+            if not packet:
+                self.process_family._get_io_multiplexer().unregister(self._socket.fileno())
+                self._socket_assembler.close()
+                self._handle_sys_out_eof()
+                return
+            message = self._socket_assembler.add_packet(packet, fds)
+            if message is not None:
+                self._handle_socket_message(*message)
+
+    def _handle_socket_message(self, data, fds):
+        if fds:
+            logger.warning("Closing %d file descriptors sent by %s", len(fds), self.name)
+            unixsocket.close_fds(fds)
+        try:
+            self._handle_response(json.loads(data.decode('utf8')))
+        except Exception as e:
+            logger.error("Error handling %s socket message: %s\n%s", self.name, e,  _traceback_str())
+
+    def _finish_sys_out_closed(self):
+        super(ProcessFamilyUnixSocketRPCProtocolStrategy, self)._finish_sys_out_closed()
+        #The socket has been unregistered from any I/O multiplexer by now
+        self._socket.close()
 
 
 class SignalStrategy(ChildCommsStrategy):
@@ -504,6 +1506,7 @@ class SignalStrategy(ChildCommsStrategy):
 class ForkingChildSignalStrategy(SignalStrategy):
     # requires the process_family instance to have a pid_file attribute added...
     MONITOR_STDOUT = False
+    CAN_WATCH_FOR_EXIT = False
 
     @property
     def pid(self):
@@ -539,6 +1542,8 @@ class ForkingChildSignalStrategy(SignalStrategy):
 CHILD_COMMS_STRATEGY_NONE = NoCommsStrategy
 CHILD_COMMS_STRATEGY_PIPES_CLOSE = ClosePipesCommsStrategy
 CHILD_COMMS_STRATEGY_PROCESSFAMILY_RPC_PROTOCOL = ProcessFamilyRPCProtocolStrategy
+CHILD_COMMS_STRATEGY_PROCESSFAMILY_BINARY_RPC_PROTOCOL = ProcessFamilyBinaryRPCProtocolStrategy
+CHILD_COMMS_STRATEGY_PROCESSFAMILY_UNIX_SOCKET_RPC_PROTOCOL = ProcessFamilyUnixSocketRPCProtocolStrategy
 CHILD_COMMS_STRATEGY_SIGNAL = SignalStrategy
 
 class ProcessFamily(object):
@@ -555,6 +1560,32 @@ class ProcessFamily(object):
     LINUX_USE_PDEATHSIG = True
     NEW_PROCESS_GROUP = True
     CHILD_COMMS_STRATEGY = CHILD_COMMS_STRATEGY_PROCESSFAMILY_RPC_PROTOCOL
+    SHARED_MEMORY_THRESHOLD = None  # If set, bytes-like objects (and numpy arrays) of at least this many bytes in RPC params and results are passed in shared memory, rather than over the comms channel (not on Windows)
+    SHARED_MEMORY_POOL_SIZE = 256 * 1024 * 1024  # Bytes of free shared memory segments kept for reuse by the pools for each child (one in this process, and one in the child)
+    BINARY_RPC_SERIALIZER = "pickle"  # The serializer for CHILD_COMMS_STRATEGY_PROCESSFAMILY_BINARY_RPC_PROTOCOL: "pickle" or "msgpack" (if installed)
+    SPAWN_WORKERS = 1  # The number of threads used to launch child processes; more than 1 launches them concurrently
+    LINUX_USE_FORK_SERVER = False  # Fork children from a template process that has already imported the child module
+    USE_IO_MULTIPLEXER = False  # Read the output of all children from a single selector thread, rather than a thread per stream (not on Windows)
+    LINUX_USE_PREEXEC_FN = True  # If False, the process group and pdeathsig are set without a preexec_fn, so that subprocess can use vfork
+    EVENT_DRIVEN_EXIT_DETECTION = True  # Detect child exits with a pidfd (or SIGCHLD) rather than by polling (not on Windows)
+    SUPERVISE_CHILDREN = False  # Restart children that exit unexpectedly, with the same child index
+    RESTART_BACKOFF_INITIAL = 1.0  # Seconds to wait before restarting a child; doubled for each recent restart of it
+    RESTART_BACKOFF_MAX = 60.0
+    RESTART_TIMEOUT = 30  # Seconds to wait for a restarted child to start
+    CRASH_LOOP_MAX_RESTARTS = 5  # A child that needs this many restarts within CRASH_LOOP_WINDOW is not restarted again
+    CRASH_LOOP_WINDOW = 300.0
+    NUMBER_OF_SPARE_CHILDREN = 0  # Started children kept idle, to take the place of any child that exits
+    RECYCLE_MEMORY_LIMIT = None  # Bytes of memory (PSS where available, otherwise RSS) above which a child is replaced
+    RECYCLE_CALL_LIMIT = None  # Number of RPC calls after which a child is replaced
+    RECYCLE_CHECK_INTERVAL = 30.0
+    RECYCLE_TIMEOUT = 30  # Seconds to wait for a child that is being recycled to stop, and for its replacement to start
+    RPC_BATCH_INTERVAL = None  # If set, RPC calls are queued for up to this many seconds and written to each child together, as a JSON-RPC batch
+    RPC_BATCH_MAX_SIZE = 100  # A batch of queued calls is written as soon as it has this many calls
+    HEARTBEAT_INTERVAL = None  # If set, each child is pinged this often (in seconds) once started (with CHILD_COMMS_STRATEGY_PROCESSFAMILY_RPC_PROTOCOL)
+    HEARTBEAT_TIMEOUT = 5.0  # Seconds after which a heartbeat with no response is missed
+    HEARTBEAT_MAX_MISSED = 3  # A child is unhealthy after missing this many heartbeats in a row, until it responds to one again
+    HEARTBEAT_LATENCY_SAMPLES = 100  # The number of recent heartbeat round trip times kept for each child's latency percentiles
+    LIFECYCLE_EVENT_HISTORY = 10000  # The number of recent child lifecycle events kept (see get_lifecycle_events)
 
     def __init__(self, child_process_module_name=None, number_of_child_processes=None, run_as_script=True):
         self.child_process_module_name = child_process_module_name
@@ -573,6 +1604,33 @@ class ProcessFamily(object):
 
         self.child_processes = []
         self._child_process_group_id = None
+        self._fork_server = None
+        self._rpc_deadlines = None
+        self._rpc_deadlines_lock = threading.Lock()
+        self._io_multiplexer = None
+        self._exit_watcher = None
+        self._spawn_pool = None
+        self._child_exit_condition = threading.Condition()
+        self._stopping = False
+        self._supervisor_lock = threading.Lock()
+        self._restart_times = {}
+        self.restart_counts = {}
+        self.crash_looping_children = set()
+        self.spare_children = []
+        self._next_child_index = self.number_of_child_processes
+        self._retiring_children = set()
+        self._stopping_event = threading.Event()
+        self._batch_flush_lock = threading.Lock()
+        self._batch_flush_event = threading.Event()
+        self._batch_flush_children = set()
+        self._batch_flush_thread = None
+        self.recycle_counts = {}
+        self._metrics_lock = threading.Lock()
+        self._metrics_collector = None
+        self.start_duration = None  # Seconds that start() took
+        self._lifecycle_events = collections.deque(maxlen=self.LIFECYCLE_EVENT_HISTORY)
+        self._lifecycle_callbacks = []
+        self.stop_duration = None  # Seconds that stop() took (if it waited for the children)
 
     def get_child_process_cmd(self, child_number):
         """
@@ -601,6 +1659,17 @@ class ProcessFamily(object):
         """
         pass
 
+    def handle_child_notification(self, child_index, method, params):
+        """
+        Called with the JSON-RPC notifications sent by a child (with CHILD_COMMS_STRATEGY_PROCESSFAMILY_RPC_PROTOCOL),
+        e.g. "stall" from its watchdog. This is called from the thread reading the child's output, so must not block.
+        """
+        if method == "stall":
+            logger.warning("%s stalled for %.3fs. Thread stacks:\n%s", self.get_child_name(child_index), params["latency"],
+                           "\n".join("%s:\n%s" % (t["thread"], t["stack"]) for t in params["threads"]))
+        else:
+            logger.warning("Unknown notification %r from %s", method, self.get_child_name(child_index))
+
     def _add_to_job_object(self):
         global _global_process_job_handle
         if _global_process_job_handle is not None:
@@ -646,6 +1715,17 @@ class ProcessFamily(object):
                 if self.NEW_PROCESS_GROUP:
                     kwargs['creationflags'] = subprocess.CREATE_NEW_PROCESS_GROUP
             return kwargs
+        elif self._fork_server is not None:
+            #The fork server cannot run pre_exec_fn, as it is not a fork of this process - it does the same itself
+            kwargs['new_process_group'] = self.NEW_PROCESS_GROUP
+            kwargs['pdeathsig'] = self.get_pdeath_sig() if self.LINUX_USE_PDEATHSIG else 0
+            return kwargs
+        elif not self.LINUX_USE_PREEXEC_FN:
+            #Running python code in the forked child would force subprocess to copy this whole process with fork();
+            #the process group is set by subprocess itself where supported, and otherwise by the launch shim
+            if self.NEW_PROCESS_GROUP and _POPEN_SUPPORTS_PROCESS_GROUP:
+                kwargs['process_group'] = 0
+            return kwargs
         else:
             kwargs['preexec_fn'] = functools.partial(self.pre_exec_fn, i)
             return kwargs
@@ -658,9 +1738,42 @@ class ProcessFamily(object):
             else:
                 logger.debug("Using ProcThreadAttributeHandleListPopen")
                 return win32Popen.ProcThreadAttributeHandleListPopen
+        elif self._fork_server is not None:
+            return self._fork_server.popen
         else:
             return subprocess.Popen
 
+    def _start_fork_server(self, timeout):
+        """Starts the fork server used to launch children. Falls back to launching children normally on failure"""
+        from processfamily.forkserver import ForkServer
+        fork_server = ForkServer(
+            [self.child_process_module_name],
+            executable=self.get_sys_executable(),
+            new_process_group=self.NEW_PROCESS_GROUP,
+            pdeathsig=self.get_pdeath_sig() if self.LINUX_USE_PDEATHSIG else 0)
+        try:
+            fork_server.start(timeout)
+        except Exception as e:
+            logger.error("Unable to start fork server; child processes will be launched normally: %s", e)
+            return
+        self._fork_server = fork_server
+
+    def _stop_fork_server(self):
+        if self._fork_server is not None:
+            self._fork_server.stop()
+            self._fork_server = None
+
+    def get_launch_cmd(self, i, cmd):
+        """Returns the command line used to launch the given child command. Unless a preexec_fn is used, this
+        wraps the command in the launch shim, which sets up the process group and pdeathsig instead"""
+        if sys.platform.startswith('win') or self.LINUX_USE_PREEXEC_FN or self._fork_server is not None:
+            return cmd
+        setpgrp = self.NEW_PROCESS_GROUP and not _POPEN_SUPPORTS_PROCESS_GROUP
+        pdeathsig = self.get_pdeath_sig() if self.LINUX_USE_PDEATHSIG else 0
+        if not setpgrp and not pdeathsig:
+            return cmd
+        return get_shim_cmd(cmd, self.get_sys_executable(), setpgrp=setpgrp, pdeathsig=pdeathsig)
+
     def pre_exec_fn(self, i):
         #This is called after fork(), but before exec()
         #Assign this new process to a new group
@@ -695,23 +1808,14 @@ class ProcessFamily(object):
         if sys.platform.startswith('win') and self.WIN_USE_JOB_OBJECT:
             self._add_to_job_object()
 
-        self.child_processes = []
-        for i in range(self.number_of_child_processes):
-            logger.info("Starting %s", self.get_child_name(i))
-            cmd = self.get_child_process_cmd(i)
-            logger.debug("Commandline for %s: %s", self.get_child_name(i), json.dumps(cmd))
-            p = self.get_Popen_class()(cmd, **self.get_Popen_kwargs(i, close_fds=self.CLOSE_FDS))
-
-            if p.poll() is None:
-                try:
-                    if self.CPU_AFFINITY_STRATEGY in [CPU_AFFINITY_STRATEGY_CHILDREN_ONLY, CPU_AFFINITY_STRATEGY_PARENT_INCLUDED]:
-                        self.set_child_affinity_mask(p.pid, i)
-                    elif self.CPU_AFFINITY_STRATEGY == CPU_AFFINITY_STRATEGY_NONE:
-                        self.allow_child_to_float(p.pid)
-                except Exception as e:
-                    logger.error("Unable to set affinity for %s process %d: %s", self.get_child_name(i), p.pid, e)
+        if self.LINUX_USE_FORK_SERVER and not sys.platform.startswith('win'):
+            self._start_fork_server(timeout)
 
-            self.child_processes.append(self.CHILD_COMMS_STRATEGY(p, self.ECHO_STD_ERR, i, self))
+        self.child_processes = []
+        self._spawn_children(list(range(self.number_of_child_processes)), self.child_processes)
+        spare_indexes = list(range(self._next_child_index, self._next_child_index + self.NUMBER_OF_SPARE_CHILDREN))
+        self._next_child_index += self.NUMBER_OF_SPARE_CHILDREN
+        self._spawn_children(spare_indexes, self.spare_children)
 
         if sys.platform.startswith('win') and self.WIN_PASS_HANDLES_OVER_COMMANDLINE:
             logger.debug("Waiting for child stream duplication events")
@@ -720,15 +1824,126 @@ class ProcessFamily(object):
 
         self.wait_for_start(timeout - (time.time()-s))
         logger.info("All child processes initialised with strategy %s", self.CHILD_COMMS_STRATEGY.__name__)
+        if self.SUPERVISE_CHILDREN or self.NUMBER_OF_SPARE_CHILDREN:
+            for c in self.child_processes + self.spare_children:
+                c.add_exit_callback(self._handle_child_exit)
+        if self.RECYCLE_MEMORY_LIMIT or self.RECYCLE_CALL_LIMIT:
+            t = threading.Thread(target=self._recycler_thread_target, name="pf_recycler")
+            t.daemon = True
+            t.start()
+        if self.HEARTBEAT_INTERVAL:
+            t = threading.Thread(target=self._heartbeat_thread_target, name="pf_heartbeat")
+            t.daemon = True
+            t.start()
+        self.start_duration = time.time() - s
+
+    def _launch_child_process(self, i):
+        """Launches the child process with the given index, sets its affinity and returns the Popen instance"""
+        logger.info("Starting %s", self.get_child_name(i))
+        self._record_lifecycle_event(tracing.SPAWN_REQUESTED, i)
+        cmd = self.get_launch_cmd(i, self.get_child_process_cmd(i))
+        logger.debug("Commandline for %s: %s", self.get_child_name(i), json.dumps(cmd))
+        kwargs = self.get_Popen_kwargs(i, close_fds=self.CLOSE_FDS)
+        env_vars = {}
+        if self.SHARED_MEMORY_THRESHOLD:
+            env_vars[shm.THRESHOLD_ENV_VAR] = str(int(self.SHARED_MEMORY_THRESHOLD))
+            env_vars[shm.POOL_SIZE_ENV_VAR] = str(int(self.SHARED_MEMORY_POOL_SIZE))
+        if not self.CHILD_COMMS_STRATEGY.USES_SOCKET:
+            p = self.get_Popen_class()(cmd, **self._add_child_env_vars(kwargs, env_vars))
+        else:
+            parent_socket, child_socket = unixsocket.socketpair()
+            try:
+                kwargs["pass_fds"] = list(kwargs.get("pass_fds", ())) + [child_socket.fileno()]
+                env_vars[unixsocket.SOCKET_FD_ENV_VAR] = str(child_socket.fileno())
+                p = self.get_Popen_class()(cmd, **self._add_child_env_vars(kwargs, env_vars))
+            except Exception:
+                parent_socket.close()
+                raise
+            finally:
+                child_socket.close()
+            p.processfamily_socket = parent_socket
+        self._record_lifecycle_event(tracing.POPEN_RETURNED, i, p.pid)
+
+        if p.poll() is None:
+            self._set_child_affinity(p.pid, i)
+        return p
+
+    def _add_child_env_vars(self, kwargs, env_vars):
+        if env_vars:
+            env = dict(kwargs.get("env") or os.environ)
+            env.update(env_vars)
+            kwargs["env"] = env
+        return kwargs
+
+    def _set_child_affinity(self, pid, i):
+        try:
+            if self.CPU_AFFINITY_STRATEGY in [CPU_AFFINITY_STRATEGY_CHILDREN_ONLY, CPU_AFFINITY_STRATEGY_PARENT_INCLUDED]:
+                self.set_child_affinity_mask(pid, i)
+            elif self.CPU_AFFINITY_STRATEGY == CPU_AFFINITY_STRATEGY_NONE:
+                self.allow_child_to_float(pid)
+            else:
+                return
+            self._record_lifecycle_event(tracing.AFFINITY_SET, i, pid)
+        except Exception as e:
+            logger.error("Unable to set affinity for %s process %d: %s", self.get_child_name(i), pid, e)
+
+    def _spawn_children(self, child_indexes, child_processes):
+        """Launches the children with the given indexes, appending their comms strategies to child_processes in
+        child index order. If SPAWN_WORKERS is more than 1, the processes are launched concurrently by a bounded set
+        of threads, and a ChildSpawnError is raised once all of them have been attempted if any could not be launched"""
+        if self.SPAWN_WORKERS <= 1 or len(child_indexes) <= 1:
+            for i in child_indexes:
+                p = self._launch_child_process(i)
+                child_processes.append(self.CHILD_COMMS_STRATEGY(p, self.ECHO_STD_ERR, i, self))
+            return
+
+        launches = [(i, self._submit_launch_child_process(i)) for i in child_indexes]
+        launched = {}
+        errors = {}
+        for i, launch in launches:
+            try:
+                launched[i] = launch.result()
+            except Exception as e:
+                logger.error("Error starting %s: %s\n%s", self.get_child_name(i), e, _traceback_str())
+                errors[i] = e
+
+        #The comms strategies are created from this thread so that they are always constructed in child index order
+        for i in child_indexes:
+            if i in launched:
+                child_processes.append(self.CHILD_COMMS_STRATEGY(launched[i], self.ECHO_STD_ERR, i, self))
+        if errors:
+            raise ChildSpawnError("Failed to start %s" % ", ".join(self.get_child_name(i) for i in sorted(errors)), errors)
+
+    def _submit_launch_child_process(self, i):
+        """Launches the child with the given index from one of the family's spawn threads, returning a Future for the
+        Popen instance. These threads live as long as the family, because a child's pdeathsig is sent when the thread
+        that launched it exits"""
+        future = Future()
+
+        def launch():
+            if future.set_running_or_notify_cancel():
+                try:
+                    future.set_result(self._launch_child_process(i))
+                except Exception as e:
+                    future.set_exception(e)
+        with self._rpc_deadlines_lock:
+            if self._spawn_pool is None:
+                self._spawn_pool = DispatchPool(max(1, self.SPAWN_WORKERS), 0, name="pf_spawn")
+        self._spawn_pool.submit(launch)
+        return future
 
     def wait_for_start(self, timeout):
         """Waits (a maximum of timeout) until all children of process_family have started"""
-        end_time = time.time() + timeout
+        return self._wait_for_children_to_start(self.child_processes + self.spare_children, time.time() + timeout)
+
+    def _wait_for_children_to_start(self, children, end_time):
         command_processes = []
         try:
-            for child_process in self.child_processes:
+            for child_process in children:
                 command_processes.append(child_process.monitor_child_startup(end_time))
-            for c in command_processes:
+            for child_process, c in zip(children, command_processes):
+                #Recorded first, so that it is always before the response
+                self._record_lifecycle_event(tracing.STARTUP_PING_SENT, child_process.child_index, child_process.pid)
                 # ping the process
                 next(c)
             # results
@@ -745,17 +1960,29 @@ class ProcessFamily(object):
         self.send_stop(clean_timeout)
         if wait:
             remaining_time = timeout - (time.time() - start_time)
-            return self.wait_for_stop_and_then_terminate(timeout=remaining_time)
+            num_terminated = self.wait_for_stop_and_then_terminate(timeout=remaining_time)
+            self.stop_duration = time.time() - start_time
+            return num_terminated
 
     def send_stop(self, timeout):
         """Instructs all process_family children to stop"""
-        end_time = time.time() + timeout
+        self._stopping_event.set()
+        with self._supervisor_lock:
+            self._stopping = True
+            #Spare children are stopped (and waited for) along with the rest
+            self.child_processes.extend(self.spare_children)
+            self.spare_children = []
+        return self._send_stop_to_children(self.child_processes, time.time() + timeout)
+
+    def _send_stop_to_children(self, children, end_time):
         command_processes = []
         try:
-            for child_process in self.child_processes:
-                if not child_process.is_stopped():
-                    command_processes.append(child_process.stop_child(end_time))
-            for c in command_processes:
+            stopping_children = [c for c in children if not c.is_stopped()]
+            for child_process in stopping_children:
+                command_processes.append(child_process.stop_child(end_time))
+            for child_process, c in zip(stopping_children, command_processes):
+                #Recorded first, so that it is always before the response
+                self._record_lifecycle_event(tracing.STOP_SENT, child_process.child_index, child_process.pid)
                 # ping the process
                 next(c)
             # results
@@ -781,22 +2008,461 @@ class ProcessFamily(object):
                     num_terminated += 1
                     if process_exists(p.pid):
                         kill_process(p.pid)
+                        self._record_lifecycle_event(tracing.KILLED, p.child_index, p.pid)
                 except Exception as e:
                     logger.warning("Failed to kill child process %s with PID %s: %s\n%s", p.name, p.pid, e, _traceback_str())
             self._wait_for_children_to_terminate(start_time, timeout)
+        if not self.child_processes:
+            #Children launched by the fork server get their pdeathsig from it, so it must outlive them
+            self._stop_fork_server()
+            with self._metrics_lock:
+                if self._metrics_collector is not None:
+                    self._metrics_collector.close()
+                    self._metrics_collector = None
         return num_terminated
 
-    def _wait_for_children_to_terminate(self, start_time, timeout):
-        first_run = True
-        while self.child_processes and (first_run or time.time() - start_time < timeout):
-            for p in list(self.child_processes):
-                if p.is_stopped():
-                    self.child_processes.remove(p)
-            if first_run:
-                first_run = False
+    def _wait_for_children_to_terminate(self, start_time, timeout, children=None):
+        """Waits until the children have terminated, removing them from the given list (by default, the family's list
+        of children) as they do"""
+        children = self.child_processes if children is None else children
+        with self._child_exit_condition:
+            while True:
+                for p in list(children):
+                    if p.is_stopped():
+                        children.remove(p)
+                        #Its exit may not have been handled yet
+                        p._close_shm_pool()
+                remaining = timeout - (time.time() - start_time)
+                if not children or remaining <= 0:
+                    return
+                if all(p.exit_detection for p in children):
+                    #We are woken by _notify_child_exit, so this timeout is just a safety net
+                    self._child_exit_condition.wait(min(remaining, 1))
+                else:
+                    self._child_exit_condition.wait(min(remaining, 0.1))
+
+    def rolling_restart(self, batch_size=1, timeout=30):
+        """Stops and replaces the children (including any spare children) batch_size at a time, so that at least
+        number_of_child_processes - batch_size of them are running throughout, e.g. to deploy new child code. Each
+        batch is given timeout seconds to stop, after which any remaining are killed, and the same again for the
+        replacements to start. Returns the number of children that had to be killed"""
+        with self._supervisor_lock:
+            if self._stopping:
+                raise Exception("Invalid state: rolling_restart() cannot be called once the family is stopping")
+            children = self.child_processes + self.spare_children
+        num_terminated = 0
+        for n in range(0, len(children), batch_size):
+            num_terminated += self._restart_children(children[n:n + batch_size], timeout)
+        return num_terminated
+
+    def _restart_children(self, children, timeout):
+        """Stops the given children and replaces them with new ones with the same indexes, returning the number that
+        had to be killed"""
+        logger.info("Restarting %s", ", ".join(c.name for c in children))
+        new_children = []
+        try:
+            num_terminated = self._retire_children(children, timeout)
+            self._spawn_children([c.child_index for c in children], new_children)
+            self._wait_for_children_to_start(new_children, time.time() + timeout)
+        finally:
+            new_children_by_index = dict((c.child_index, c) for c in new_children)
+            replacements = {}
+            with self._supervisor_lock:
+                for old_child in children:
+                    new_child = new_children_by_index.get(old_child.child_index)
+                    if new_child is None or self._stopping:
+                        continue
+                    for family_list in (self.child_processes, self.spare_children):
+                        if old_child in family_list:
+                            family_list[family_list.index(old_child)] = new_child
+                            replacements[old_child] = new_child
+                            del new_children_by_index[old_child.child_index]
+                            break
+            for new_child in new_children_by_index.values():
+                #The family started stopping, so this replacement is not needed
+                if process_exists(new_child.pid):
+                    kill_process(new_child.pid)
+            if self.SUPERVISE_CHILDREN or self.NUMBER_OF_SPARE_CHILDREN:
+                for c in children:
+                    if c in replacements:
+                        replacements[c].add_exit_callback(self._handle_child_exit)
+                    else:
+                        #No replacement was started, so it is treated like any other child that has exited
+                        c.add_exit_callback(self._handle_child_exit)
+        return num_terminated
+
+    def _retire_children(self, children, timeout):
+        """Stops the given children, which are not restarted or replaced when they exit, killing any that have not
+        stopped within timeout. Returns the number that had to be killed"""
+        with self._supervisor_lock:
+            self._retiring_children.update(children)
+        try:
+            start_time = time.time()
+            self._send_stop_to_children(children, start_time + timeout - 1)
+            remaining = list(children)
+            if self.CHILD_COMMS_STRATEGY.CAN_WAIT_FOR_TERMINATE:
+                self._wait_for_children_to_terminate(start_time, timeout - 1, remaining)
+            num_terminated = len(remaining)
+            for p in remaining:
+                try:
+                    if process_exists(p.pid):
+                        kill_process(p.pid)
+                        self._record_lifecycle_event(tracing.KILLED, p.child_index, p.pid)
+                except Exception as e:
+                    logger.warning("Failed to kill child process %s with PID %s: %s\n%s", p.name, p.pid, e, _traceback_str())
+            self._wait_for_children_to_terminate(start_time, timeout, remaining)
+            return num_terminated
+        finally:
+            with self._supervisor_lock:
+                self._retiring_children.difference_update(children)
+
+    def scale_to(self, number_of_child_processes, timeout=30):
+        """Starts or stops children so that number_of_child_processes are running. New children are given fresh child
+        indexes (and so affinity slots). When scaling down, the children with the highest indexes are stopped, and
+        killed if they have not stopped within timeout. Returns the number of children that had to be killed"""
+        with self._supervisor_lock:
+            if self._stopping:
+                raise Exception("Invalid state: scale_to() cannot be called once the family is stopping")
+            current_number = len(self.child_processes)
+            self.number_of_child_processes = number_of_child_processes
+            if number_of_child_processes < current_number:
+                retiring = sorted(self.child_processes, key=lambda c: c.child_index)[number_of_child_processes:]
+                for c in retiring:
+                    self.child_processes.remove(c)
+            else:
+                new_indexes = list(range(self._next_child_index,
+                                         self._next_child_index + number_of_child_processes - current_number))
+                self._next_child_index += len(new_indexes)
+        if number_of_child_processes < current_number:
+            logger.info("Scaling down from %d to %d children", current_number, number_of_child_processes)
+            return self._retire_children(retiring, timeout)
+        if not new_indexes:
+            return 0
+        logger.info("Scaling up from %d to %d children", current_number, number_of_child_processes)
+        new_children = []
+        try:
+            self._spawn_children(new_indexes, new_children)
+            self._wait_for_children_to_start(new_children, time.time() + timeout)
+        finally:
+            with self._supervisor_lock:
+                added = not self._stopping
+                if added:
+                    self.child_processes.extend(new_children)
+            for c in new_children:
+                if not added:
+                    #The family started stopping, so these children are not needed
+                    if process_exists(c.pid):
+                        kill_process(c.pid)
+                elif self.SUPERVISE_CHILDREN or self.NUMBER_OF_SPARE_CHILDREN:
+                    c.add_exit_callback(self._handle_child_exit)
+        return 0
+
+    def get_child_memory_info(self):
+        """Returns a dict mapping the index of each running child to a dict with its "rss" and "pss" in bytes
+        (see processes.get_process_memory_info)"""
+        memory_info = {}
+        for c in list(self.child_processes):
+            try:
+                memory_info[c.child_index] = get_process_memory_info(c.pid)
+            except Exception as e:
+                logger.debug("Could not get memory information for %s: %s", c.name, e)
+        return memory_info
+
+    def get_child_metrics(self):
+        """Returns a dict of child index to the current resource usage of that child: "cpu_percent" (since the
+        previous call), "rss" (in bytes), "threads", "fds", "voluntary_ctxt_switches", "nonvoluntary_ctxt_switches",
+        and "read_bytes" and "write_bytes" with their rates since the previous call (Linux only)"""
+        if not sys.platform.startswith('linux'):
+            raise NotImplementedError("Child metrics are only available on Linux")
+        with self._metrics_lock:
+            if self._metrics_collector is None:
+                self._metrics_collector = ChildMetricsCollector(self)
+            return self._metrics_collector.sample()
+
+    def get_children_to_recycle(self):
+        """Returns the children that have exceeded RECYCLE_MEMORY_LIMIT or RECYCLE_CALL_LIMIT"""
+        memory_info = self.get_child_memory_info() if self.RECYCLE_MEMORY_LIMIT else {}
+        children = []
+        for c in list(self.child_processes):
+            if c.is_stopped():
+                continue
+            if self.RECYCLE_CALL_LIMIT and c.call_count >= self.RECYCLE_CALL_LIMIT:
+                logger.info("%s has handled %d calls: recycling it", c.name, c.call_count)
+                children.append(c)
+            elif c.child_index in memory_info:
+                memory = memory_info[c.child_index]["pss"] or memory_info[c.child_index]["rss"]
+                if memory > self.RECYCLE_MEMORY_LIMIT:
+                    logger.info("%s is using %d bytes of memory: recycling it", c.name, memory)
+                    children.append(c)
+        return children
+
+    def _recycler_thread_target(self):
+        while not self._stopping_event.wait(self.RECYCLE_CHECK_INTERVAL):
+            try:
+                #Children are replaced one at a time, so that at most one child's worth of capacity is lost
+                for c in self.get_children_to_recycle():
+                    if self._stopping:
+                        break
+                    self.recycle_counts[c.child_index] = self.recycle_counts.get(c.child_index, 0) + 1
+                    self._restart_children([c], self.RECYCLE_TIMEOUT)
+            except Exception as e:
+                logger.error("Error recycling children: %s\n%s", e, _traceback_str())
+
+    def add_lifecycle_callback(self, callback):
+        """Calls callback(event) with a tracing.LifecycleEvent for every lifecycle event of every child (e.g. spawn
+        requested, ready, stop sent, exited). This is called from whichever thread the event happens on, so must not
+        block"""
+        self._lifecycle_callbacks.append(callback)
+
+    def get_lifecycle_events(self):
+        """Returns the most recent LIFECYCLE_EVENT_HISTORY lifecycle events of the children, oldest first"""
+        return list(self._lifecycle_events)
+
+    def write_chrome_trace(self, path):
+        """Writes the recent lifecycle events to path as a Chrome trace event JSON timeline"""
+        tracing.write_chrome_trace(self.get_lifecycle_events(), path)
+
+    def _record_lifecycle_event(self, name, child_index, pid=None):
+        event = tracing.LifecycleEvent(name, child_index, self.get_child_name(child_index), pid, time.time())
+        self._lifecycle_events.append(event)
+        for callback in list(self._lifecycle_callbacks):
+            try:
+                callback(event)
+            except Exception as e:
+                logger.error("Error in lifecycle callback for %r: %s\n%s", event, e, _traceback_str())
+
+    def get_child_health(self):
+        """Returns a dict of child index to the health of that child (see ChildCommsStrategy.get_health), which is
+        only tracked if HEARTBEAT_INTERVAL is set. This can be used to send work to the healthiest children"""
+        return dict((c.child_index, c.get_health()) for c in list(self.child_processes))
+
+    def handle_child_health_change(self, child_index, healthy):
+        """
+        Called when a child becomes unhealthy (by missing HEARTBEAT_MAX_MISSED heartbeats in a row) or healthy again.
+        This is called from a background thread, so must not block.
+        """
+
+    def _handle_child_health_change(self, child):
+        if child.healthy:
+            logger.info("%s is responding to heartbeats again", child.name)
+        else:
+            logger.warning("%s is unhealthy: it has missed %d heartbeats", child.name, child.missed_heartbeats)
+        try:
+            self.handle_child_health_change(child.child_index, child.healthy)
+        except Exception as e:
+            logger.error("Error handling health change of %s: %s\n%s", child.name, e, _traceback_str())
+
+    def _heartbeat_thread_target(self):
+        while not self._stopping_event.wait(self.HEARTBEAT_INTERVAL):
+            for c in list(self.child_processes) + list(self.spare_children):
+                try:
+                    c.send_heartbeat(self.HEARTBEAT_TIMEOUT)
+                except Exception as e:
+                    logger.error("Error sending heartbeat to %s: %s\n%s", c.name, e, _traceback_str())
+
+    def _handle_child_exit(self, child):
+        """Replaces a child that has exited, by promoting a spare child if one is ready, or by restarting it if
+        SUPERVISE_CHILDREN is set. Nothing is done while the family is stopping, or for a child that is restarting too
+        often"""
+        i = child.child_index
+        with self._supervisor_lock:
+            if self._stopping or child in self._retiring_children:
+                return
+            if child in self.spare_children:
+                self.spare_children.remove(child)
+                logger.warning("Spare %s exited unexpectedly: starting another in %.1f seconds",
+                               child.name, self.RESTART_BACKOFF_INITIAL)
+                self._get_rpc_deadlines().schedule(time.time() + self.RESTART_BACKOFF_INITIAL,
+                                                   self._start_spare_child_thread)
+                return
+            if child not in self.child_processes:
+                return
+            now = time.time()
+            recent_restarts = [t for t in self._restart_times.get(i, []) if now - t < self.CRASH_LOOP_WINDOW]
+            self._restart_times[i] = recent_restarts
+            if len(recent_restarts) >= self.CRASH_LOOP_MAX_RESTARTS:
+                self.crash_looping_children.add(i)
+                logger.error("%s has been restarted %d times in %d seconds: it will not be restarted again",
+                             child.name, len(recent_restarts), self.CRASH_LOOP_WINDOW)
+                return
+            spare = self.spare_children.pop(0) if self.spare_children else None
+            if spare is not None:
+                recent_restarts.append(now)
+                self.restart_counts[i] = self.restart_counts.get(i, 0) + 1
+                logger.warning("%s exited unexpectedly: replacing it with spare %s", child.name, spare.name)
+                spare.child_index = i
+                spare.name = self.get_child_name(i)
+                self.child_processes[self.child_processes.index(child)] = spare
+            elif not self.SUPERVISE_CHILDREN:
+                logger.warning("%s exited unexpectedly, and there is no spare child to replace it", child.name)
+                return
             else:
-                time.sleep(0.1)
+                delay = min(self.RESTART_BACKOFF_INITIAL * 2 ** len(recent_restarts), self.RESTART_BACKOFF_MAX)
+        if spare is not None:
+            self._set_child_affinity(spare.pid, i)
+            self._start_spare_child_thread()
+            return
+        logger.warning("%s exited unexpectedly: restarting it in %.1f seconds", child.name, delay)
+        self._get_rpc_deadlines().schedule(now + delay, functools.partial(self._start_restart_thread, child))
+
+    def _start_restart_thread(self, child):
+        #Launching and waiting for startup must not hold up the deadline scheduler thread
+        t = threading.Thread(target=self._replace_child, args=(child,), name="pf_restart_%d" % child.child_index)
+        t.daemon = True
+        t.start()
+
+    def _replace_child(self, child):
+        """Launches a new child with the same index as the given one, which has exited, and puts it in its place"""
+        i = child.child_index
+        with self._supervisor_lock:
+            if self._stopping or child not in self.child_processes:
+                return
+            self._restart_times.setdefault(i, []).append(time.time())
+            self.restart_counts[i] = self.restart_counts.get(i, 0) + 1
+        try:
+            new_child = self._start_child(i, self.RESTART_TIMEOUT)
+        except Exception as e:
+            logger.error("Error restarting %s: %s\n%s", self.get_child_name(i), e, _traceback_str())
+            self._handle_child_exit(child)
+            return
+        with self._supervisor_lock:
+            replaced = not self._stopping and child in self.child_processes
+            if replaced:
+                self.child_processes[self.child_processes.index(child)] = new_child
+        if not replaced:
+            logger.info("Stopping restarted %s as the family is stopping", new_child.name)
+            if process_exists(new_child.pid):
+                kill_process(new_child.pid)
+            return
+        logger.info("Restarted %s (restart count: %d)", new_child.name, self.restart_counts[i])
+        new_child.add_exit_callback(self._handle_child_exit)
+
+    def _start_spare_child_thread(self):
+        t = threading.Thread(target=self._add_spare_child, name="pf_add_spare")
+        t.daemon = True
+        t.start()
+
+    def _add_spare_child(self):
+        """Starts a new spare child, with a fresh child index"""
+        with self._supervisor_lock:
+            if self._stopping:
+                return
+            i = self._next_child_index
+            self._next_child_index += 1
+        try:
+            spare = self._start_child(i, self.RESTART_TIMEOUT)
+        except Exception as e:
+            logger.error("Error starting spare %s: %s\n%s", self.get_child_name(i), e, _traceback_str())
+            self._get_rpc_deadlines().schedule(time.time() + self.RESTART_BACKOFF_MAX, self._start_spare_child_thread)
+            return
+        with self._supervisor_lock:
+            added = not self._stopping
+            if added:
+                self.spare_children.append(spare)
+        if not added:
+            logger.info("Stopping spare %s as the family is stopping", spare.name)
+            if process_exists(spare.pid):
+                kill_process(spare.pid)
+            return
+        logger.info("Started spare %s", spare.name)
+        spare.add_exit_callback(self._handle_child_exit)
+
+    def _start_child(self, i, timeout):
+        """Launches the child with the given index from a spawn thread, and waits for it to start. Returns its comms
+        strategy"""
+        p = self._submit_launch_child_process(i).result()
+        child = self.CHILD_COMMS_STRATEGY(p, self.ECHO_STD_ERR, i, self)
+        startup = child.monitor_child_startup(time.time() + timeout)
+        try:
+            self._record_lifecycle_event(tracing.STARTUP_PING_SENT, i, child.pid)
+            next(startup)
+            next(startup)
+        except Exception:
+            if process_exists(child.pid):
+                kill_process(child.pid)
+            raise
+        finally:
+            startup.close()
+        return child
+
+    def _notify_child_exit(self):
+        with self._child_exit_condition:
+            self._child_exit_condition.notify_all()
+
+    def add_child_exit_callback(self, child_index, callback):
+        """Calls callback(child_comms_strategy) when the running child with the given index exits; see
+        ChildCommsStrategy.add_exit_callback"""
+        self.get_child(child_index).add_exit_callback(callback)
+
+
+    def get_child(self, child_index):
+        """Returns the comms strategy instance for the running child with the given index"""
+        for child_process in list(self.child_processes):
+            if child_process.child_index == child_index:
+                return child_process
+        raise ValueError("There is no running child with index %r" % (child_index,))
+
+    def call(self, child_index, method, params=None, timeout=None):
+        """Calls an RPC method (registered by ChildProcess.register_rpc_methods) on the given child. params can be
+        a list or dict. Returns a concurrent.futures.Future for the result; see ProcessFamilyRPCProtocolStrategy.call"""
+        return self.get_child(child_index).call(method, params=params, timeout=timeout)
+
+    def call_batch(self, child_index, calls, timeout=None):
+        """Calls several RPC methods on the given child with a single write, given a list of (method, params).
+        Returns a list of concurrent.futures.Future for the results"""
+        return self.get_child(child_index).call_batch(calls, timeout=timeout)
+
+    def call_with_fds(self, child_index, method, params=None, fds=(), timeout=None):
+        """Calls an RPC method on the given child, passing it copies of the given file descriptors (with
+        CHILD_COMMS_STRATEGY_PROCESSFAMILY_UNIX_SOCKET_RPC_PROTOCOL); see ProcessFamilyUnixSocketRPCProtocolStrategy.call_with_fds"""
+        return self.get_child(child_index).call_with_fds(method, params=params, fds=fds, timeout=timeout)
+
+    def _schedule_batch_flush(self, child):
+        with self._batch_flush_lock:
+            self._batch_flush_children.add(child)
+            if self._batch_flush_thread is None:
+                self._batch_flush_thread = threading.Thread(target=self._batch_flush_thread_target, name="pf_rpc_batcher")
+                self._batch_flush_thread.daemon = True
+                self._batch_flush_thread.start()
+        self._batch_flush_event.set()
+
+    def _batch_flush_thread_target(self):
+        while True:
+            self._batch_flush_event.wait()
+            time.sleep(self.RPC_BATCH_INTERVAL)
+            self._batch_flush_event.clear()
+            with self._batch_flush_lock:
+                children, self._batch_flush_children = self._batch_flush_children, set()
+            for c in children:
+                try:
+                    c.flush_batch()
+                except Exception as e:
+                    logger.error("Error writing batched calls to %s: %s\n%s", c.name, e, _traceback_str())
 
+    def _get_io_multiplexer(self):
+        """Returns the I/O multiplexer used to read child output streams, or None if they are read by threads"""
+        if not self.USE_IO_MULTIPLEXER or sys.platform.startswith('win'):
+            return None
+        with self._rpc_deadlines_lock:
+            if self._io_multiplexer is None:
+                self._io_multiplexer = IOMultiplexer()
+            return self._io_multiplexer
+
+    def _get_exit_watcher(self):
+        """Returns the watcher used to detect child exits, or None if they are detected by polling"""
+        if not self.EVENT_DRIVEN_EXIT_DETECTION or sys.platform.startswith('win'):
+            return None
+        io_multiplexer = self._get_io_multiplexer()
+        with self._rpc_deadlines_lock:
+            if self._exit_watcher is None:
+                self._exit_watcher = ExitWatcher(io_multiplexer or IOMultiplexer(name="pf_exit_watch"))
+            return self._exit_watcher
+
+    def _get_rpc_deadlines(self):
+        with self._rpc_deadlines_lock:
+            if self._rpc_deadlines is None:
+                self._rpc_deadlines = DeadlineScheduler()
+            return self._rpc_deadlines
 
     def _find_module_filename(self, modulename):
         """finds the filename of the module with the given name (supports submodules)"""
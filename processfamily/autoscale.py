@@ -0,0 +1,129 @@
+# -*- coding: utf-8 -*-
+"""Scaling the number of children in a ProcessFamily up and down with their load"""
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+from __future__ import unicode_literals
+from future import standard_library
+standard_library.install_aliases()
+from builtins import *
+from builtins import object
+__author__ = 'matth'
+
+import logging
+import threading
+import time
+import traceback
+
+from processfamily.processes import get_process_cpu_time
+
+logger = logging.getLogger("processfamily.autoscale")
+
+
+def _traceback_str():
+    return traceback.format_exc()
+
+
+class CPUUtilisationMetric(object):
+    """
+    A load metric: the average fraction of a CPU used by each child since the previous sample
+    """
+
+    def __init__(self):
+        self._last_samples = {}
+
+    def __call__(self, process_family):
+        now = time.time()
+        samples = {}
+        utilisations = []
+        for c in list(process_family.child_processes):
+            try:
+                cpu_time = get_process_cpu_time(c.pid)
+            except Exception as e:
+                logger.debug("Could not get the CPU time for %s: %s", c.name, e)
+                continue
+            samples[c.pid] = (now, cpu_time)
+            last_sample = self._last_samples.get(c.pid)
+            if last_sample is not None and now > last_sample[0]:
+                utilisations.append((cpu_time - last_sample[1]) / (now - last_sample[0]))
+        self._last_samples = samples
+        return sum(utilisations) / len(utilisations) if utilisations else None
+
+
+def pending_calls_metric(process_family):
+    """A load metric: the average number of RPC calls each child has not yet answered"""
+    counts = [c.pending_call_count for c in list(process_family.child_processes)]
+    return sum(counts) / float(len(counts)) if counts else None
+
+
+class Autoscaler(object):
+    """
+    Periodically calls ProcessFamily.scale_to to keep the load on its children between two thresholds. The metric is
+    a callable that returns the load for a family (or None if it is unknown), e.g. a CPUUtilisationMetric (the default)
+    or pending_calls_metric. One child is added when the load is above scale_up_threshold; one is removed when it has
+    been below scale_down_threshold for scale_down_checks checks in a row.
+    """
+
+    def __init__(self, process_family, min_children, max_children, metric=None, scale_up_threshold=0.75,
+                 scale_down_threshold=0.25, interval=10.0, scale_down_checks=3, scale_timeout=30):
+        self.process_family = process_family
+        self.min_children = min_children
+        self.max_children = max_children
+        self.metric = metric or CPUUtilisationMetric()
+        self.scale_up_threshold = scale_up_threshold
+        self.scale_down_threshold = scale_down_threshold
+        self.interval = interval
+        self.scale_down_checks = scale_down_checks
+        self.scale_timeout = scale_timeout
+        self._low_load_checks = 0
+        self._stop_event = threading.Event()
+        self._thread = None
+
+    def start(self):
+        self._stop_event.clear()
+        self._thread = threading.Thread(target=self._thread_target, name="pf_autoscaler")
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self):
+        self._stop_event.set()
+        if self._thread is not None and self._thread is not threading.current_thread():
+            self._thread.join()
+        self._thread = None
+
+    def check(self):
+        """Samples the load and scales the family if necessary. Returns the new number of children if it was scaled"""
+        if self.process_family._stopping:
+            return None
+        load = self.metric(self.process_family)
+        if load is None:
+            return None
+        number_of_children = len(self.process_family.child_processes)
+        target = None
+        if load > self.scale_up_threshold:
+            self._low_load_checks = 0
+            if number_of_children < self.max_children:
+                target = number_of_children + 1
+        elif load < self.scale_down_threshold:
+            self._low_load_checks += 1
+            if self._low_load_checks >= self.scale_down_checks and number_of_children > self.min_children:
+                self._low_load_checks = 0
+                target = number_of_children - 1
+        else:
+            self._low_load_checks = 0
+        if number_of_children < self.min_children:
+            target = self.min_children
+        elif number_of_children > self.max_children:
+            target = self.max_children
+        if target is None:
+            return None
+        logger.info("Load is %.2f: scaling from %d to %d children", load, number_of_children, target)
+        self.process_family.scale_to(target, timeout=self.scale_timeout)
+        return target
+
+    def _thread_target(self):
+        while not self._stop_event.wait(self.interval):
+            try:
+                self.check()
+            except Exception as e:
+                logger.error("Error autoscaling: %s\n%s", e, _traceback_str())
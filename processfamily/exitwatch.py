@@ -0,0 +1,122 @@
+# -*- coding: utf-8 -*-
+"""Event driven detection of child process exit (not on Windows)"""
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+from __future__ import unicode_literals
+from future import standard_library
+standard_library.install_aliases()
+from builtins import *
+from builtins import object
+__author__ = 'matth'
+
+import errno
+import logging
+import os
+import signal
+import threading
+import traceback
+
+logger = logging.getLogger("processfamily.exitwatch")
+
+EXIT_DETECTION_PIDFD = "pidfd"
+EXIT_DETECTION_SIGCHLD = "sigchld"
+EXIT_DETECTION_FORK_SERVER = "fork_server"
+
+
+def _traceback_str():
+    return traceback.format_exc()
+
+
+class ExitWatcher(object):
+    """
+    Calls a callback when a child process exits, without polling. A pidfd (Linux 5.3+, Python 3.9+) is registered with
+    an IOMultiplexer for each process; where that is not available, a SIGCHLD handler wakes the multiplexer to poll the
+    watched processes. The SIGCHLD handler is only installed from the main thread, and only if no other handler is set.
+    Callbacks run on the multiplexer thread, so they must not block.
+    """
+
+    def __init__(self, multiplexer):
+        self.multiplexer = multiplexer
+        self._lock = threading.Lock()
+        self._sigchld_popens = {}
+        self._sigchld_wakeup_w = None
+        self._sigchld_installed = None
+
+    def watch(self, popen, callback):
+        """Arranges for callback() to be called once popen has exited and has a returncode. Returns the exit
+        detection mechanism used, or None if the exit of this process can only be detected by polling"""
+        if hasattr(popen, "add_exit_callback"):
+            #Children of a fork server have their exit reported by it
+            popen.add_exit_callback(callback)
+            return EXIT_DETECTION_FORK_SERVER
+        if hasattr(os, "pidfd_open"):
+            try:
+                pidfd = os.pidfd_open(popen.pid)
+            except OSError as e:
+                if e.errno != errno.ESRCH:
+                    logger.debug("pidfd_open is not available (%s): falling back to SIGCHLD", e)
+                else:
+                    #It has already been reaped
+                    popen.poll()
+                    callback()
+                    return EXIT_DETECTION_PIDFD
+            else:
+                self.multiplexer.register(pidfd, lambda: self._handle_pidfd_readable(pidfd, popen, callback))
+                return EXIT_DETECTION_PIDFD
+        if self._install_sigchld_handler():
+            with self._lock:
+                self._sigchld_popens[popen] = callback
+            #In case it exited before it was added
+            self._sigchld_handler(signal.SIGCHLD, None)
+            return EXIT_DETECTION_SIGCHLD
+        return None
+
+    def _handle_pidfd_readable(self, pidfd, popen, callback):
+        self.multiplexer.unregister(pidfd)
+        os.close(pidfd)
+        popen.poll()
+        callback()
+
+    def _install_sigchld_handler(self):
+        with self._lock:
+            if self._sigchld_installed is None:
+                self._sigchld_installed = False
+                try:
+                    if threading.current_thread() is threading.main_thread() and \
+                            signal.getsignal(signal.SIGCHLD) == signal.SIG_DFL:
+                        wakeup_r, self._sigchld_wakeup_w = os.pipe()
+                        os.set_blocking(wakeup_r, False)
+                        os.set_blocking(self._sigchld_wakeup_w, False)
+                        self.multiplexer.register(wakeup_r, lambda: self._handle_sigchld_wakeup(wakeup_r))
+                        signal.signal(signal.SIGCHLD, self._sigchld_handler)
+                        signal.siginterrupt(signal.SIGCHLD, False)
+                        self._sigchld_installed = True
+                except (ValueError, AttributeError, OSError) as e:
+                    logger.debug("Could not install a SIGCHLD handler: %s", e)
+            return self._sigchld_installed
+
+    def _sigchld_handler(self, signum, frame):
+        #Only async signal safe work is done here; the watched processes are checked on the multiplexer thread
+        try:
+            os.write(self._sigchld_wakeup_w, b'\0')
+        except OSError:
+            pass
+
+    def _handle_sigchld_wakeup(self, wakeup_r):
+        try:
+            while os.read(wakeup_r, 4096):
+                pass
+        except OSError as e:
+            if e.errno not in (errno.EAGAIN, errno.EWOULDBLOCK):
+                raise
+        with self._lock:
+            popens = list(self._sigchld_popens.items())
+        for popen, callback in popens:
+            if popen.poll() is not None:
+                with self._lock:
+                    self._sigchld_popens.pop(popen, None)
+                try:
+                    callback()
+                except Exception as e:
+                    logger.error("Error in exit callback for %r: %s\n%s", popen, e, _traceback_str())
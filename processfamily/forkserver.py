@@ -0,0 +1,475 @@
+# -*- coding: utf-8 -*-
+"""A fork server (or "zygote") for launching child processes on Linux.
+
+The fork server is a template python process that imports the child process module once, and then forks a new child
+process from itself for each launch request. The forked children skip interpreter startup and the import of the child
+module's dependencies, and share the memory of the template copy-on-write.
+
+Launch requests and the stdio file descriptors for each child are passed to the server over a unix socket. The server
+reaps its children and reports their exit codes back, so that ForkServerPopen can behave like subprocess.Popen even
+though the children are not children of the calling process.
+
+The template process must remain single threaded, so modules that are preloaded should not start threads on import."""
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+from __future__ import unicode_literals
+from future import standard_library
+standard_library.install_aliases()
+from builtins import str
+from builtins import *
+from builtins import object
+__author__ = 'matth'
+
+import array
+import errno
+import importlib
+import json
+import logging
+import os
+import select
+import signal
+import socket
+import subprocess
+import sys
+import threading
+import time
+import traceback
+
+from processfamily.launcher import split_python_cmd, run_python_main
+from processfamily.processes import process_exists
+
+logger = logging.getLogger("processfamily.forkserver")
+
+_MAX_MESSAGE_SIZE = 1 << 20
+_MAX_FDS = 64
+
+# The return code reported for a child whose exit status was lost along with the fork server
+UNKNOWN_RETURNCODE = 255
+
+
+class ForkServerError(Exception):
+    pass
+
+
+def send_message(sock, message, fds=()):
+    """Sends a json message (and optionally some file descriptors) as a single packet on a SOCK_SEQPACKET socket"""
+    data = json.dumps(message).encode('utf-8')
+    if fds:
+        sock.sendmsg([data], [(socket.SOL_SOCKET, socket.SCM_RIGHTS, array.array('i', fds))])
+    else:
+        sock.sendall(data)
+
+
+def recv_message(sock):
+    """Receives a json message sent with send_message. Returns (message, fds), or (None, []) at the end of the stream"""
+    fds = array.array('i')
+    data, ancdata, flags, addr = sock.recvmsg(_MAX_MESSAGE_SIZE, socket.CMSG_SPACE(_MAX_FDS * fds.itemsize))
+    for cmsg_level, cmsg_type, cmsg_data in ancdata:
+        if cmsg_level == socket.SOL_SOCKET and cmsg_type == socket.SCM_RIGHTS:
+            fds.frombytes(cmsg_data[:len(cmsg_data) - (len(cmsg_data) % fds.itemsize)])
+    if not data:
+        for fd in fds:
+            os.close(fd)
+        return None, []
+    return json.loads(data.decode('utf-8')), list(fds)
+
+
+def _returncode_from_status(status):
+    if os.WIFSIGNALED(status):
+        return -os.WTERMSIG(status)
+    return os.WEXITSTATUS(status)
+
+
+class ForkServer(object):
+    """
+    Parent side of the fork server: starts the template process and launches children from it
+    """
+
+    def __init__(self, preload_modules, executable=None, new_process_group=True, pdeathsig=0, name="pf_forkserver"):
+        self.preload_modules = list(preload_modules)
+        self.executable = executable or sys.executable
+        self.new_process_group = new_process_group
+        self.pdeathsig = pdeathsig
+        self.name = name
+        self._sock = None
+        self._process = None
+        self._send_lock = threading.Lock()
+        self._state_lock = threading.Lock()
+        self._next_request_id = 0
+        self._pending_requests = {}
+        self._children = {}
+        self._ready_event = threading.Event()
+        self._ready_error = None
+        self._lost = False
+
+    @property
+    def pid(self):
+        return self._process.pid if self._process else None
+
+    def start(self, timeout=30):
+        """Starts the template process, and waits until it has finished importing the preloaded modules"""
+        parent_sock, child_sock = socket.socketpair(socket.AF_UNIX, socket.SOCK_SEQPACKET)
+        try:
+            cmd = [self.executable, '-m', 'processfamily.forkserver', str(child_sock.fileno())] + self.preload_modules
+            devnull = open(os.devnull, 'r+')
+            try:
+                self._process = subprocess.Popen(
+                    cmd, stdin=devnull, stdout=devnull, close_fds=True, pass_fds=[child_sock.fileno()],
+                    preexec_fn=self._pre_exec_fn)
+            finally:
+                devnull.close()
+        except Exception:
+            parent_sock.close()
+            raise
+        finally:
+            child_sock.close()
+        self._sock = parent_sock
+        reader_thread = threading.Thread(target=self._reader_thread_target, name=self.name)
+        reader_thread.daemon = True
+        reader_thread.start()
+        if not self._ready_event.wait(timeout):
+            self.stop()
+            raise ForkServerError("Timed out waiting for the fork server to preload %s" % ", ".join(self.preload_modules))
+        if self._ready_error:
+            self.stop()
+            raise ForkServerError("The fork server could not preload modules:\n%s" % self._ready_error)
+        logger.info("Fork server started (PID %d) with preloaded modules %s", self.pid, ", ".join(self.preload_modules))
+
+    def _pre_exec_fn(self):
+        if self.new_process_group:
+            os.setpgrp()
+        if self.pdeathsig:
+            from processfamily import ctypes_prctl
+            ctypes_prctl.set_pdeathsig(self.pdeathsig)
+
+    def stop(self, timeout=5):
+        """Stops the template process. Children that have already been launched are not stopped, but note that if
+        they were launched with a pdeathsig, they will receive it when the template process exits"""
+        if self._sock is not None:
+            try:
+                self._sock.shutdown(socket.SHUT_RDWR)
+            except socket.error:
+                pass
+        if self._process is not None:
+            end_time = time.time() + timeout
+            while self._process.poll() is None and time.time() < end_time:
+                time.sleep(0.05)
+            if self._process.poll() is None:
+                logger.warning("Fork server (PID %d) did not stop; killing it", self._process.pid)
+                self._process.kill()
+                self._process.wait()
+
+    def popen(self, args, **kwargs):
+        """Launches a child process with arguments like subprocess.Popen. Commands that do not run a python
+        script or module with this fork server's executable are launched with subprocess.Popen instead"""
+        if split_python_cmd(args, self.executable) is None or self._lost:
+            logger.debug("Launching %r with subprocess.Popen rather than the fork server", args)
+            return _subprocess_popen(args, **kwargs)
+        return ForkServerPopen(self, args, **kwargs)
+
+    def _spawn(self, popen, argv, fds, fd_targets, cwd, env, new_process_group, pdeathsig):
+        with self._state_lock:
+            self._next_request_id += 1
+            request_id = self._next_request_id
+            event = threading.Event()
+            result = {}
+            self._pending_requests[request_id] = (event, result, popen)
+        request = {
+            "op": "spawn",
+            "id": request_id,
+            "argv": argv,
+            "fd_targets": fd_targets,
+            "cwd": cwd,
+            "env": env,
+            "new_process_group": new_process_group,
+            "pdeathsig": pdeathsig,
+        }
+        try:
+            with self._send_lock:
+                send_message(self._sock, request, fds)
+            event.wait()
+        finally:
+            with self._state_lock:
+                self._pending_requests.pop(request_id, None)
+        if "error" in result:
+            raise ForkServerError(result["error"])
+        return result["pid"]
+
+    def _reader_thread_target(self):
+        try:
+            while True:
+                try:
+                    message, fds = recv_message(self._sock)
+                except Exception as e:
+                    if not self._lost:
+                        logger.error("Error reading from fork server: %s", e)
+                    break
+                for fd in fds:
+                    os.close(fd)
+                if message is None:
+                    break
+                op = message.get("op")
+                if op == "ready":
+                    self._ready_error = message.get("error")
+                    self._ready_event.set()
+                elif op in ("spawned", "error"):
+                    with self._state_lock:
+                        event, result, popen = self._pending_requests.get(message["id"], (None, None, None))
+                        if event is not None and op == "spawned":
+                            #This is registered here so that an exit message that follows can't be missed
+                            self._children[message["pid"]] = popen
+                    if event is not None:
+                        if op == "error":
+                            result["error"] = message["message"]
+                        else:
+                            result["pid"] = message["pid"]
+                        event.set()
+                elif op == "exit":
+                    with self._state_lock:
+                        popen = self._children.pop(message["pid"], None)
+                    if popen is not None:
+                        popen._set_returncode(message["returncode"])
+        finally:
+            self._lost = True
+            self._ready_event.set()
+            with self._state_lock:
+                for event, result, popen in list(self._pending_requests.values()):
+                    result["error"] = "The fork server has stopped"
+                    event.set()
+                lost_children = list(self._children.values())
+                self._children.clear()
+            for popen in lost_children:
+                popen._fork_server_lost()
+            logger.debug("Fork server connection closed")
+
+
+def _subprocess_popen(args, new_process_group=False, pdeathsig=0, **kwargs):
+    if new_process_group or pdeathsig:
+        def pre_exec_fn():
+            if new_process_group:
+                os.setpgrp()
+            if pdeathsig:
+                from processfamily import ctypes_prctl
+                ctypes_prctl.set_pdeathsig(pdeathsig)
+        kwargs['preexec_fn'] = pre_exec_fn
+    return subprocess.Popen(args, **kwargs)
+
+
+class ForkServerPopen(object):
+    """
+    A subprocess.Popen lookalike for a child launched by a ForkServer. Only the subset of the Popen interface used
+    by processfamily is supported.
+    """
+
+    def __init__(self, fork_server, args, stdin=None, stdout=None, stderr=None, close_fds=True, cwd=None, env=None,
+                 pass_fds=(), new_process_group=False, pdeathsig=0):
+        self.args = args
+        self.returncode = None
+        self.stdin = self.stdout = self.stderr = None
+        self._exit_event = threading.Event()
+        self._exit_lock = threading.Lock()
+        self._exit_callbacks = []
+
+        child_fds = []
+        parent_fds_to_close = []
+        our_ends = []
+        try:
+            for target, stream, mode in ((0, stdin, 'wb'), (1, stdout, 'rb'), (2, stderr, 'rb')):
+                if stream == subprocess.PIPE:
+                    r, w = os.pipe()
+                    child_end, our_end = (r, w) if mode == 'wb' else (w, r)
+                    parent_fds_to_close.append(child_end)
+                    our_ends.append((target, our_end, mode))
+                    child_fds.append(child_end)
+                elif stream == subprocess.DEVNULL:
+                    fd = os.open(os.devnull, os.O_RDWR)
+                    parent_fds_to_close.append(fd)
+                    child_fds.append(fd)
+                elif stream is None:
+                    child_fds.append(target)
+                elif isinstance(stream, int):
+                    child_fds.append(stream)
+                else:
+                    child_fds.append(stream.fileno())
+            fd_targets = [0, 1, 2] + list(pass_fds)
+            child_fds.extend(pass_fds)
+            argv = split_python_cmd(args, fork_server.executable)
+            self.pid = fork_server._spawn(self, argv, child_fds, fd_targets, cwd, env and dict(env),
+                                          new_process_group, pdeathsig)
+        except Exception:
+            for target, fd, mode in our_ends:
+                os.close(fd)
+            raise
+        finally:
+            for fd in parent_fds_to_close:
+                os.close(fd)
+        for target, fd, mode in our_ends:
+            setattr(self, ("stdin", "stdout", "stderr")[target], os.fdopen(fd, mode))
+
+    def __repr__(self):
+        return "<%s: pid %s>" % (type(self).__name__, getattr(self, "pid", None))
+
+    def _set_returncode(self, returncode):
+        with self._exit_lock:
+            if self.returncode is None:
+                self.returncode = returncode
+            callbacks, self._exit_callbacks = self._exit_callbacks, []
+        self._exit_event.set()
+        for callback in callbacks:
+            try:
+                callback()
+            except Exception as e:
+                logger.error("Error in exit callback for %r: %s", self, e, exc_info=True)
+
+    def add_exit_callback(self, callback):
+        """Calls callback() (from the fork server reader thread) once the exit of this child has been reported. It is
+        called immediately if that has already happened"""
+        with self._exit_lock:
+            if self.returncode is None:
+                self._exit_callbacks.append(callback)
+                return
+        callback()
+
+    def _fork_server_lost(self):
+        #We have lost track of this child; the best we can do is poll for its existence
+        self._lost = True
+
+    def poll(self):
+        if self.returncode is None and getattr(self, "_lost", False) and not process_exists(self.pid):
+            self._set_returncode(UNKNOWN_RETURNCODE)
+        return self.returncode
+
+    def wait(self, timeout=None):
+        end_time = None if timeout is None else time.time() + timeout
+        while self.poll() is None:
+            remaining = None if end_time is None else end_time - time.time()
+            if remaining is not None and remaining <= 0:
+                raise subprocess.TimeoutExpired(self.args, timeout)
+            self._exit_event.wait(0.1 if remaining is None else min(remaining, 0.1))
+        return self.returncode
+
+    def send_signal(self, sig):
+        if self.poll() is None:
+            os.kill(self.pid, sig)
+
+    def terminate(self):
+        self.send_signal(signal.SIGTERM)
+
+    def kill(self):
+        self.send_signal(signal.SIGKILL)
+
+
+def _reap_children(sock):
+    while True:
+        try:
+            pid, status = os.waitpid(-1, os.WNOHANG)
+        except OSError as e:
+            if e.errno == errno.ECHILD:
+                return
+            raise
+        if pid == 0:
+            return
+        send_message(sock, {"op": "exit", "pid": pid, "returncode": _returncode_from_status(status)})
+
+
+def _close_fds_except(keep_fds):
+    max_fd = os.sysconf("SC_OPEN_MAX")
+    low = 0
+    for fd in sorted(set(keep_fds)) + [max_fd]:
+        if fd > low:
+            os.closerange(low, fd)
+        low = fd + 1
+
+
+def _prepare_forked_child(request, fds, zygote_pid):
+    """Sets up a freshly forked child according to the spawn request. Returns the argv to run"""
+    if request["new_process_group"]:
+        os.setpgrp()
+    if request["pdeathsig"]:
+        from processfamily import ctypes_prctl
+        ctypes_prctl.set_pdeathsig(request["pdeathsig"])
+        if os.getppid() != zygote_pid:
+            #The fork server died before the death signal was set
+            os._exit(1)
+    targets = request["fd_targets"]
+    #Move the received fds out of the way of the targets before putting them in place
+    import fcntl
+    high_fds = [fcntl.fcntl(fd, fcntl.F_DUPFD, max(targets) + 1) for fd in fds]
+    for high_fd, target in zip(high_fds, targets):
+        os.dup2(high_fd, target)
+    _close_fds_except(targets)
+    if request["cwd"]:
+        os.chdir(request["cwd"])
+    if request["env"] is not None:
+        os.environ.clear()
+        os.environ.update(request["env"])
+    import random
+    random.seed()
+    return request["argv"]
+
+
+def serve(sock, preload_modules):
+    """Runs the fork server loop in the template process. Returns None when the parent closes the connection, or the
+    argv to run (as a (module_name, script_filename, args) tuple) in a forked child"""
+    error = None
+    for module_name in preload_modules:
+        try:
+            importlib.import_module(module_name)
+        except Exception:
+            error = traceback.format_exc()
+    send_message(sock, {"op": "ready", "error": error})
+    if error:
+        return None
+
+    zygote_pid = os.getpid()
+    wakeup_r, wakeup_w = os.pipe()
+    os.set_blocking(wakeup_r, False)
+    os.set_blocking(wakeup_w, False)
+    signal.set_wakeup_fd(wakeup_w)
+    signal.signal(signal.SIGCHLD, lambda signum, frame: None)
+    while True:
+        readable, _, _ = select.select([sock, wakeup_r], [], [])
+        if wakeup_r in readable:
+            try:
+                while os.read(wakeup_r, 4096):
+                    pass
+            except OSError as e:
+                if e.errno not in (errno.EAGAIN, errno.EWOULDBLOCK):
+                    raise
+            _reap_children(sock)
+        if sock not in readable:
+            continue
+        request, fds = recv_message(sock)
+        if request is None:
+            return None
+        try:
+            pid = os.fork()
+        except OSError as e:
+            for fd in fds:
+                os.close(fd)
+            send_message(sock, {"op": "error", "id": request["id"], "message": str(e)})
+            continue
+        if pid == 0:
+            try:
+                signal.set_wakeup_fd(-1)
+                signal.signal(signal.SIGCHLD, signal.SIG_DFL)
+                sock.close()
+                os.close(wakeup_r)
+                os.close(wakeup_w)
+                return _prepare_forked_child(request, fds, zygote_pid)
+            except BaseException:
+                traceback.print_exc()
+                os._exit(1)
+        for fd in fds:
+            os.close(fd)
+        send_message(sock, {"op": "spawned", "id": request["id"], "pid": pid})
+
+
+if __name__ == '__main__':
+    _sock = socket.socket(fileno=int(sys.argv[1]))
+    _child_argv = serve(_sock, sys.argv[2:])
+    del _sock
+    if _child_argv is not None:
+        #We are now in a forked child - run it like the interpreter would have
+        run_python_main(*_child_argv)
@@ -0,0 +1,129 @@
+# -*- coding: utf-8 -*-
+"""Length prefixed binary frames with pluggable serializers, as an alternative to newline delimited JSON"""
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+from __future__ import unicode_literals
+from future import standard_library
+standard_library.install_aliases()
+from builtins import *
+from builtins import object
+__author__ = 'matth'
+
+import pickle
+import struct
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+#Each frame is a 4 byte big endian length followed by that many bytes of serialized message
+FRAME_HEADER = struct.Struct(">I")
+MAX_FRAME_SIZE = 0xffffffff
+
+_COUNT = struct.Struct(">I")
+_BUFFER_LENGTH = struct.Struct(">Q")
+
+
+class PickleSerializer(object):
+    """
+    Pickle, with protocol 5 out-of-band buffers where available (Python 3.8+): large buffers (e.g. bytearrays and
+    numpy arrays) are written after the pickle data rather than being copied into it. Only use this between processes
+    that trust each other, as unpickling can run arbitrary code.
+    """
+    name = "pickle"
+
+    def __init__(self):
+        self.protocol = pickle.HIGHEST_PROTOCOL
+        self.out_of_band = self.protocol >= 5
+
+    def dumps(self, obj):
+        """Returns a list of bytes-like chunks which together are the serialized obj"""
+        buffers = []
+        if self.out_of_band:
+            data = pickle.dumps(obj, protocol=self.protocol, buffer_callback=buffers.append)
+        else:
+            data = pickle.dumps(obj, protocol=self.protocol)
+        raws = [buffer.raw() for buffer in buffers]
+        #The buffer count and lengths, then the pickle data, then the buffers
+        return [_COUNT.pack(len(raws))] + [_BUFFER_LENGTH.pack(raw.nbytes) for raw in raws] + [data] + raws
+
+    def loads(self, data):
+        data = memoryview(data)
+        count = _COUNT.unpack_from(data)[0]
+        offset = _COUNT.size
+        lengths = []
+        for i in range(count):
+            lengths.append(_BUFFER_LENGTH.unpack_from(data, offset)[0])
+            offset += _BUFFER_LENGTH.size
+        pickle_end = len(data) - sum(lengths)
+        buffers = []
+        buffer_offset = pickle_end
+        for length in lengths:
+            buffers.append(data[buffer_offset:buffer_offset + length])
+            buffer_offset += length
+        if self.out_of_band:
+            return pickle.loads(data[offset:pickle_end], buffers=buffers)
+        return pickle.loads(data[offset:pickle_end])
+
+
+class MsgpackSerializer(object):
+    """msgpack (which must be installed), with bytes and str kept distinct"""
+    name = "msgpack"
+
+    def __init__(self):
+        if msgpack is None:
+            raise ValueError("msgpack is not installed")
+
+    def dumps(self, obj):
+        return [msgpack.packb(obj, use_bin_type=True)]
+
+    def loads(self, data):
+        return msgpack.unpackb(data, raw=False)
+
+
+SERIALIZERS = {
+    PickleSerializer.name: PickleSerializer,
+    MsgpackSerializer.name: MsgpackSerializer,
+}
+
+
+def get_serializer(name):
+    """Returns a serializer instance for the given name, raising ValueError if it is unknown or not available"""
+    if name not in SERIALIZERS:
+        raise ValueError("Unknown serializer %r" % (name,))
+    return SERIALIZERS[name]()
+
+
+def encode_frame(serializer, message):
+    """Returns a list of bytes-like chunks which together are the frame for message"""
+    chunks = serializer.dumps(message)
+    length = sum(memoryview(c).nbytes for c in chunks)
+    if length > MAX_FRAME_SIZE:
+        raise ValueError("Message is too large for a frame (%d bytes)" % length)
+    return [FRAME_HEADER.pack(length)] + chunks
+
+
+def read_frame(stream):
+    """Reads a frame from a blocking binary stream, returning its payload, or None at the end of the stream"""
+    header = _read_exactly(stream, FRAME_HEADER.size)
+    if header is None:
+        return None
+    length = FRAME_HEADER.unpack(header)[0]
+    payload = _read_exactly(stream, length)
+    if payload is None:
+        raise EOFError("The stream ended part way through a frame")
+    return payload
+
+
+def _read_exactly(stream, size):
+    data = stream.read(size)
+    if not data:
+        return None if size else b''
+    while len(data) < size:
+        more = stream.read(size - len(data))
+        if not more:
+            raise EOFError("The stream ended part way through a frame")
+        data += more
+    return data
@@ -0,0 +1,171 @@
+# -*- coding: utf-8 -*-
+"""A single threaded I/O multiplexer for reading the output streams of many child processes (not on Windows)"""
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+from __future__ import unicode_literals
+from future import standard_library
+standard_library.install_aliases()
+from builtins import *
+from builtins import object
+__author__ = 'matth'
+
+import errno
+import logging
+import os
+import selectors
+import threading
+import traceback
+
+from processfamily.framing import FRAME_HEADER
+
+logger = logging.getLogger("processfamily.iomux")
+
+READ_SIZE = 65536
+
+
+def _traceback_str():
+    return traceback.format_exc()
+
+
+class IOMultiplexer(object):
+    """
+    Calls callbacks when file descriptors become readable, from a single background thread (using epoll, kqueue etc.
+    through the selectors module). Callbacks run on that thread, so they must not block.
+    """
+
+    def __init__(self, name="pf_io_mux"):
+        self.name = name
+        self._selector = selectors.DefaultSelector()
+        self._lock = threading.Lock()
+        self._pending = []
+        self._thread = None
+        self._wakeup_r, self._wakeup_w = os.pipe()
+        os.set_blocking(self._wakeup_r, False)
+        os.set_blocking(self._wakeup_w, False)
+        self._selector.register(self._wakeup_r, selectors.EVENT_READ, None)
+
+    def register(self, fd, callback):
+        """Calls callback() whenever fd is readable, until it is unregistered"""
+        self._queue_change(self._selector.register, fd, selectors.EVENT_READ, callback)
+
+    def unregister(self, fd):
+        """Stops watching fd. This must be called before fd is closed"""
+        self._queue_change(self._selector.unregister, fd)
+
+    def _queue_change(self, fn, *args):
+        if threading.current_thread() is self._thread:
+            #Changes made from callbacks can be applied immediately
+            self._apply_change(fn, args)
+            return
+        with self._lock:
+            self._pending.append((fn, args))
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._thread_target, name=self.name)
+                self._thread.daemon = True
+                self._thread.start()
+        self._wakeup()
+
+    def _wakeup(self):
+        try:
+            os.write(self._wakeup_w, b'\0')
+        except OSError as e:
+            if e.errno not in (errno.EAGAIN, errno.EWOULDBLOCK):
+                raise
+
+    def _apply_change(self, fn, args):
+        try:
+            fn(*args)
+        except (KeyError, ValueError) as e:
+            logger.warning("Could not change I/O registration for fd %r: %s", args[0], e)
+
+    def _thread_target(self):
+        while True:
+            with self._lock:
+                pending, self._pending = self._pending, []
+            for fn, args in pending:
+                self._apply_change(fn, args)
+            for key, events in self._selector.select():
+                if key.data is None:
+                    try:
+                        while os.read(self._wakeup_r, READ_SIZE):
+                            pass
+                    except OSError as e:
+                        if e.errno not in (errno.EAGAIN, errno.EWOULDBLOCK):
+                            raise
+                    continue
+                try:
+                    key.data()
+                except Exception as e:
+                    logger.error("Error in I/O callback for fd %r: %s\n%s", key.fd, e, _traceback_str())
+
+
+class LineReader(object):
+    """
+    Reads lines from a file descriptor registered with an IOMultiplexer, calling line_callback(line) for each line
+    (including its line ending, like readline()) and eof_callback() at the end of the stream. After switch_to_frames,
+    the rest of the stream is read as length prefixed frames instead (see processfamily.framing).
+    """
+
+    def __init__(self, multiplexer, fd, line_callback, eof_callback):
+        self.multiplexer = multiplexer
+        self.fd = fd
+        self.line_callback = line_callback
+        self.eof_callback = eof_callback
+        self.frame_callback = None
+        self._buffer = bytearray()
+        self._wanted = 0
+        self._scanned = 0
+        os.set_blocking(fd, False)
+        multiplexer.register(fd, self._on_readable)
+
+    def switch_to_frames(self, frame_callback):
+        """Calls frame_callback(payload) for each frame after the current line. This must be called from
+        line_callback, so that it takes effect before any more of the stream is read"""
+        self.frame_callback = frame_callback
+
+    def _on_readable(self):
+        try:
+            #Reads the rest of a large frame at once, rather than in READ_SIZE pieces
+            data = os.read(self.fd, max(READ_SIZE, self._wanted))
+        except OSError as e:
+            if e.errno in (errno.EAGAIN, errno.EWOULDBLOCK, errno.EINTR):
+                return
+            logger.warning("Error reading fd %d; treating it as closed: %s", self.fd, e)
+            data = b''
+        if not data:
+            self.multiplexer.unregister(self.fd)
+            if self._buffer:
+                if self.frame_callback is None:
+                    self.line_callback(bytes(self._buffer))
+                else:
+                    logger.warning("fd %d ended part way through a frame", self.fd)
+                self._buffer = bytearray()
+            self.eof_callback()
+            return
+        self._buffer += data
+        self._process_buffer()
+
+    def _process_buffer(self):
+        buffer = self._buffer
+        pos = 0
+        #The start of a long partial line has already been searched
+        search_from, self._scanned = self._scanned, 0
+        while self.frame_callback is None:
+            end = buffer.find(b'\n', max(pos, search_from))
+            if end < 0:
+                self._scanned = len(buffer) - pos
+                break
+            self.line_callback(bytes(buffer[pos:end + 1]))
+            pos = end + 1
+        self._wanted = 0
+        if self.frame_callback is not None:
+            while len(buffer) - pos >= FRAME_HEADER.size:
+                start = pos + FRAME_HEADER.size
+                length = FRAME_HEADER.unpack_from(buffer, pos)[0]
+                if len(buffer) - start < length:
+                    self._wanted = length - (len(buffer) - start)
+                    break
+                self.frame_callback(bytes(buffer[start:start + length]))
+                pos = start + length
+        del buffer[:pos]
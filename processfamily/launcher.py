@@ -0,0 +1,89 @@
+# -*- coding: utf-8 -*-
+"""Helpers for running a child process command line inside an already running python interpreter.
+
+When run as a script, this module is a small launch shim that does the process setup that would otherwise need a
+preexec_fn (which forces subprocess to use a full fork of the parent), and then runs the real child command:
+
+    python -m processfamily.launcher [--setpgrp] [--pdeathsig SIG --ppid PID] -- child_cmd...
+
+If the child command runs a python script or module with the same interpreter it is run in this process, so the shim
+adds no extra interpreter startup; any other command is exec'd."""
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+from __future__ import unicode_literals
+from future import standard_library
+standard_library.install_aliases()
+from builtins import *
+
+import argparse
+import os
+import runpy
+import sys
+
+
+def split_python_cmd(cmd, executable=None):
+    """Splits a child process command line of the form [executable, script, args...] or
+    [executable, '-m', module, args...] into (module_name, script_filename, args). Exactly one of module_name and
+    script_filename will be set. Returns None if the command line is not of one of these forms (or runs a different
+    executable), in which case it cannot be run in this interpreter"""
+    if len(cmd) < 2:
+        return None
+    if executable is not None and os.path.realpath(cmd[0]) != os.path.realpath(executable):
+        return None
+    if cmd[1] == '-m':
+        if len(cmd) < 3:
+            return None
+        return cmd[2], None, list(cmd[3:])
+    if cmd[1].startswith('-'):
+        # Interpreter options would need a new interpreter
+        return None
+    return None, cmd[1], list(cmd[2:])
+
+
+def run_python_main(module_name, script_filename, args):
+    """Runs the given module or script as __main__ with the given command line arguments, as the python interpreter
+    would if it had been started with them"""
+    if module_name is not None:
+        sys.argv = [module_name] + list(args)
+        runpy.run_module(module_name, run_name='__main__', alter_sys=True)
+    else:
+        sys.argv = [script_filename] + list(args)
+        sys.path[0] = os.path.dirname(os.path.abspath(script_filename))
+        runpy.run_path(script_filename, run_name='__main__')
+
+
+def get_shim_cmd(cmd, executable, setpgrp=False, pdeathsig=0):
+    """Returns a command line that runs cmd through the launch shim, applying the given process settings"""
+    shim_cmd = [executable, '-m', 'processfamily.launcher']
+    if setpgrp:
+        shim_cmd.append('--setpgrp')
+    if pdeathsig:
+        shim_cmd.extend(['--pdeathsig', str(int(pdeathsig)), '--ppid', str(os.getpid())])
+    return shim_cmd + ['--'] + list(cmd)
+
+
+def _main():
+    arg_parser = argparse.ArgumentParser(description='processfamily child process launch shim')
+    arg_parser.add_argument('--setpgrp', action='store_true')
+    arg_parser.add_argument('--pdeathsig', type=int, default=0)
+    arg_parser.add_argument('--ppid', type=int, default=0)
+    arg_parser.add_argument('cmd', nargs=argparse.REMAINDER)
+    args = arg_parser.parse_args()
+    cmd = args.cmd[1:] if args.cmd and args.cmd[0] == '--' else args.cmd
+    if args.setpgrp:
+        os.setpgrp()
+    if args.pdeathsig:
+        from processfamily import ctypes_prctl
+        ctypes_prctl.set_pdeathsig(args.pdeathsig)
+        if args.ppid and os.getppid() != args.ppid:
+            #The parent died before the death signal was set, so it will never be delivered
+            os._exit(1)
+    python_cmd = split_python_cmd(cmd, sys.executable)
+    if python_cmd is None:
+        os.execvp(cmd[0], cmd)
+    run_python_main(*python_cmd)
+
+
+if __name__ == '__main__':
+    _main()
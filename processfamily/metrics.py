@@ -0,0 +1,157 @@
+# -*- coding: utf-8 -*-
+"""Sampling the resource usage of child processes from /proc (Linux only)"""
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+from __future__ import unicode_literals
+from future import standard_library
+standard_library.install_aliases()
+from builtins import *
+from builtins import object
+__author__ = 'matth'
+
+import errno
+import logging
+import os
+import time
+
+logger = logging.getLogger("processfamily.metrics")
+
+READ_SIZE = 8192
+
+_CLOCK_TICKS = os.sysconf(os.sysconf_names['SC_CLK_TCK']) if hasattr(os, "sysconf") else 100
+
+_STATUS_FIELDS = {
+    b'VmRSS': "rss",
+    b'voluntary_ctxt_switches': "voluntary_ctxt_switches",
+    b'nonvoluntary_ctxt_switches': "nonvoluntary_ctxt_switches",
+}
+_IO_FIELDS = {
+    b'read_bytes': "read_bytes",
+    b'write_bytes': "write_bytes",
+}
+
+
+class _ProcFiles(object):
+    """
+    Keeps the /proc files of a process open, so that each sample is just a pread from the start of each file
+    (rather than an open, read and close)
+    """
+
+    def __init__(self, pid):
+        self.pid = pid
+        self.fds = {}
+        try:
+            for name in ("stat", "status", "io"):
+                try:
+                    self.fds[name] = os.open("/proc/%d/%s" % (pid, name), os.O_RDONLY)
+                except OSError as e:
+                    #io is only readable by the owner of the process (or with CAP_SYS_PTRACE)
+                    if name != "io" or e.errno not in (errno.EACCES, errno.EPERM):
+                        raise
+        except Exception:
+            self.close()
+            raise
+
+    def read(self, name):
+        fd = self.fds.get(name)
+        if fd is None:
+            return None
+        chunks = []
+        offset = 0
+        while True:
+            chunk = os.pread(fd, READ_SIZE, offset)
+            chunks.append(chunk)
+            offset += len(chunk)
+            if len(chunk) < READ_SIZE:
+                return b''.join(chunks)
+
+    def close(self):
+        for fd in self.fds.values():
+            os.close(fd)
+        self.fds = {}
+
+
+def _parse_fields(data, names):
+    values = {}
+    for line in data.splitlines():
+        name, _, value = line.partition(b':')
+        if name in names:
+            values[names[name]] = int(value.split()[0])
+    return values
+
+
+class ChildMetricsCollector(object):
+    """
+    Samples the CPU, memory, thread, file descriptor, context switch and I/O usage of the children of a ProcessFamily.
+    The /proc files of each child are kept open between samples. CPU usage and I/O rates are measured since the
+    previous sample of the same child, so they are None in the first sample.
+    """
+
+    def __init__(self, process_family):
+        self.process_family = process_family
+        self._proc_files = {}
+        self._last_samples = {}
+
+    def sample(self):
+        """Returns a dict of child index to a dict of metrics for each running child"""
+        children = [c for c in list(self.process_family.child_processes) if not c.is_stopped()]
+        pids = set(c.pid for c in children)
+        for pid in list(self._proc_files):
+            if pid not in pids:
+                self._proc_files.pop(pid).close()
+                self._last_samples.pop(pid, None)
+        metrics = {}
+        for c in children:
+            try:
+                metrics[c.child_index] = self._sample_process(c.pid)
+            except (IOError, OSError) as e:
+                #It has probably just exited
+                logger.debug("Could not sample metrics for %s: %s", c.name, e)
+                proc_files = self._proc_files.pop(c.pid, None)
+                if proc_files is not None:
+                    proc_files.close()
+        return metrics
+
+    def close(self):
+        for proc_files in self._proc_files.values():
+            proc_files.close()
+        self._proc_files = {}
+        self._last_samples = {}
+
+    def _sample_process(self, pid):
+        proc_files = self._proc_files.get(pid)
+        if proc_files is None:
+            proc_files = self._proc_files[pid] = _ProcFiles(pid)
+        now = time.time()
+        stat = proc_files.read("stat")
+        #The command name can contain spaces and brackets, so the fields are found after the last bracket
+        stat_fields = stat[stat.rindex(b')') + 2:].split()
+        cpu_time = (int(stat_fields[11]) + int(stat_fields[12])) / float(_CLOCK_TICKS)
+        status = _parse_fields(proc_files.read("status"), _STATUS_FIELDS)
+        io_data = proc_files.read("io")
+        io = _parse_fields(io_data, _IO_FIELDS) if io_data is not None else {}
+        sample = {
+            "pid": pid,
+            "cpu_time": cpu_time,
+            "cpu_percent": None,
+            "rss": status.get("rss", 0) * 1024,
+            "threads": int(stat_fields[17]),
+            "fds": len(os.listdir("/proc/%d/fd" % pid)),
+            "voluntary_ctxt_switches": status.get("voluntary_ctxt_switches"),
+            "nonvoluntary_ctxt_switches": status.get("nonvoluntary_ctxt_switches"),
+            "read_bytes": io.get("read_bytes"),
+            "write_bytes": io.get("write_bytes"),
+            "read_bytes_per_sec": None,
+            "write_bytes_per_sec": None,
+        }
+        last_sample = self._last_samples.get(pid)
+        if last_sample is not None and now > last_sample[0]:
+            elapsed = now - last_sample[0]
+            last = last_sample[1]
+            sample["cpu_percent"] = 100.0 * (cpu_time - last["cpu_time"]) / elapsed
+            for name in ("read_bytes", "write_bytes"):
+                if sample[name] is not None and last[name] is not None:
+                    sample[name + "_per_sec"] = (sample[name] - last[name]) / elapsed
+        self._last_samples[pid] = (now, sample)
+        return sample
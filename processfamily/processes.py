@@ -109,6 +109,67 @@ else:
         return multiprocessing.cpu_count()
 
 
+if sys.platform.startswith("win"):
+
+    def get_process_cpu_time(pid):
+        """Returns the total user and kernel CPU time used by the given process, in seconds"""
+        h = win32api.OpenProcess(PROCESS_QUERY_LIMITED_INFORMATION if USE_PROCESS_QUERY_LIMITED_INFORMATION
+                                 else win32con.PROCESS_QUERY_INFORMATION, 0, pid)
+        try:
+            times = win32process.GetProcessTimes(h)
+            #These are in units of 100ns
+            return (times['UserTime'] + times['KernelTime']) / 10000000.0
+        finally:
+            win32api.CloseHandle(h)
+
+else:
+
+    _CLOCK_TICKS = os.sysconf(os.sysconf_names['SC_CLK_TCK']) if hasattr(os, "sysconf") else 100
+
+    def get_process_cpu_time(pid):
+        """Returns the total user and kernel CPU time used by the given process, in seconds"""
+        with open("/proc/%d/stat" % pid, 'rb') as f:
+            stat = f.read()
+        #The command name can contain spaces and brackets, so the fields are found after the last bracket
+        fields = stat[stat.rindex(b')') + 2:].split()
+        return (int(fields[11]) + int(fields[12])) / float(_CLOCK_TICKS)
+
+
+if sys.platform.startswith("win"):
+
+    def get_process_memory_info(pid):
+        """Returns a dict with the resident set size ("rss") of the given process in bytes, and its proportional set
+        size ("pss"), or None where that is not available"""
+        h = win32api.OpenProcess(PROCESS_QUERY_LIMITED_INFORMATION if USE_PROCESS_QUERY_LIMITED_INFORMATION
+                                 else win32con.PROCESS_QUERY_INFORMATION, 0, pid)
+        try:
+            return {"rss": win32process.GetProcessMemoryInfo(h)['WorkingSetSize'], "pss": None}
+        finally:
+            win32api.CloseHandle(h)
+
+else:
+
+    def _read_proc_kb_fields(filename, names):
+        values = {}
+        with open(filename, 'rb') as f:
+            for line in f:
+                name, _, value = line.partition(b':')
+                if name in names:
+                    values[names[name]] = int(value.split()[0]) * 1024
+        return values
+
+    def get_process_memory_info(pid):
+        """Returns a dict with the resident set size ("rss") of the given process in bytes, and its proportional set
+        size ("pss"), or None where that is not available"""
+        try:
+            #This is much cheaper than summing /proc/<pid>/smaps, but needs Linux 4.14
+            memory_info = _read_proc_kb_fields("/proc/%d/smaps_rollup" % pid, {b'Rss': "rss", b'Pss': "pss"})
+        except (IOError, OSError):
+            memory_info = _read_proc_kb_fields("/proc/%d/status" % pid, {b'VmRSS': "rss"})
+        memory_info.setdefault("pss", None)
+        return memory_info
+
+
 
 def get_process_affinity(pid=None):
     """Gets the process_affinity cores either for the current process or the given pid. Returns a list of cores"""
@@ -0,0 +1,116 @@
+# -*- coding: utf-8 -*-
+"""A low overhead sampling profiler, which periodically records the stacks of all the threads in this process"""
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+from __future__ import unicode_literals
+from future import standard_library
+standard_library.install_aliases()
+from builtins import *
+from builtins import object
+__author__ = 'matth'
+
+import logging
+import os
+import threading
+import time
+import traceback
+
+from processfamily.threads import find_thread_frames
+
+logger = logging.getLogger("processfamily.profiler")
+
+TRUNCATED_STACK = "[truncated]"
+
+
+def _traceback_str():
+    return traceback.format_exc()
+
+
+def _frame_label(frame):
+    code = frame.f_code
+    return "%s (%s:%d)" % (code.co_name, os.path.basename(code.co_filename), code.co_firstlineno)
+
+
+class SamplingProfiler(object):
+    """
+    Samples the stack of every thread every interval seconds from a background thread, and counts how often each
+    stack is seen. At most max_stacks different stacks are kept: once that many have been seen, samples of new stacks
+    are counted under a single "[truncated]" stack. Stacks deeper than max_depth frames keep only their innermost frames.
+    The results are in the collapsed (folded) stack format used by flamegraph tools.
+    """
+
+    def __init__(self, interval=0.01, max_stacks=10000, max_depth=100):
+        self.interval = interval
+        self.max_stacks = max_stacks
+        self.max_depth = max_depth
+        self._lock = threading.Lock()
+        self._stacks = {}
+        self.samples = 0
+        self.truncated_samples = 0
+        self._stop_event = threading.Event()
+        self._thread = None
+
+    @property
+    def is_running(self):
+        return self._thread is not None
+
+    def start(self):
+        if self._thread is not None:
+            return
+        self._stop_event.clear()
+        self._thread = threading.Thread(target=self._thread_target, name="pf_profiler")
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self):
+        self._stop_event.set()
+        if self._thread is not None and self._thread is not threading.current_thread():
+            self._thread.join()
+        self._thread = None
+
+    def reset(self):
+        with self._lock:
+            self._stacks = {}
+            self.samples = 0
+            self.truncated_samples = 0
+
+    def sample(self):
+        """Records the current stack of every thread (except the calling one)"""
+        current_thread = threading.current_thread()
+        stacks = []
+        for thread, frame in find_thread_frames():
+            if thread is current_thread:
+                continue
+            labels = []
+            while frame is not None and len(labels) < self.max_depth:
+                labels.append(_frame_label(frame))
+                frame = frame.f_back
+            labels.append(thread.name if thread is not None else "unknown thread")
+            labels.reverse()
+            stacks.append(";".join(label.replace(";", ":") for label in labels))
+        with self._lock:
+            for stack in stacks:
+                if stack not in self._stacks and len(self._stacks) >= self.max_stacks:
+                    stack = TRUNCATED_STACK
+                    self.truncated_samples += 1
+                self._stacks[stack] = self._stacks.get(stack, 0) + 1
+            self.samples += 1
+
+    def get_collapsed_stacks(self):
+        """Returns the stacks seen so far as text, with a line of "frame;frame;... count" for each, most common first"""
+        with self._lock:
+            stacks = sorted(self._stacks.items(), key=lambda item: (-item[1], item[0]))
+        return "".join("%s %d\n" % (stack, count) for stack, count in stacks)
+
+    def _thread_target(self):
+        next_time = time.time()
+        while True:
+            #Skip any samples that were missed, rather than trying to catch up
+            next_time = max(next_time + self.interval, time.time())
+            if self._stop_event.wait(max(0, next_time - time.time())):
+                return
+            try:
+                self.sample()
+            except Exception as e:
+                logger.error("Error sampling thread stacks: %s\n%s", e, _traceback_str())
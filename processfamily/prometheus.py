@@ -0,0 +1,207 @@
+# -*- coding: utf-8 -*-
+"""Exporting the state of a ProcessFamily in the Prometheus text exposition format"""
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+from __future__ import unicode_literals
+from future import standard_library
+standard_library.install_aliases()
+from builtins import *
+from builtins import object
+__author__ = 'matth'
+
+import http.server
+import logging
+import os
+import sys
+import threading
+import traceback
+
+from processfamily.rpc import RPCStats
+
+logger = logging.getLogger("processfamily.prometheus")
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+
+def _traceback_str():
+    return traceback.format_exc()
+
+
+def _format_value(value):
+    if isinstance(value, float):
+        if value == float("inf"):
+            return "+Inf"
+        return repr(value)
+    return str(int(value))
+
+
+class _MetricWriter(object):
+
+    def __init__(self, prefix):
+        self.prefix = prefix
+        self.lines = []
+
+    def metric(self, name, metric_type, help_text, samples):
+        """samples is a list of (labels dict, value), or (labels dict, value, name suffix) for histograms"""
+        name = "%s_%s" % (self.prefix, name)
+        self.lines.append("# HELP %s %s" % (name, help_text))
+        self.lines.append("# TYPE %s %s" % (name, metric_type))
+        for sample in samples:
+            labels, value = sample[0], sample[1]
+            suffix = sample[2] if len(sample) > 2 else ""
+            label_str = ",".join('%s="%s"' % (k, str(v).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n"))
+                                 for k, v in labels)
+            self.lines.append("%s%s%s %s" % (name, suffix, "{%s}" % label_str if label_str else "", _format_value(value)))
+
+    def text(self):
+        return "\n".join(self.lines) + "\n"
+
+
+class PrometheusExporter(object):
+    """
+    Renders gauges and counters for a ProcessFamily and its children in the Prometheus text format, which can be
+    served over HTTP (serve) or written for the node exporter's textfile collector (write_textfile). Everything is
+    gathered when the metrics are rendered, from counters that the family keeps anyway, so this adds nothing to the
+    cost of an RPC call.
+    """
+
+    def __init__(self, process_family, prefix="processfamily"):
+        self.process_family = process_family
+        self.prefix = prefix
+        self._metrics_collector = None
+        if sys.platform.startswith('linux'):
+            from processfamily.metrics import ChildMetricsCollector
+            #A separate collector, so that scrapes do not change the intervals seen by ProcessFamily.get_child_metrics
+            self._metrics_collector = ChildMetricsCollector(process_family)
+        self._lock = threading.Lock()
+        self._http_server = None
+        self._textfile_stop_event = threading.Event()
+        self._textfile_thread = None
+
+    def render(self):
+        """Returns the current metrics in the Prometheus text exposition format"""
+        with self._lock:
+            return self._render()
+
+    def _render(self):
+        family = self.process_family
+        children = list(family.child_processes)
+        w = _MetricWriter(self.prefix)
+        w.metric("children", "gauge", "The number of children that should be running",
+                 [((), family.number_of_child_processes)])
+        w.metric("children_alive", "gauge", "The number of children that are running",
+                 [((), len([c for c in children if not c.is_stopped()]))])
+        w.metric("spare_children", "gauge", "The number of spare children that are ready",
+                 [((), len(family.spare_children))])
+        if family.start_duration is not None:
+            w.metric("start_duration_seconds", "gauge", "How long the family took to start",
+                     [((), family.start_duration)])
+        if family.stop_duration is not None:
+            w.metric("stop_duration_seconds", "gauge", "How long the family took to stop",
+                     [((), family.stop_duration)])
+        w.metric("child_restarts_total", "counter", "Restarts of each child after it exited",
+                 [((("child", i),), n) for i, n in sorted(family.restart_counts.items())])
+        w.metric("child_recycles_total", "counter", "Replacements of each child for using too many resources",
+                 [((("child", i),), n) for i, n in sorted(family.recycle_counts.items())])
+
+        labels = dict((c, (("child", c.child_index),)) for c in children)
+        w.metric("child_up", "gauge", "Whether each child is running",
+                 [(labels[c], 0 if c.is_stopped() else 1) for c in children])
+        if family.HEARTBEAT_INTERVAL:
+            w.metric("child_healthy", "gauge", "Whether each child is responding to heartbeats",
+                     [(labels[c], 1 if c.healthy else 0) for c in children])
+        w.metric("child_rpc_requests_total", "counter", "RPC calls to each child that have completed or timed out",
+                 [(labels[c], c.rpc_stats.requests) for c in children])
+        w.metric("child_rpc_errors_total", "counter", "RPC calls to each child that returned an error",
+                 [(labels[c], c.rpc_stats.errors) for c in children])
+        w.metric("child_rpc_timeouts_total", "counter", "RPC calls to each child that timed out",
+                 [(labels[c], c.rpc_stats.timeouts) for c in children])
+        w.metric("child_rpc_pending", "gauge", "RPC calls sent to each child that have not been answered yet",
+                 [(labels[c], c.pending_call_count) for c in children])
+        histogram = []
+        for c in children:
+            stats = c.rpc_stats
+            bucket_counts = list(stats.latency_bucket_counts)
+            count = 0
+            for bound, bucket_count in zip(RPCStats.LATENCY_BUCKETS + (float("inf"),), bucket_counts):
+                count += bucket_count
+                histogram.append((labels[c] + (("le", _format_value(float(bound))),), count, "_bucket"))
+            histogram.append((labels[c], stats.latency_sum, "_sum"))
+            histogram.append((labels[c], count, "_count"))
+        w.metric("child_rpc_latency_seconds", "histogram", "Round trip times of the RPC calls to each child", histogram)
+
+        if self._metrics_collector is not None:
+            metrics = self._metrics_collector.sample()
+            indexed = [((("child", i),), m) for i, m in sorted(metrics.items())]
+            w.metric("child_cpu_seconds_total", "counter", "CPU time used by each child",
+                     [(l, m["cpu_time"]) for l, m in indexed])
+            w.metric("child_resident_memory_bytes", "gauge", "Resident set size of each child",
+                     [(l, m["rss"]) for l, m in indexed])
+            w.metric("child_threads", "gauge", "Threads in each child", [(l, m["threads"]) for l, m in indexed])
+            w.metric("child_open_fds", "gauge", "Open file descriptors in each child", [(l, m["fds"]) for l, m in indexed])
+        return w.text()
+
+    def write_textfile(self, path):
+        """Writes the metrics to path (e.g. in the node exporter's textfile collector directory). The file is
+        replaced atomically, so it is never read half written"""
+        tmp_path = "%s.%d.tmp" % (path, os.getpid())
+        with open(tmp_path, 'w') as f:
+            f.write(self.render())
+        os.replace(tmp_path, path)
+
+    def start_textfile_writer(self, path, interval=15.0):
+        """Writes the metrics to path every interval seconds, from a background thread"""
+        self._textfile_stop_event.clear()
+
+        def thread_target():
+            while True:
+                try:
+                    self.write_textfile(path)
+                except Exception as e:
+                    logger.error("Error writing metrics to %s: %s\n%s", path, e, _traceback_str())
+                if self._textfile_stop_event.wait(interval):
+                    return
+        self._textfile_thread = threading.Thread(target=thread_target, name="pf_prometheus_textfile")
+        self._textfile_thread.daemon = True
+        self._textfile_thread.start()
+
+    def serve(self, port, host="127.0.0.1"):
+        """Serves the metrics over HTTP from a background thread. Returns the port (which is chosen if port is 0)"""
+        exporter = self
+
+        class MetricsHandler(http.server.BaseHTTPRequestHandler):
+            def do_GET(self):
+                try:
+                    body = exporter.render().encode("utf-8")
+                except Exception as e:
+                    logger.error("Error rendering metrics: %s\n%s", e, _traceback_str())
+                    self.send_error(500)
+                    return
+                self.send_response(200)
+                self.send_header("Content-Type", CONTENT_TYPE)
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                logger.debug(format, *args)
+
+        self._http_server = http.server.HTTPServer((host, port), MetricsHandler)
+        t = threading.Thread(target=self._http_server.serve_forever, name="pf_prometheus")
+        t.daemon = True
+        t.start()
+        return self._http_server.server_address[1]
+
+    def stop(self):
+        if self._http_server is not None:
+            self._http_server.shutdown()
+            self._http_server.server_close()
+            self._http_server = None
+        self._textfile_stop_event.set()
+        if self._textfile_thread is not None:
+            self._textfile_thread.join()
+            self._textfile_thread = None
+        with self._lock:
+            if self._metrics_collector is not None:
+                self._metrics_collector.close()
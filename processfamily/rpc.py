@@ -0,0 +1,204 @@
+# -*- coding: utf-8 -*-
+"""Support for making JSON-RPC calls from the parent process to its children over the processfamily protocol"""
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+from __future__ import unicode_literals
+from future import standard_library
+standard_library.install_aliases()
+from builtins import *
+from builtins import object
+__author__ = 'matth'
+
+import bisect
+import heapq
+import itertools
+import logging
+import queue
+import threading
+import time
+
+logger = logging.getLogger("processfamily.rpc")
+
+#Standard JSON-RPC 2.0 error codes
+PARSE_ERROR = -32700
+INVALID_REQUEST = -32600
+METHOD_NOT_FOUND = -32601
+INVALID_PARAMS = -32602
+INTERNAL_ERROR = -32603
+#Implementation defined server errors: an RPC method raised an exception, or a child has too many requests queued
+#to accept another
+SERVER_ERROR = -32000
+SERVER_BUSY = -32001
+
+
+class RPCError(Exception):
+    """An error response to an RPC call, or a failure to get a response"""
+    def __init__(self, message, code=None, data=None):
+        super(RPCError, self).__init__(message)
+        self.code = code
+        self.data = data
+
+
+class RPCTimeoutError(RPCError):
+    """No response to an RPC call was received within its timeout"""
+
+
+class ChildTerminatedError(RPCError):
+    """The child process stopped (or its output stream closed) before responding to an RPC call"""
+
+
+class ServerBusyError(RPCError):
+    """The child rejected an RPC call because its dispatch queue was full; the caller should back off and retry"""
+
+
+def error_from_response(error):
+    """Returns an RPCError for the error member of a JSON-RPC response"""
+    if not isinstance(error, dict):
+        return RPCError("Invalid error response: %r" % (error,))
+    error_class = ServerBusyError if error.get("code") == SERVER_BUSY else RPCError
+    return error_class(error.get("message", "Unknown error"), code=error.get("code"), data=error.get("data"))
+
+
+class RPCStats(object):
+    """
+    Counts of the RPC calls made to a child, with a histogram of their round trip times. This is updated for every
+    response, so it only does a few additions (and a bisect to find the latency bucket)
+    """
+
+    LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)  # Upper bounds in seconds
+
+    def __init__(self):
+        self.requests = 0
+        self.errors = 0
+        self.timeouts = 0
+        #The last count is for latencies above the largest bucket
+        self.latency_bucket_counts = [0] * (len(self.LATENCY_BUCKETS) + 1)
+        self.latency_sum = 0.0
+
+    def record_response(self, latency, error=False):
+        self.requests += 1
+        if error:
+            self.errors += 1
+        self.latency_bucket_counts[bisect.bisect_left(self.LATENCY_BUCKETS, latency)] += 1
+        self.latency_sum += latency
+
+    def record_timeout(self):
+        self.requests += 1
+        self.timeouts += 1
+
+
+class DispatchPool(object):
+    """
+    A fixed size pool of threads with a bounded queue, used by the child process host to handle RPC requests
+    """
+
+    def __init__(self, size, queue_size, name="pf_dispatch"):
+        self.size = size
+        self._queue = queue.Queue(queue_size)
+        self._stats_lock = threading.Lock()
+        self._busy_workers = 0
+        self._submitted = 0
+        self._rejected = 0
+        self._completed = 0
+        self._max_queue_depth = 0
+        self._wait_time_total = 0.0
+        self._wait_time_max = 0.0
+        self._threads = []
+        for i in range(size):
+            t = threading.Thread(target=self._worker_thread_target, name="%s_%d" % (name, i))
+            t.daemon = True
+            t.start()
+            self._threads.append(t)
+
+    def submit(self, fn, *args):
+        """Queues fn(*args) to be called by a pool thread. Returns False (without queueing it) if the queue is full"""
+        try:
+            self._queue.put_nowait((time.time(), fn, args))
+        except queue.Full:
+            with self._stats_lock:
+                self._rejected += 1
+            return False
+        with self._stats_lock:
+            self._submitted += 1
+            self._max_queue_depth = max(self._max_queue_depth, self._queue.qsize())
+        return True
+
+    def get_stats(self):
+        """Returns a dict of metrics for the pool. Counts and the total wait time are cumulative"""
+        with self._stats_lock:
+            return {
+                "pool_size": self.size,
+                "busy_workers": self._busy_workers,
+                "queue_depth": self._queue.qsize(),
+                "max_queue_depth": self._max_queue_depth,
+                "submitted": self._submitted,
+                "rejected": self._rejected,
+                "completed": self._completed,
+                "wait_time_total": self._wait_time_total,
+                "wait_time_max": self._wait_time_max,
+            }
+
+    def _worker_thread_target(self):
+        while True:
+            queued_time, fn, args = self._queue.get()
+            wait_time = time.time() - queued_time
+            with self._stats_lock:
+                self._busy_workers += 1
+                self._wait_time_total += wait_time
+                self._wait_time_max = max(self._wait_time_max, wait_time)
+            try:
+                fn(*args)
+            except Exception as e:
+                logger.error("Error in dispatch pool thread: %s", e, exc_info=True)
+            finally:
+                with self._stats_lock:
+                    self._busy_workers -= 1
+                    self._completed += 1
+
+
+class DeadlineScheduler(object):
+    """
+    Calls callbacks when their deadlines pass, from a single background thread. This lets many outstanding calls
+    have timeouts without needing a thread (or timer) each.
+    """
+
+    def __init__(self, name="pf_rpc_deadlines"):
+        self.name = name
+        self._condition = threading.Condition(threading.Lock())
+        self._heap = []
+        self._counter = itertools.count()
+        self._thread = None
+
+    def schedule(self, deadline, callback):
+        """Schedules callback to be called (with no arguments) at the given time.time() deadline.
+        Returns a handle that can be passed to cancel()"""
+        handle = [deadline, next(self._counter), callback]
+        with self._condition:
+            heapq.heappush(self._heap, handle)
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._thread_target, name=self.name)
+                self._thread.daemon = True
+                self._thread.start()
+            elif self._heap[0] is handle:
+                self._condition.notify()
+        return handle
+
+    def cancel(self, handle):
+        """Cancels a scheduled callback. The entry is discarded when it reaches the front of the queue"""
+        handle[2] = None
+
+    def _thread_target(self):
+        while True:
+            with self._condition:
+                while not self._heap or self._heap[0][0] > time.time():
+                    if self._heap and self._heap[0][2] is None:
+                        heapq.heappop(self._heap)
+                        continue
+                    self._condition.wait(self._heap[0][0] - time.time() if self._heap else None)
+                deadline, _, callback = heapq.heappop(self._heap)
+            if callback is not None:
+                try:
+                    callback()
+                except Exception as e:
+                    logger.error("Error in deadline callback: %s", e, exc_info=True)
@@ -0,0 +1,292 @@
+# -*- coding: utf-8 -*-
+"""Large RPC payloads in shared memory segments, with only a small descriptor of each sent over the comms channel.
+
+A descriptor is a dict with the segment name (under DESCRIPTOR_KEY), the offset and length of the payload, and the
+dtype and shape if it is a numpy array. Each side writes payloads into segments from a pool that it owns and reuses
+across calls, and the other side attaches to each segment once: the child sees the params' payloads without copying
+them, and the parent copies the results' payloads. A segment is in use until the other side says it has finished with
+it, and the other side is told which segments have been destroyed, so that it can detach from them. Needs
+multiprocessing.shared_memory (Python 3.8+), and is not used on Windows."""
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+from __future__ import unicode_literals
+from future import standard_library
+standard_library.install_aliases()
+from builtins import *
+from builtins import object
+__author__ = 'matth'
+
+import logging
+import sys
+import threading
+
+try:
+    from multiprocessing import shared_memory
+    from multiprocessing import resource_tracker
+except ImportError:
+    shared_memory = None
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+logger = logging.getLogger("processfamily.shm")
+
+#The environment variables that tell a child the size above which it should put payloads of its results in segments,
+#and the size of its pool
+THRESHOLD_ENV_VAR = "PROCESSFAMILY_SHM_THRESHOLD"
+POOL_SIZE_ENV_VAR = "PROCESSFAMILY_SHM_POOL_SIZE"
+
+DESCRIPTOR_KEY = "__pf_shm__"
+MIN_SEGMENT_SIZE = 1024 * 1024
+
+#SharedMemory only lets segments be left out of the resource tracker from Python 3.13
+_CAN_SKIP_TRACKING = sys.version_info >= (3, 13)
+
+
+def is_available():
+    return shared_memory is not None and not sys.platform.startswith('win')
+
+
+def create_segment(size):
+    """Creates a segment owned by this process (which the resource tracker destroys if this process exits without
+    doing so)"""
+    return shared_memory.SharedMemory(create=True, size=size)
+
+
+def attach_segment(name):
+    """Attaches to a segment owned by another process, without this process's resource tracker taking it over
+    (before Python 3.13, this still starts a resource tracker)"""
+    if _CAN_SKIP_TRACKING:
+        return shared_memory.SharedMemory(name, track=False)
+    segment = shared_memory.SharedMemory(name)
+    _untrack(segment)
+    return segment
+
+
+def unlink_segments(names):
+    """Destroys segments that another process has left for this one to destroy"""
+    for name in names:
+        try:
+            #Tracked until it is unlinked, in case this process exits first
+            segment = shared_memory.SharedMemory(name)
+        except FileNotFoundError:
+            continue
+        destroy_segment(segment)
+
+
+def _untrack(segment):
+    resource_tracker.unregister(segment._name, "shared_memory")
+
+
+def destroy_segment(segment):
+    """Closes and unlinks a segment owned by this process"""
+    try:
+        segment.close()
+    except BufferError as e:
+        #Something still has a view of it; the memory is freed once that has gone
+        logger.warning("Shared memory segment %s is still in use: %s", segment.name, e)
+    try:
+        segment.unlink()
+    except FileNotFoundError:
+        pass
+
+
+class SegmentPool(object):
+    """
+    Segments created by this process, which are reused for payloads rather than being created and destroyed for each
+    one. Up to max_free_bytes of free segments are kept; new segments are at least min_segment_size bytes, rounded up
+    to a power of two so that they suit a range of payload sizes.
+    """
+
+    def __init__(self, max_free_bytes, min_segment_size=MIN_SEGMENT_SIZE):
+        if not is_available():
+            raise ValueError("Shared memory is not available")
+        self.max_free_bytes = max_free_bytes
+        self.min_segment_size = min_segment_size
+        self._lock = threading.Lock()
+        self._free = []
+        self._free_bytes = 0
+        self._in_use = {}
+        self._closed = False
+
+    def acquire(self, size):
+        """Returns a segment of at least size bytes, which is in use until it is released or discarded"""
+        with self._lock:
+            if self._closed:
+                raise ValueError("The segment pool is closed")
+            fits = [s for s in self._free if s.size >= size]
+            if fits:
+                segment = min(fits, key=lambda s: s.size)
+                self._free.remove(segment)
+                self._free_bytes -= segment.size
+                self._in_use[segment.name] = segment
+                return segment
+        segment_size = self.min_segment_size
+        while segment_size < size:
+            segment_size *= 2
+        segment = create_segment(segment_size)
+        with self._lock:
+            if not self._closed:
+                self._in_use[segment.name] = segment
+                return segment
+        destroy_segment(segment)
+        raise ValueError("The segment pool is closed")
+
+    def release(self, segment):
+        """Returns a segment to the pool once nothing else is using it, returning the names of any segments that were
+        destroyed to keep the pool within max_free_bytes"""
+        destroyed = []
+        with self._lock:
+            self._in_use.pop(segment.name, None)
+            if self._closed:
+                destroyed.append(segment)
+            else:
+                self._free.append(segment)
+                self._free_bytes += segment.size
+                #The segments that have been free for longest go first
+                while self._free_bytes > self.max_free_bytes:
+                    oldest = self._free.pop(0)
+                    self._free_bytes -= oldest.size
+                    destroyed.append(oldest)
+        for s in destroyed:
+            destroy_segment(s)
+        return [s.name for s in destroyed]
+
+    def release_names(self, names):
+        """Releases the in use segments with the given names, as for release"""
+        with self._lock:
+            segments = [self._in_use[name] for name in names if name in self._in_use]
+        destroyed = []
+        for segment in segments:
+            destroyed.extend(self.release(segment))
+        return destroyed
+
+    def discard(self, segment):
+        """Destroys a segment rather than reusing it (e.g. if another process may still be using it), returning its
+        name"""
+        with self._lock:
+            self._in_use.pop(segment.name, None)
+        destroy_segment(segment)
+        return segment.name
+
+    def close(self, hand_over_in_use=False):
+        """Destroys all of the segments, including any in use unless hand_over_in_use is True, in which case they are
+        left for the other process to destroy (as it may not have read them yet)"""
+        with self._lock:
+            self._closed = True
+            segments = self._free
+            in_use = list(self._in_use.values())
+            self._free = []
+            self._free_bytes = 0
+            self._in_use = {}
+        if hand_over_in_use:
+            for segment in in_use:
+                _untrack(segment)
+                segment.close()
+        else:
+            segments += in_use
+        for segment in segments:
+            destroy_segment(segment)
+
+
+class AttachedSegments(object):
+    """Segments owned by another process that this one has attached to, which stay attached (as the other process
+    reuses them) until it says that they have been destroyed"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._segments = {}
+        self._closing = []
+
+    def get_buffer(self, name, offset, length):
+        """Returns a memoryview of part of a segment, without copying it"""
+        with self._lock:
+            segment = self._segments.get(name)
+            if segment is None:
+                segment = self._segments[name] = attach_segment(name)
+        return segment.buf[offset:offset + length]
+
+    def detach(self, names):
+        with self._lock:
+            segments = [self._segments.pop(name) for name in names if name in self._segments] + self._closing
+            self._closing = []
+        still_in_use = []
+        for segment in segments:
+            try:
+                segment.close()
+            except BufferError:
+                #A method has kept a view of one of its params; try again next time
+                still_in_use.append(segment)
+        if still_in_use:
+            with self._lock:
+                self._closing.extend(still_in_use)
+
+    def close(self):
+        with self._lock:
+            names = list(self._segments)
+        self.detach(names)
+
+
+def _payload_view(obj, threshold):
+    """Returns a flat memoryview of obj if it is a bytes-like object (or numpy array) of at least threshold bytes"""
+    if numpy is not None and isinstance(obj, numpy.ndarray):
+        if obj.dtype.hasobject or obj.nbytes < threshold:
+            return None
+        return memoryview(numpy.ascontiguousarray(obj)).cast('B')
+    if not isinstance(obj, (bytes, bytearray, memoryview)):
+        return None
+    view = memoryview(obj)
+    if view.nbytes < threshold:
+        return None
+    if not view.c_contiguous:
+        view = memoryview(view.tobytes())
+    return view.cast('B') if view.ndim != 1 or view.format != 'B' else view
+
+
+def encode_payloads(obj, threshold, allocate, segments):
+    """Returns obj with each bytes-like object (or numpy array) of at least threshold bytes in it (including in lists,
+    tuples and dict values) replaced by the descriptor of a copy of it in a segment from allocate(size), which is added
+    to segments (for the caller to release, even if this fails)"""
+    view = _payload_view(obj, threshold)
+    if view is not None:
+        segment = allocate(view.nbytes)
+        segments.append(segment)
+        segment.buf[:view.nbytes] = view
+        descriptor = {DESCRIPTOR_KEY: segment.name, "offset": 0, "length": view.nbytes}
+        if numpy is not None and isinstance(obj, numpy.ndarray):
+            descriptor["dtype"] = obj.dtype.str
+            descriptor["shape"] = list(obj.shape)
+        return descriptor
+    if isinstance(obj, dict):
+        encoded = {k: encode_payloads(v, threshold, allocate, segments) for k, v in obj.items()}
+        return encoded if any(encoded[k] is not v for k, v in obj.items()) else obj
+    if isinstance(obj, (list, tuple)):
+        encoded = [encode_payloads(v, threshold, allocate, segments) for v in obj]
+        return encoded if any(e is not v for e, v in zip(encoded, obj)) else obj
+    return obj
+
+
+def decode_payloads(obj, get_buffer, copy=False):
+    """Returns obj with each descriptor in it replaced by its payload, from get_buffer(name, offset, length). Unless
+    copy is True, payloads are memoryviews (or numpy arrays) of the buffers rather than bytes (or arrays) of their own"""
+    if isinstance(obj, dict):
+        if DESCRIPTOR_KEY in obj:
+            return _decode_payload(obj, get_buffer, copy)
+        return {k: decode_payloads(v, get_buffer, copy) for k, v in obj.items()}
+    if isinstance(obj, list):
+        return [decode_payloads(v, get_buffer, copy) for v in obj]
+    return obj
+
+
+def _decode_payload(descriptor, get_buffer, copy):
+    buf = get_buffer(descriptor[DESCRIPTOR_KEY], descriptor["offset"], descriptor["length"])
+    if "dtype" in descriptor:
+        if numpy is None:
+            raise ValueError("A numpy array was passed in shared memory, but numpy is not installed")
+        array = numpy.frombuffer(buf, dtype=descriptor["dtype"]).reshape(descriptor["shape"])
+        return array.copy() if copy else array
+    return bytes(buf) if copy else buf
+
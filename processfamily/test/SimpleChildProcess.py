@@ -0,0 +1,87 @@
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+from __future__ import unicode_literals
+from future import standard_library
+standard_library.install_aliases()
+from builtins import *
+
+import argparse
+import ctypes
+import logging
+import os
+import threading
+import time
+
+from processfamily import ChildProcess, start_child_process
+
+class SimpleChildProcess(ChildProcess):
+    """A minimal child process (used by the unit tests and benchmarks) that waits to be told to stop"""
+
+    def init(self):
+        self._stop_event = threading.Event()
+
+    def run(self):
+        while not self._stop_event.is_set():
+            self._stop_event.wait(1)
+
+    def stop(self, timeout=None):
+        self._stop_event.set()
+
+    def register_rpc_methods(self, dispatcher):
+        dispatcher["echo"] = self.echo
+        dispatcher["sleep"] = self.sleep
+        dispatcher["fail"] = self.fail
+        dispatcher["getpid"] = os.getpid
+        dispatcher["start_stuck_thread"] = self.start_stuck_thread
+        dispatcher["hold_gil"] = self.hold_gil
+        dispatcher["read_fds"] = self.read_fds
+
+    def echo(self, *args, **kwargs):
+        return kwargs if kwargs else list(args)
+
+    def sleep(self, seconds):
+        time.sleep(seconds)
+        return seconds
+
+    def fail(self, message):
+        raise ValueError(message)
+
+    def read_fds(self, fds):
+        """Reads each of the file descriptors passed with the call to the end, and closes them"""
+        contents = []
+        for fd in fds:
+            with os.fdopen(fd, 'rb') as f:
+                contents.append(f.read().decode('utf8'))
+        return contents
+
+    def hold_gil(self, seconds):
+        #Using a PyDLL here instead of a CDLL means that the GIL is held during the call
+        ctypes.PyDLL(None).usleep(int(seconds * 1000000))
+        return seconds
+
+    def start_stuck_thread(self):
+        """Starts a non-daemon thread that ignores stop(), so it has to be forced to stop"""
+        def stuck():
+            while True:
+                time.sleep(0.05)
+        thread = threading.Thread(target=stuck, name="stuck")
+        thread.daemon = False
+        thread.start()
+        return 0
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.WARNING)
+    arg_parser = argparse.ArgumentParser(description='SimpleChildProcess')
+    arg_parser.add_argument('--rpc_dispatch_pool_size', type=int)
+    arg_parser.add_argument('--rpc_dispatch_queue_size', type=int)
+    arg_parser.add_argument('--watchdog_interval', type=float)
+    args = arg_parser.parse_args()
+    if args.rpc_dispatch_pool_size:
+        SimpleChildProcess.RPC_DISPATCH_POOL_SIZE = args.rpc_dispatch_pool_size
+    if args.rpc_dispatch_queue_size:
+        SimpleChildProcess.RPC_DISPATCH_QUEUE_SIZE = args.rpc_dispatch_queue_size
+    if args.watchdog_interval:
+        SimpleChildProcess.WATCHDOG_INTERVAL = args.watchdog_interval
+        SimpleChildProcess.WATCHDOG_STALL_THRESHOLD = 0.2
+    start_child_process(SimpleChildProcess())
@@ -0,0 +1,70 @@
+# -*- coding: utf-8 -*-
+"""Measures how many small RPC requests per second a single child can handle, with a thread per request and with a
+dispatch pool (and with calls written in batches), keeping a number of calls in flight so that the child (rather
+than the round trip) is the limit.
+
+Run with: python -m processfamily.test.benchmarks.dispatch_benchmark --calls 20000"""
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+from __future__ import unicode_literals
+from future import standard_library
+standard_library.install_aliases()
+from builtins import range
+from builtins import *
+
+import argparse
+import collections
+import logging
+import time
+
+import processfamily
+
+class BenchmarkProcessFamily(processfamily.ProcessFamily):
+    CPU_AFFINITY_STRATEGY = processfamily.CPU_AFFINITY_STRATEGY_INHERIT
+
+    def __init__(self, child_args, batch_interval):
+        self.child_args = child_args
+        self.RPC_BATCH_INTERVAL = batch_interval
+        super(BenchmarkProcessFamily, self).__init__(
+            child_process_module_name='processfamily.test.SimpleChildProcess',
+            number_of_child_processes=1)
+
+    def get_child_process_cmd(self, child_number):
+        return super(BenchmarkProcessFamily, self).get_child_process_cmd(child_number) + self.child_args
+
+def measure(child_args, batch_interval, method, params, calls, in_flight):
+    family = BenchmarkProcessFamily(child_args, batch_interval)
+    family.start(timeout=60)
+    try:
+        futures = collections.deque()
+        start_time = time.time()
+        for i in range(calls):
+            futures.append(family.call(0, method, params))
+            if len(futures) >= in_flight:
+                futures.popleft().result(60)
+        for f in futures:
+            f.result(60)
+        return calls / (time.time() - start_time)
+    finally:
+        family.stop(timeout=10)
+
+def main():
+    arg_parser = argparse.ArgumentParser(description='ProcessFamily child RPC dispatch benchmark')
+    arg_parser.add_argument('--calls', type=int, default=20000)
+    arg_parser.add_argument('--in_flight', type=int, default=1000, help='The number of calls to keep in flight')
+    arg_parser.add_argument('--repeat', type=int, default=3)
+    args = arg_parser.parse_args()
+    logging.basicConfig(level=logging.ERROR)
+
+    print("%-8s %-24s %12s" % ("method", "dispatch", "requests/s"))
+    pool_args = ["--rpc_dispatch_pool_size", "4"]
+    for dispatch, child_args, batch_interval in (("thread per request", [], None), ("pool of 4", pool_args, None),
+                                                 ("pool of 4, batched", pool_args, 0.001)):
+        for method, params in (("ping", None), ("echo", {"key": "value", "items": list(range(10))})):
+            rates = [measure(child_args, batch_interval, method, params, args.calls, args.in_flight)
+                     for i in range(args.repeat)]
+            print("%-8s %-24s %12.0f" % (method, dispatch, max(rates)))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,100 @@
+# -*- coding: utf-8 -*-
+"""Measures the throughput of echo calls with bulk payloads over the JSON lines protocol, JSON over a unix socket, and
+binary frames with each available serializer, and with blobs passed in shared memory. Blobs are sent as bytes in frames
+and shared memory, and base64 encoded (and decoded again in the parent) over JSON, as they would have to be.
+
+Run with: python -m processfamily.test.benchmarks.framing_benchmark --size 1000000 --calls 200"""
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+from __future__ import unicode_literals
+from future import standard_library
+standard_library.install_aliases()
+from builtins import range
+from builtins import *
+
+import argparse
+import base64
+import logging
+import os
+import time
+
+import processfamily
+from processfamily import framing
+from processfamily import shm
+
+class BenchmarkProcessFamily(processfamily.ProcessFamily):
+    CPU_AFFINITY_STRATEGY = processfamily.CPU_AFFINITY_STRATEGY_INHERIT
+
+    def __init__(self, number_of_child_processes, comms_strategy, serializer, shm_threshold):
+        self.CHILD_COMMS_STRATEGY = comms_strategy
+        self.BINARY_RPC_SERIALIZER = serializer
+        self.SHARED_MEMORY_THRESHOLD = shm_threshold
+        super(BenchmarkProcessFamily, self).__init__(
+            child_process_module_name='processfamily.test.SimpleChildProcess',
+            number_of_child_processes=number_of_child_processes)
+
+def measure(number_of_child_processes, comms_strategy, serializer, shm_threshold, payload_kind, size, calls, in_flight):
+    family = BenchmarkProcessFamily(number_of_child_processes, comms_strategy, serializer, shm_threshold)
+    family.start(timeout=60)
+    try:
+        if payload_kind == "floats":
+            payload = [float(i) for i in range(size // 8)]
+        else:
+            payload = os.urandom(size)
+        binary = comms_strategy is processfamily.CHILD_COMMS_STRATEGY_PROCESSFAMILY_BINARY_RPC_PROTOCOL or shm_threshold
+        start_time = time.time()
+        futures = []
+        for i in range(calls):
+            if payload_kind == "blob" and not binary:
+                params = [base64.b64encode(payload).decode('ascii')]
+            else:
+                params = [payload]
+            futures.append(family.call(i % number_of_child_processes, "echo", params))
+            if len(futures) >= in_flight:
+                result = futures.pop(0).result(60)
+                if payload_kind == "blob" and not binary:
+                    base64.b64decode(result[0])
+        for f in futures:
+            result = f.result(60)
+            if payload_kind == "blob" and not binary:
+                base64.b64decode(result[0])
+        return time.time() - start_time
+    finally:
+        family.stop(timeout=10)
+
+def main():
+    arg_parser = argparse.ArgumentParser(description='ProcessFamily JSON lines vs binary frames throughput benchmark')
+    arg_parser.add_argument('--children', type=int, default=2)
+    arg_parser.add_argument('--size', type=int, default=1000000, help='The size of each payload in bytes')
+    arg_parser.add_argument('--calls', type=int, default=200)
+    arg_parser.add_argument('--in_flight', type=int, default=8, help='The number of calls to keep in flight')
+    args = arg_parser.parse_args()
+    logging.basicConfig(level=logging.ERROR)
+
+    protocols = [("json lines", processfamily.CHILD_COMMS_STRATEGY_PROCESSFAMILY_RPC_PROTOCOL, None, None),
+                 ("json/unix socket", processfamily.CHILD_COMMS_STRATEGY_PROCESSFAMILY_UNIX_SOCKET_RPC_PROTOCOL, None, None)]
+    for name in sorted(framing.SERIALIZERS):
+        try:
+            framing.get_serializer(name)
+        except ValueError as e:
+            print("Skipping %s: %s" % (name, e))
+            continue
+        protocols.append(("frames/%s" % name, processfamily.CHILD_COMMS_STRATEGY_PROCESSFAMILY_BINARY_RPC_PROTOCOL, name,
+                          None))
+    if shm.is_available():
+        protocols.append(("json/shared mem", processfamily.CHILD_COMMS_STRATEGY_PROCESSFAMILY_RPC_PROTOCOL, None, 65536))
+
+    print("%-8s %-16s %12s %12s" % ("payload", "protocol", "calls/s", "MB/s"))
+    for payload_kind in ("floats", "blob"):
+        for name, comms_strategy, serializer, shm_threshold in protocols:
+            if shm_threshold and payload_kind != "blob":
+                #Only bytes-like objects (and numpy arrays) are passed in shared memory
+                continue
+            duration = measure(args.children, comms_strategy, serializer, shm_threshold, payload_kind, args.size,
+                               args.calls, args.in_flight)
+            print("%-8s %-16s %12.1f %12.1f" % (payload_kind, name, args.calls / duration,
+                                                 2 * args.calls * args.size / duration / 1000000))
+
+if __name__ == '__main__':
+    main()
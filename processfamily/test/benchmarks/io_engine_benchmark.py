@@ -0,0 +1,82 @@
+# -*- coding: utf-8 -*-
+"""Compares the thread-per-pipe model of reading child output with the single threaded I/O multiplexer: parent thread
+count, parent RSS, and RPC round trip latency.
+
+Run with: python -m processfamily.test.benchmarks.io_engine_benchmark --children 128"""
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+from __future__ import unicode_literals
+from future import standard_library
+standard_library.install_aliases()
+from builtins import range
+from builtins import *
+
+import argparse
+import logging
+import threading
+import time
+
+import processfamily
+
+class BenchmarkProcessFamily(processfamily.ProcessFamily):
+    CPU_AFFINITY_STRATEGY = processfamily.CPU_AFFINITY_STRATEGY_INHERIT
+    ECHO_STD_ERR = True
+    SPAWN_WORKERS = 16
+    LINUX_USE_PREEXEC_FN = False
+
+    def __init__(self, number_of_child_processes, use_io_multiplexer):
+        self.USE_IO_MULTIPLEXER = use_io_multiplexer
+        super(BenchmarkProcessFamily, self).__init__(
+            child_process_module_name='processfamily.test.SimpleChildProcess',
+            number_of_child_processes=number_of_child_processes)
+
+    def handle_sys_err_line(self, child_index, line):
+        #stderr is piped so that it has to be read, but the output itself is not interesting here
+        pass
+
+def get_rss_kb():
+    with open("/proc/self/status") as f:
+        for line in f:
+            if line.startswith("VmRSS:"):
+                return int(line.split()[1])
+
+def percentile(values, p):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p / 100.0))]
+
+def measure(number_of_child_processes, use_io_multiplexer, calls):
+    family = BenchmarkProcessFamily(number_of_child_processes, use_io_multiplexer)
+    family.start(timeout=120)
+    try:
+        threads = threading.active_count()
+        rss_kb = get_rss_kb()
+        latencies = []
+        for i in range(calls):
+            start_time = time.time()
+            family.call(i % number_of_child_processes, "echo", [i]).result(30)
+            latencies.append(time.time() - start_time)
+        start_time = time.time()
+        futures = [family.call(i % number_of_child_processes, "echo", [i]) for i in range(calls)]
+        for f in futures:
+            f.result(30)
+        throughput = calls / (time.time() - start_time)
+        return threads, rss_kb, latencies, throughput
+    finally:
+        family.stop(timeout=30)
+
+def main():
+    arg_parser = argparse.ArgumentParser(description='ProcessFamily I/O engine benchmark')
+    arg_parser.add_argument('--children', type=int, default=32)
+    arg_parser.add_argument('--calls', type=int, default=2000)
+    args = arg_parser.parse_args()
+    logging.basicConfig(level=logging.WARNING)
+
+    print("%-12s %8s %10s %10s %10s %12s" % ("engine", "threads", "RSS (KB)", "p50 (ms)", "p99 (ms)", "calls/s"))
+    for name, use_io_multiplexer in (("threads", False), ("multiplexer", True)):
+        threads, rss_kb, latencies, throughput = measure(args.children, use_io_multiplexer, args.calls)
+        print("%-12s %8d %10d %10.3f %10.3f %12.0f" % (
+            name, threads, rss_kb, 1000 * percentile(latencies, 50), 1000 * percentile(latencies, 99), throughput))
+
+if __name__ == '__main__':
+    main()
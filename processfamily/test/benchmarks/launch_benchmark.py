@@ -0,0 +1,64 @@
+# -*- coding: utf-8 -*-
+"""Compares the time taken to launch a child process with a preexec_fn (which forces subprocess to fork the whole
+parent) against the launch shim (which lets subprocess use vfork), with a large parent heap.
+
+Run with: python -m processfamily.test.benchmarks.launch_benchmark --parent-rss-mb 4096"""
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+from __future__ import unicode_literals
+from future import standard_library
+standard_library.install_aliases()
+from builtins import range
+from builtins import *
+
+import argparse
+import logging
+import mmap
+import time
+
+import processfamily
+
+class BenchmarkProcessFamily(processfamily.ProcessFamily):
+    CPU_AFFINITY_STRATEGY = processfamily.CPU_AFFINITY_STRATEGY_INHERIT
+
+    def __init__(self, use_preexec_fn):
+        self.LINUX_USE_PREEXEC_FN = use_preexec_fn
+        super(BenchmarkProcessFamily, self).__init__(
+            child_process_module_name='processfamily.test.SimpleChildProcess',
+            number_of_child_processes=1)
+
+def allocate_heap(size_mb):
+    """Allocates and touches size_mb of memory, so that it is all mapped into the page tables"""
+    heap = bytearray(size_mb * 1024 * 1024)
+    for offset in range(0, len(heap), mmap.PAGESIZE):
+        heap[offset] = 1
+    return heap
+
+def time_launches(use_preexec_fn, launches):
+    family = BenchmarkProcessFamily(use_preexec_fn)
+    timings = []
+    for i in range(launches):
+        start_time = time.time()
+        p = family._launch_child_process(0)
+        timings.append(time.time() - start_time)
+        p.kill()
+        p.wait()
+    return timings
+
+def main():
+    arg_parser = argparse.ArgumentParser(description='ProcessFamily launch benchmark')
+    arg_parser.add_argument('--parent-rss-mb', type=int, default=2048)
+    arg_parser.add_argument('--launches', type=int, default=10)
+    args = arg_parser.parse_args()
+    logging.basicConfig(level=logging.WARNING)
+
+    heap = allocate_heap(args.parent_rss_mb)
+    print("Parent heap: %d MB" % (len(heap) // (1024 * 1024)))
+    print("%-14s %10s %10s" % ("launch path", "mean (ms)", "max (ms)"))
+    for name, use_preexec_fn in (("preexec_fn", True), ("launch shim", False)):
+        timings = time_launches(use_preexec_fn, args.launches)
+        print("%-14s %10.2f %10.2f" % (name, 1000 * sum(timings) / len(timings), 1000 * max(timings)))
+
+if __name__ == '__main__':
+    main()
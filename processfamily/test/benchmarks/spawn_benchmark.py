@@ -0,0 +1,58 @@
+# -*- coding: utf-8 -*-
+"""Measures the time taken for ProcessFamily.start() to return (i.e. for every child to answer wait_for_start)
+against the number of children, for serial and concurrent spawning.
+
+Run with: python -m processfamily.test.benchmarks.spawn_benchmark --counts 1,4,16,64
+Add --fork-server to launch the children from a fork server (Linux only)"""
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+from __future__ import unicode_literals
+from future import standard_library
+standard_library.install_aliases()
+from builtins import *
+
+import argparse
+import logging
+import time
+
+import processfamily
+
+class BenchmarkProcessFamily(processfamily.ProcessFamily):
+    CPU_AFFINITY_STRATEGY = processfamily.CPU_AFFINITY_STRATEGY_CHILDREN_ONLY
+
+    def __init__(self, number_of_child_processes, spawn_workers, fork_server=False):
+        self.SPAWN_WORKERS = spawn_workers
+        self.LINUX_USE_FORK_SERVER = fork_server
+        super(BenchmarkProcessFamily, self).__init__(
+            child_process_module_name='processfamily.test.SimpleChildProcess',
+            number_of_child_processes=number_of_child_processes)
+
+def time_to_all_ready(number_of_child_processes, spawn_workers, timeout, fork_server=False):
+    family = BenchmarkProcessFamily(number_of_child_processes, spawn_workers, fork_server)
+    start_time = time.time()
+    try:
+        family.start(timeout=timeout)
+        return time.time() - start_time
+    finally:
+        family.stop(timeout=timeout)
+
+def main():
+    arg_parser = argparse.ArgumentParser(description='ProcessFamily spawn benchmark')
+    arg_parser.add_argument('--counts', default='1,2,4,8,16', help='comma separated child counts to measure')
+    arg_parser.add_argument('--workers', type=int, default=0, help='concurrent spawn workers (0 means one per child)')
+    arg_parser.add_argument('--repeat', type=int, default=3)
+    arg_parser.add_argument('--timeout', type=int, default=120)
+    arg_parser.add_argument('--fork-server', action='store_true', help='launch children from a fork server')
+    args = arg_parser.parse_args()
+    logging.basicConfig(level=logging.WARNING)
+
+    print("%8s %12s %12s %8s" % ("children", "serial (s)", "parallel (s)", "speedup"))
+    for count in [int(c) for c in args.counts.split(',')]:
+        workers = args.workers or count
+        serial = min(time_to_all_ready(count, 1, args.timeout, args.fork_server) for _ in range(args.repeat))
+        parallel = min(time_to_all_ready(count, workers, args.timeout, args.fork_server) for _ in range(args.repeat))
+        print("%8d %12.3f %12.3f %7.2fx" % (count, serial, parallel, serial / parallel))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,60 @@
+# -*- coding: utf-8 -*-
+"""Measures the latency from ProcessFamily.stop to the children exiting, for children that stop cleanly and for
+children with a non-daemon thread that ignores stop() (so the child host has to force it to stop), and how many of
+them the parent had to kill.
+
+Run with: python -m processfamily.test.benchmarks.stop_benchmark --children 8 --timeout 5"""
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+from __future__ import unicode_literals
+from future import standard_library
+standard_library.install_aliases()
+from builtins import range
+from builtins import *
+
+import argparse
+import logging
+import time
+
+import processfamily
+
+class BenchmarkProcessFamily(processfamily.ProcessFamily):
+    CPU_AFFINITY_STRATEGY = processfamily.CPU_AFFINITY_STRATEGY_INHERIT
+    SPAWN_WORKERS = 8
+
+    def __init__(self, number_of_child_processes):
+        super(BenchmarkProcessFamily, self).__init__(
+            child_process_module_name='processfamily.test.SimpleChildProcess',
+            number_of_child_processes=number_of_child_processes)
+
+def measure(number_of_child_processes, stuck_threads, timeout):
+    family = BenchmarkProcessFamily(number_of_child_processes)
+    family.start(timeout=60)
+    if stuck_threads:
+        for i in range(number_of_child_processes):
+            family.call(i, "start_stuck_thread").result(10)
+    start_time = time.time()
+    killed = family.stop(timeout=timeout)
+    return time.time() - start_time, killed
+
+def main():
+    arg_parser = argparse.ArgumentParser(description='ProcessFamily stop latency benchmark')
+    arg_parser.add_argument('--children', type=int, default=4)
+    arg_parser.add_argument('--timeout', type=float, default=5, help='The stop timeout given to ProcessFamily.stop')
+    arg_parser.add_argument('--repeat', type=int, default=3)
+    args = arg_parser.parse_args()
+    logging.basicConfig(level=logging.ERROR)
+
+    print("%-14s %12s %12s %8s" % ("children", "mean (s)", "max (s)", "killed"))
+    for name, stuck_threads in (("clean", False), ("stuck thread", True)):
+        durations = []
+        killed = 0
+        for i in range(args.repeat):
+            duration, k = measure(args.children, stuck_threads, args.timeout)
+            durations.append(duration)
+            killed += k
+        print("%-14s %12.3f %12.3f %8d" % (name, sum(durations) / len(durations), max(durations), killed))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,622 @@
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+from __future__ import unicode_literals
+
+from future import standard_library
+
+standard_library.install_aliases()
+from builtins import range
+from builtins import *
+
+import json
+import os
+import signal
+import sys
+import threading
+import time
+import urllib.request
+import pytest
+
+import processfamily
+from processfamily import framing
+from processfamily import tracing
+from processfamily.autoscale import Autoscaler, CPUUtilisationMetric, pending_calls_metric
+from processfamily.processes import process_exists
+from processfamily.threads import stop_threads_parallel
+from processfamily.profiler import SamplingProfiler, TRUNCATED_STACK
+from processfamily.prometheus import PrometheusExporter
+
+
+class SimpleProcessFamily(processfamily.ProcessFamily):
+    # These tests run the family from within the test process, so the affinity of the test process is left alone
+    CPU_AFFINITY_STRATEGY = processfamily.CPU_AFFINITY_STRATEGY_INHERIT
+
+    def __init__(self, number_of_child_processes=2, child_args=None, **class_overrides):
+        self.child_args = child_args or []
+        for name, value in class_overrides.items():
+            setattr(self, name, value)
+        super(SimpleProcessFamily, self).__init__(
+            child_process_module_name='processfamily.test.SimpleChildProcess',
+            number_of_child_processes=number_of_child_processes)
+
+    def get_child_process_cmd(self, child_number):
+        return super(SimpleProcessFamily, self).get_child_process_cmd(child_number) + self.child_args
+
+
+@pytest.fixture()
+def family_factory():
+    families = []
+
+    def create(*args, **kwargs):
+        family = SimpleProcessFamily(*args, **kwargs)
+        families.append(family)
+        return family
+    yield create
+    for family in families:
+        family.stop(timeout=10)
+
+
+@pytest.mark.skipif(sys.platform.startswith('win'), reason="Unix only")
+class TestSpawn(object):
+
+    @pytest.mark.parametrize("spawn_workers", [1, 4])
+    def test_start_and_stop(self, family_factory, spawn_workers):
+        family = family_factory(4, SPAWN_WORKERS=spawn_workers)
+        family.start(timeout=30)
+        assert [c.child_index for c in family.child_processes] == list(range(4))
+        # The children must outlive the threads that launched them (which would send them their pdeathsig)
+        time.sleep(0.5)
+        assert not [c for c in family.child_processes if c.is_stopped()]
+        pids = [c.pid for c in family.child_processes]
+        assert family.stop(timeout=10) == 0
+        assert not [pid for pid in pids if process_exists(pid)]
+
+    def test_concurrent_spawn_reports_errors(self, family_factory):
+        family = family_factory(4, SPAWN_WORKERS=4)
+        original_launch = family._launch_child_process
+
+        def launch_child_process(i):
+            if i == 2:
+                raise OSError("Cannot launch this one")
+            return original_launch(i)
+        family._launch_child_process = launch_child_process
+        with pytest.raises(processfamily.ChildSpawnError) as exc_info:
+            family.start(timeout=30)
+        assert list(exc_info.value.errors) == [2]
+        assert [c.child_index for c in family.child_processes] == [0, 1, 3]
+
+    def test_fork_server(self, family_factory):
+        family = family_factory(3, LINUX_USE_FORK_SERVER=True)
+        family.start(timeout=30)
+        fork_server = family._fork_server
+        assert fork_server is not None
+        pids = [c.pid for c in family.child_processes]
+        for pid in pids:
+            with open("/proc/%d/stat" % pid) as f:
+                # The children are forked from the template process rather than from this one
+                assert int(f.read().rsplit(")", 1)[1].split()[1]) == fork_server.pid
+        assert family.stop(timeout=10) == 0
+        assert family._fork_server is None
+        assert not [pid for pid in pids if process_exists(pid)]
+
+    def test_launch_without_preexec_fn(self, family_factory):
+        family = family_factory(2, LINUX_USE_PREEXEC_FN=False)
+        family.start(timeout=30)
+        for c in family.child_processes:
+            # The child must still be the leader of its own process group
+            assert os.getpgid(c.pid) == c.pid
+        assert family.stop(timeout=10) == 0
+
+    @pytest.mark.parametrize("use_io_multiplexer", [False, True])
+    def test_exit_callback(self, family_factory, use_io_multiplexer):
+        family = family_factory(2, USE_IO_MULTIPLEXER=use_io_multiplexer)
+        family.start(timeout=30)
+        child = family.get_child(0)
+        assert child.exit_detection is not None
+        exited = threading.Event()
+        family.add_child_exit_callback(0, lambda c: exited.set())
+        os.kill(child.pid, signal.SIGKILL)
+        assert exited.wait(10)
+        assert child.is_stopped()
+        assert child._process_instance.returncode == -signal.SIGKILL
+        # A callback added after the exit is called straight away
+        called = []
+        child.add_exit_callback(called.append)
+        assert called == [child]
+
+    def test_lifecycle_events(self, family_factory, tmp_path):
+        family = family_factory(2, CPU_AFFINITY_STRATEGY=processfamily.CPU_AFFINITY_STRATEGY_NONE)
+        events = []
+        family.add_lifecycle_callback(events.append)
+        family.start(timeout=30)
+        assert family.stop(timeout=10) == 0
+        assert family.get_lifecycle_events() == events
+        for i in range(2):
+            names = [e.name for e in events if e.child_index == i]
+            assert names == [tracing.SPAWN_REQUESTED, tracing.POPEN_RETURNED, tracing.AFFINITY_SET,
+                             tracing.STARTUP_PING_SENT, tracing.READY, tracing.STOP_SENT, tracing.STOP_ACKED,
+                             tracing.EXITED]
+            timestamps = [e.timestamp for e in events if e.child_index == i]
+            assert timestamps == sorted(timestamps)
+        path = str(tmp_path / "trace.json")
+        family.write_chrome_trace(path)
+        with open(path) as f:
+            trace = json.load(f)
+        spans = [e for e in trace["traceEvents"] if e["ph"] == "X"]
+        assert sorted(e["name"] for e in spans if e["tid"] == 0) == ["affinity", "shutdown", "spawn", "startup", "stop"]
+        assert all(e["dur"] >= 0 for e in spans)
+
+    def test_stop_forces_stuck_threads_within_timeout(self, family_factory):
+        family = family_factory(2)
+        family.start(timeout=30)
+        for i in range(2):
+            family.call(i, "start_stuck_thread").result(10)
+        start_time = time.time()
+        # The child hosts force the stuck threads to stop before the parent would have to kill them
+        assert family.stop(timeout=4) == 0
+        assert time.time() - start_time < 4
+
+
+def wait_for(condition, timeout=10):
+    end_time = time.time() + timeout
+    while not condition():
+        if time.time() > end_time:
+            return False
+        time.sleep(0.05)
+    return True
+
+
+@pytest.mark.skipif(sys.platform.startswith('win'), reason="Unix only")
+class TestSupervision(object):
+
+    def test_restart(self, family_factory):
+        family = family_factory(2, SUPERVISE_CHILDREN=True, RESTART_BACKOFF_INITIAL=0.05)
+        family.start(timeout=30)
+        old_pid = family.get_child(0).pid
+        other_pid = family.get_child(1).pid
+        os.kill(old_pid, signal.SIGKILL)
+        assert wait_for(lambda: family.get_child(0).pid != old_pid)
+        assert [c.child_index for c in family.child_processes] == [0, 1]
+        assert family.get_child(1).pid == other_pid
+        assert family.restart_counts == {0: 1}
+        assert family.call(0, "echo", ["restarted"]).result(10) == ["restarted"]
+        pids = [c.pid for c in family.child_processes]
+        assert family.stop(timeout=10) == 0
+        assert not [pid for pid in pids if process_exists(pid)]
+        assert family.restart_counts == {0: 1}
+
+    def test_crash_loop(self, family_factory):
+        family = family_factory(1, SUPERVISE_CHILDREN=True, RESTART_BACKOFF_INITIAL=0.05, CRASH_LOOP_MAX_RESTARTS=1)
+        family.start(timeout=30)
+        old_pid = family.get_child(0).pid
+        os.kill(old_pid, signal.SIGKILL)
+        assert wait_for(lambda: family.get_child(0).pid != old_pid)
+        os.kill(family.get_child(0).pid, signal.SIGKILL)
+        assert wait_for(lambda: family.crash_looping_children == {0})
+        assert family.restart_counts == {0: 1}
+        assert family.get_child(0).is_stopped()
+
+    def test_spare_promotion(self, family_factory):
+        family = family_factory(2, NUMBER_OF_SPARE_CHILDREN=1)
+        family.start(timeout=30)
+        assert [c.child_index for c in family.spare_children] == [2]
+        spare_pid = family.spare_children[0].pid
+        os.kill(family.get_child(0).pid, signal.SIGKILL)
+        assert wait_for(lambda: family.get_child(0).pid == spare_pid)
+        assert family.call(0, "echo", ["promoted"]).result(10) == ["promoted"]
+        assert family.restart_counts == {0: 1}
+        # A new spare is started in the background, with a fresh child index
+        assert wait_for(lambda: [c.child_index for c in family.spare_children] == [3])
+        pids = [c.pid for c in family.child_processes + family.spare_children]
+        assert family.stop(timeout=10) == 0
+        assert not [pid for pid in pids if process_exists(pid)]
+
+    @pytest.mark.parametrize("batch_size", [1, 2])
+    def test_rolling_restart(self, family_factory, batch_size):
+        family = family_factory(4, NUMBER_OF_SPARE_CHILDREN=1)
+        family.start(timeout=30)
+        old_pids = [c.pid for c in family.child_processes + family.spare_children]
+        running_counts = []
+        done = threading.Event()
+
+        def sample_capacity():
+            while not done.is_set():
+                running_counts.append(len([c for c in list(family.child_processes) if not c.is_stopped()]))
+                time.sleep(0.01)
+        sampler = threading.Thread(target=sample_capacity)
+        sampler.start()
+        try:
+            assert family.rolling_restart(batch_size=batch_size, timeout=10) == 0
+        finally:
+            done.set()
+            sampler.join()
+        assert min(running_counts) >= 4 - batch_size
+        assert [c.child_index for c in family.child_processes] == [0, 1, 2, 3]
+        assert [c.child_index for c in family.spare_children] == [4]
+        new_pids = [c.pid for c in family.child_processes + family.spare_children]
+        assert not set(new_pids) & set(old_pids)
+        assert not [pid for pid in old_pids if process_exists(pid)]
+        assert [family.call(i, "echo", [i]).result(10) for i in range(4)] == [[i] for i in range(4)]
+        # The stopped children were retired rather than replaced by a spare
+        assert family.restart_counts == {}
+
+    def test_recycle_after_calls(self, family_factory):
+        family = family_factory(2, RECYCLE_CALL_LIMIT=3, RECYCLE_CHECK_INTERVAL=0.1)
+        family.start(timeout=30)
+        old_pids = [c.pid for c in family.child_processes]
+        for i in range(3):
+            family.call(0, "echo", [i]).result(10)
+        assert wait_for(lambda: family.get_child(0).pid != old_pids[0] and not family.get_child(0).is_stopped())
+        assert family.recycle_counts == {0: 1}
+        assert family.get_child(1).pid == old_pids[1]
+        assert family.call(0, "echo", ["recycled"]).result(10) == ["recycled"]
+
+    def test_recycle_on_memory(self, family_factory):
+        family = family_factory(2, RECYCLE_MEMORY_LIMIT=10 * 1024 ** 3, RECYCLE_CHECK_INTERVAL=1000)
+        family.start(timeout=30)
+        memory_info = family.get_child_memory_info()
+        assert sorted(memory_info) == [0, 1]
+        assert memory_info[0]["rss"] > 0
+        assert family.get_children_to_recycle() == []
+        family.RECYCLE_MEMORY_LIMIT = 1024
+        assert family.get_children_to_recycle() == family.child_processes
+
+
+@pytest.mark.skipif(sys.platform.startswith('win'), reason="Unix only")
+class TestScaling(object):
+
+    def test_scale_to(self, family_factory):
+        family = family_factory(2, SUPERVISE_CHILDREN=True)
+        family.start(timeout=30)
+        assert family.scale_to(4, timeout=10) == 0
+        assert [c.child_index for c in family.child_processes] == [0, 1, 2, 3]
+        assert [family.call(i, "echo", [i]).result(10) for i in range(4)] == [[i] for i in range(4)]
+        retiring_pids = [family.get_child(i).pid for i in (2, 3)]
+        assert family.scale_to(1, timeout=10) == 0
+        assert [c.child_index for c in family.child_processes] == [0]
+        assert not [pid for pid in retiring_pids if process_exists(pid)]
+        # Retired children are not restarted by the supervisor, and new children get fresh indexes
+        assert family.restart_counts == {}
+        assert family.scale_to(2, timeout=10) == 0
+        assert [c.child_index for c in family.child_processes] == [0, 4]
+        assert family.number_of_child_processes == 2
+
+    def test_autoscaler(self, family_factory):
+        family = family_factory(1)
+        family.start(timeout=30)
+        load = [1.0]
+        autoscaler = Autoscaler(family, 1, 2, metric=lambda f: load[0], scale_down_checks=2)
+        assert autoscaler.check() == 2
+        assert autoscaler.check() is None
+        load[0] = 0.5
+        assert autoscaler.check() is None
+        load[0] = 0.0
+        assert autoscaler.check() is None
+        assert autoscaler.check() == 1
+        assert len(family.child_processes) == 1
+        assert autoscaler.check() is None
+
+    def test_metrics(self, family_factory):
+        family = family_factory(2)
+        family.start(timeout=30)
+        cpu_metric = CPUUtilisationMetric()
+        assert cpu_metric(family) is None
+        family.call(0, "sleep", [0.2]).result(10)
+        assert 0 <= cpu_metric(family) < 1.5
+        futures = [family.call(0, "sleep", [0.5]) for i in range(4)]
+        assert pending_calls_metric(family) == 2
+        for f in futures:
+            f.result(10)
+        assert pending_calls_metric(family) == 0
+
+    def test_child_metrics(self, family_factory):
+        family = family_factory(2)
+        family.start(timeout=30)
+        metrics = family.get_child_metrics()
+        assert sorted(metrics) == [0, 1]
+        assert metrics[0]["pid"] == family.get_child(0).pid
+        assert metrics[0]["cpu_percent"] is None
+        assert metrics[0]["rss"] > 1024 * 1024
+        assert metrics[0]["threads"] >= 2
+        assert metrics[0]["fds"] >= 3
+        assert metrics[0]["voluntary_ctxt_switches"] > 0
+        family.call(0, "hold_gil", [0.2]).result(10)
+        metrics = family.get_child_metrics()
+        assert metrics[0]["cpu_percent"] is not None and metrics[0]["cpu_percent"] >= 0
+        assert metrics[0]["read_bytes_per_sec"] is None or metrics[0]["read_bytes_per_sec"] >= 0
+        assert family.stop(timeout=10) == 0
+        assert family._metrics_collector is None
+
+    def test_prometheus_exporter(self, family_factory, tmp_path):
+        family = family_factory(2)
+        family.start(timeout=30)
+        family.call(0, "echo", [1]).result(10)
+        with pytest.raises(processfamily.RPCError):
+            family.call(0, "fail", ["oops"]).result(10)
+        exporter = PrometheusExporter(family)
+        try:
+            port = exporter.serve(0)
+            text = urllib.request.urlopen("http://127.0.0.1:%d/metrics" % port, timeout=10).read().decode("utf-8")
+            lines = text.splitlines()
+            assert "# TYPE processfamily_child_rpc_latency_seconds histogram" in lines
+            assert "processfamily_children_alive 2" in lines
+            assert 'processfamily_child_rpc_requests_total{child="0"} 2' in lines
+            assert 'processfamily_child_rpc_errors_total{child="0"} 1' in lines
+            assert 'processfamily_child_rpc_latency_seconds_bucket{child="0",le="+Inf"} 2' in lines
+            assert 'processfamily_child_rpc_latency_seconds_count{child="1"} 0' in lines
+            assert [l for l in lines if l.startswith('processfamily_child_resident_memory_bytes{child="1"} ')]
+            path = str(tmp_path / "processfamily.prom")
+            exporter.write_textfile(path)
+            with open(path) as f:
+                assert "processfamily_children 2" in f.read().splitlines()
+        finally:
+            exporter.stop()
+
+
+@pytest.mark.skipif(sys.platform.startswith('win'), reason="Unix only")
+class TestRPC(object):
+
+    @pytest.fixture()
+    def family(self, family_factory):
+        family = family_factory(2)
+        family.start(timeout=30)
+        return family
+
+    def test_call(self, family):
+        assert family.call(0, "echo", [1, "two"]).result(10) == [1, "two"]
+        assert family.call(1, "echo", {"a": 1}).result(10) == {"a": 1}
+        assert family.call(1, "getpid").result(10) == family.get_child(1).pid
+
+    def test_many_calls_in_flight(self, family):
+        futures = [family.call(i % 2, "sleep", [0.5]) for i in range(20)]
+        assert [f.result(10) for f in futures] == [0.5] * 20
+
+    def test_profiler(self, family):
+        assert family.call(0, "start_profiler", {"interval": 0.005}).result(10) == 0
+        family.call(0, "sleep", [0.5]).result(10)
+        result = family.call(0, "stop_profiler").result(10)
+        assert result["samples"] > 10
+        lines = result["collapsed_stacks"].splitlines()
+        assert sum(int(line.rsplit(" ", 1)[1]) for line in lines) >= result["samples"]
+        assert [line for line in lines if ";sleep (SimpleChildProcess.py:" in line]
+        assert family.call(0, "stop_profiler").result(10) is None
+
+    def test_watchdog_reports_stalls(self, family_factory):
+        stalls = []
+        family = family_factory(1, child_args=["--watchdog_interval", "0.05"],
+                                handle_child_notification=lambda i, method, params: stalls.append((i, method, params)))
+        family.start(timeout=30)
+        family.call(0, "sleep", [0.5]).result(10)
+        assert stalls == []
+        family.call(0, "hold_gil", [0.5]).result(10)
+        assert wait_for(lambda: stalls)
+        child_index, method, params = stalls[0]
+        assert (child_index, method) == (0, "stall")
+        assert params["latency"] > 0.3
+        thread_names = [t["thread"] for t in params["threads"]]
+        assert "MainThread" in thread_names
+        assert "pf_watchdog" not in thread_names
+
+    def test_heartbeat(self, family_factory):
+        changes = []
+        family = family_factory(2, HEARTBEAT_INTERVAL=0.05, HEARTBEAT_TIMEOUT=0.2, HEARTBEAT_MAX_MISSED=2,
+                                handle_child_health_change=lambda i, healthy: changes.append((i, healthy)))
+        family.start(timeout=30)
+        assert wait_for(lambda: family.get_child_health()[0]["samples"] >= 5)
+        health = family.get_child_health()[0]
+        assert health["healthy"] and health["missed_heartbeats"] == 0
+        assert 0 < health["p50"] <= health["p90"] <= health["p99"] < 0.2
+        call_count = family.get_child(0).call_count
+        # Nothing in the child can respond while it holds the GIL
+        family.call(0, "hold_gil", [1.5])
+        assert wait_for(lambda: changes == [(0, False)])
+        assert wait_for(lambda: changes == [(0, False), (0, True)])
+        assert family.get_child_health()[1]["healthy"]
+        # Heartbeats are not counted as calls
+        assert family.get_child(0).call_count == call_count + 1
+
+    def test_call_errors(self, family):
+        with pytest.raises(processfamily.RPCError) as exc_info:
+            family.call(0, "fail", ["oops"]).result(10)
+        assert "oops" in str(exc_info.value.data)
+        assert exc_info.value.code == processfamily.rpc.SERVER_ERROR
+        with pytest.raises(processfamily.RPCError) as exc_info:
+            family.call(0, "no_such_method").result(10)
+        assert exc_info.value.code == processfamily.rpc.METHOD_NOT_FOUND
+        with pytest.raises(processfamily.RPCError) as exc_info:
+            family.call(0, "sleep", [1, 2]).result(10)
+        assert exc_info.value.code == processfamily.rpc.INVALID_PARAMS
+        with pytest.raises(ValueError):
+            family.call(5, "echo")
+
+    def test_call_batch(self, family):
+        futures = family.call_batch(0, [("echo", [1]), ("fail", ["oops"]), ("sleep", [0.2]), ("no_such_method", None)])
+        assert futures[0].result(10) == [1]
+        with pytest.raises(processfamily.RPCError):
+            futures[1].result(10)
+        assert futures[2].result(10) == 0.2
+        with pytest.raises(processfamily.RPCError) as exc_info:
+            futures[3].result(10)
+        assert exc_info.value.code == processfamily.rpc.METHOD_NOT_FOUND
+
+    def test_batched_calls(self, family_factory):
+        family = family_factory(1, RPC_BATCH_INTERVAL=0.01, RPC_BATCH_MAX_SIZE=20)
+        family.start(timeout=30)
+        child = family.get_child(0)
+        writes = []
+        write_command_req = child._write_command_req
+        child._write_command_req = lambda req, **kwargs: (writes.append(req), write_command_req(req, **kwargs))[1]
+        futures = [family.call(0, "echo", [i]) for i in range(100)]
+        assert [f.result(10) for f in futures] == [[i] for i in range(100)]
+        assert len(writes) <= 10
+        # A call on its own is written after the interval
+        assert family.call(0, "echo", ["alone"]).result(10) == ["alone"]
+        assert family.stop(timeout=10) == 0
+
+    def test_call_timeout(self, family):
+        future = family.call(0, "sleep", [5], timeout=0.2)
+        with pytest.raises(processfamily.RPCTimeoutError):
+            future.result(10)
+        assert family.get_child(0).pending_call_count == 0
+
+    def test_call_child_terminated(self, family):
+        future = family.call(0, "sleep", [30])
+        os.kill(family.get_child(0).pid, signal.SIGKILL)
+        with pytest.raises(processfamily.ChildTerminatedError):
+            future.result(10)
+        with pytest.raises(processfamily.ChildTerminatedError):
+            family.call(0, "echo").result(10)
+
+    def test_dispatch_pool_rejects_when_busy(self, family_factory):
+        family = family_factory(1, child_args=['--rpc_dispatch_pool_size', '1', '--rpc_dispatch_queue_size', '1'])
+        family.start(timeout=30)
+        running = family.call(0, "sleep", [1])
+        # wait until the first call has been picked up by the only pool thread
+        while family.call(0, "get_dispatch_stats").result(10)["busy_workers"] < 1:
+            pass
+        queued = family.call(0, "sleep", [0])
+        with pytest.raises(processfamily.ServerBusyError):
+            family.call(0, "sleep", [0]).result(10)
+        assert running.result(10) == 1
+        assert queued.result(10) == 0
+        # the pool counts a call as completed just after its response has been sent
+        end_time = time.time() + 10
+        stats = family.call(0, "get_dispatch_stats").result(10)
+        while stats["completed"] < 3 and time.time() < end_time:
+            stats = family.call(0, "get_dispatch_stats").result(10)
+        assert stats["pool_size"] == 1
+        assert stats["rejected"] == 1
+        assert stats["completed"] == 3
+        assert stats["wait_time_max"] > 0.5
+
+    @pytest.mark.parametrize("use_io_multiplexer", [False, True])
+    def test_binary_frames(self, family_factory, use_io_multiplexer):
+        family = family_factory(2, CHILD_COMMS_STRATEGY=processfamily.CHILD_COMMS_STRATEGY_PROCESSFAMILY_BINARY_RPC_PROTOCOL,
+                                USE_IO_MULTIPLEXER=use_io_multiplexer)
+        family.start(timeout=30)
+        assert family.get_child(0)._frame_serializer.name == "pickle"
+        payload = [b"new\nlines", {"a": (1, 2)}]
+        assert family.call(0, "echo", payload).result(10) == payload
+        large = bytearray(os.urandom(3000000))
+        assert family.call(1, "echo", [large]).result(10) == [large]
+        futures = [family.call(i % 2, "echo", [i]) for i in range(100)]
+        assert [f.result(10) for f in futures] == [[i] for i in range(100)]
+        with pytest.raises(processfamily.RPCError):
+            family.call(0, "fail", ["oops"]).result(10)
+        futures = family.call_batch(1, [("echo", [b"\x00"]), ("echo", [b"\xff"])])
+        assert [f.result(10) for f in futures] == [[b"\x00"], [b"\xff"]]
+        assert family.stop(timeout=10) == 0
+
+    def test_binary_frames_fallback(self, family_factory):
+        family = family_factory(1, CHILD_COMMS_STRATEGY=processfamily.CHILD_COMMS_STRATEGY_PROCESSFAMILY_BINARY_RPC_PROTOCOL,
+                                BINARY_RPC_SERIALIZER="no_such_serializer")
+        family.start(timeout=30)
+        assert family.get_child(0)._frame_serializer is None
+        assert family.call(0, "echo", ["json"]).result(10) == ["json"]
+
+    @pytest.mark.skipif(framing.msgpack is None, reason="msgpack is not installed")
+    def test_binary_frames_msgpack(self, family_factory):
+        family = family_factory(1, CHILD_COMMS_STRATEGY=processfamily.CHILD_COMMS_STRATEGY_PROCESSFAMILY_BINARY_RPC_PROTOCOL,
+                                BINARY_RPC_SERIALIZER="msgpack")
+        family.start(timeout=30)
+        assert family.get_child(0)._frame_serializer.name == "msgpack"
+        assert family.call(0, "echo", [b"\x00\xff", "text"]).result(10) == [b"\x00\xff", "text"]
+
+    @pytest.mark.parametrize("family_kwargs", [{}, {"USE_IO_MULTIPLEXER": True}, {"LINUX_USE_FORK_SERVER": True}])
+    def test_unix_socket(self, family_factory, family_kwargs):
+        family = family_factory(2, CHILD_COMMS_STRATEGY=processfamily.CHILD_COMMS_STRATEGY_PROCESSFAMILY_UNIX_SOCKET_RPC_PROTOCOL,
+                                **family_kwargs)
+        family.start(timeout=30)
+        # Larger than a packet, and with new lines
+        large = "line\n" * 100000
+        assert family.call(0, "echo", [large]).result(10) == [large]
+        futures = family.call_batch(1, [("echo", [1]), ("echo", [2])])
+        assert [f.result(10) for f in futures] == [[1], [2]]
+        r, w = os.pipe()
+        os.write(w, b"passed")
+        os.close(w)
+        future = family.call_with_fds(1, "read_fds", fds=[r])
+        os.close(r)
+        assert future.result(10) == ["passed"]
+        assert family.stop(timeout=10) == 0
+
+    @pytest.mark.parametrize("comms_strategy", [processfamily.CHILD_COMMS_STRATEGY_PROCESSFAMILY_RPC_PROTOCOL,
+                                                processfamily.CHILD_COMMS_STRATEGY_PROCESSFAMILY_BINARY_RPC_PROTOCOL])
+    def test_shared_memory(self, family_factory, comms_strategy):
+        segments_before = set(os.listdir("/dev/shm"))
+        family = family_factory(1, CHILD_COMMS_STRATEGY=comms_strategy, SHARED_MEMORY_THRESHOLD=1000)
+        family.start(timeout=30)
+        payload = os.urandom(100000)
+        for i in range(3):
+            assert family.call(0, "echo", [payload, {"small": "value"}]).result(10) == [payload, {"small": "value"}]
+        # The segments for the params and the result are reused
+        pool = family.get_child(0)._shm_pool
+        assert len(pool._free) == 1 and not pool._in_use
+        new_segments = set(os.listdir("/dev/shm")) - segments_before
+        assert len(new_segments) == 2 and pool._free[0].name in new_segments
+        futures = family.call_batch(0, [("echo", [bytearray(5000)]), ("echo", [memoryview(payload)[:2000]])])
+        assert [f.result(10) for f in futures] == [[bytes(5000)], [payload[:2000]]]
+        assert family.stop(timeout=10) == 0
+        # The pool is destroyed once the child's output has closed
+        assert wait_for(lambda: set(os.listdir("/dev/shm")) == segments_before, 10)
+
+    def test_io_multiplexer(self, family_factory):
+        family = family_factory(3, USE_IO_MULTIPLEXER=True, ECHO_STD_ERR=True)
+        family.start(timeout=30)
+        assert not [t for t in threading.enumerate() if t.name.endswith("_stdout") or t.name.endswith("_stderr")]
+        futures = [family.call(i % 3, "echo", [i]) for i in range(30)]
+        assert [f.result(10) for f in futures] == [[i] for i in range(30)]
+        future = family.call(0, "sleep", [30])
+        os.kill(family.get_child(0).pid, signal.SIGKILL)
+        with pytest.raises(processfamily.ChildTerminatedError):
+            future.result(10)
+        assert family.stop(timeout=10) == 0
+
+
+class TestThreads(object):
+
+    def test_profiler_is_bounded(self):
+        profiler = SamplingProfiler(max_stacks=2, max_depth=3)
+        for i in range(5):
+            profiler.sample()
+        assert profiler.samples == 5
+        stacks = dict(line.rsplit(" ", 1) for line in profiler.get_collapsed_stacks().splitlines())
+        assert len([s for s in stacks if s != TRUNCATED_STACK]) <= 2
+        # The thread name, then at most max_depth frames
+        assert max(len(s.split(";")) for s in stacks) <= 4
+
+    def test_stop_threads_parallel(self):
+        release_event = threading.Event()
+
+        def stuck():
+            try:
+                while True:
+                    time.sleep(0.05)
+            except SystemExit:
+                pass
+
+        def blocked():
+            # Blocked waiting on a lock, so SystemExit is not raised in it until it is released
+            try:
+                release_event.wait()
+            except SystemExit:
+                pass
+        threads = [threading.Thread(target=stuck, name="stuck-%d" % i) for i in range(5)]
+        threads.append(threading.Thread(target=blocked, name="blocked"))
+        threads.append(threading.Thread(target=time.sleep, args=(0.1,), name="finishes"))
+        for t in threads:
+            t.start()
+        start_time = time.time()
+        try:
+            report = stop_threads_parallel(global_wait=0.5, thread_wait=1.0, log_tracebacks=False,
+                                           exclude_thread_fn=lambda t: t in threads)
+        finally:
+            release_event.set()
+        # Stopping them one at a time would take at least a second each
+        assert time.time() - start_time < 3
+        assert sorted(t.name for t in report.stopped) == ["finishes"] + ["stuck-%d" % i for i in range(5)]
+        assert [t.name for t in report.forced] == ["blocked"]
+        assert report.unstoppable == []
+        assert report.durations[threads[-1]] < 0.5
+        assert 0.5 <= report.durations[threads[0]] < 2
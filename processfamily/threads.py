@@ -164,12 +164,8 @@ def log_thread_tracebacks(threads, stop_event=None, finished_event=None, logleve
     if finished_event:
         finished_event.set()
 
-def stop_threads(global_wait=2.0, thread_wait=1.0, exclude_threads=None, log_tracebacks=True, exclude_thread_fn=None, thread_class=threading.Thread):
-    """enumerates remaining threads and stops them"""
-    current_thread = threading.currentThread()
-    def find_stop_threads():
-        return [t for t in filter_threads(list(threading._active.values()), current_thread, exclude_threads, exclude_thread_fn=exclude_thread_fn) if t.is_alive()]
-    remaining_threads = find_stop_threads()
+def _find_threads_to_stop(current_thread, exclude_threads, exclude_thread_fn):
+    remaining_threads = [t for t in filter_threads(list(threading._active.values()), current_thread, exclude_threads, exclude_thread_fn=exclude_thread_fn) if t.is_alive()]
     threads_to_stop = []
     for thread in remaining_threads:
         if not thread.isDaemon():
@@ -177,19 +173,30 @@ def stop_threads(global_wait=2.0, thread_wait=1.0, exclude_threads=None, log_tra
             callstr = get_thread_callstr(thread)
             logger.warning("Shutting down but thread %s still remains alive: %s", thread_name, callstr)
             threads_to_stop.append(thread)
-    if not threads_to_stop:
-        return
+    return threads_to_stop
+
+def _log_thread_tracebacks_with_timeout(threads_to_stop, global_wait, thread_class):
     traceback_stop_event = threading.Event()
     traceback_finished_event = threading.Event()
+    traceback_thread = thread_class(target=log_thread_tracebacks, name="stop_thread_tracebacks", args=(threads_to_stop, traceback_stop_event, traceback_finished_event))
+    traceback_thread.start()
+    # wait for the tracebacks to stop, and give them a chance to abort if they take too long
+    logger.info("Started traceback thread")
+    traceback_finished_event.wait(global_wait)
+    traceback_stop_event.set()
+    traceback_finished_event.wait(global_wait)
+    logger.info("Finished waiting for traceback thread")
+
+def stop_threads(global_wait=2.0, thread_wait=1.0, exclude_threads=None, log_tracebacks=True, exclude_thread_fn=None, thread_class=threading.Thread):
+    """enumerates remaining threads and stops them"""
+    current_thread = threading.currentThread()
+    def find_stop_threads():
+        return [t for t in filter_threads(list(threading._active.values()), current_thread, exclude_threads, exclude_thread_fn=exclude_thread_fn) if t.is_alive()]
+    threads_to_stop = _find_threads_to_stop(current_thread, exclude_threads, exclude_thread_fn)
+    if not threads_to_stop:
+        return
     if log_tracebacks:
-        traceback_thread = thread_class(target=log_thread_tracebacks, name="stop_thread_tracebacks", args=(threads_to_stop, traceback_stop_event, traceback_finished_event))
-        traceback_thread.start()
-        # wait for the tracebacks to stop, and give them a chance to abort if they take too long
-        logger.info("Started traceback thread")
-        traceback_finished_event.wait(global_wait)
-        traceback_stop_event.set()
-        traceback_finished_event.wait(global_wait)
-        logger.info("Finished waiting for traceback thread")
+        _log_thread_tracebacks_with_timeout(threads_to_stop, global_wait, thread_class)
     threads_to_stop2 = []
     try:
         time.sleep(global_wait)
@@ -209,3 +216,76 @@ def stop_threads(global_wait=2.0, thread_wait=1.0, exclude_threads=None, log_tra
     if unstoppable_thread_names:
         logger.error("The following threads could not be stopped: %s", ", ".join(unstoppable_thread_names))
 
+class ThreadStopReport(object):
+    """The result of stop_threads_parallel"""
+
+    def __init__(self):
+        self.stopped = []  # Threads that stopped, either by themselves or when SystemExit was raised in them
+        self.forced = []  # Threads that had to be stopped forcefully
+        self.unstoppable = []  # Threads that were still alive at the end
+        self.durations = {}  # Seconds from the start until each thread that is no longer alive stopped
+
+    def __repr__(self):
+        return "ThreadStopReport(stopped=%r, forced=%r, unstoppable=%r)" % (
+            [t.name for t in self.stopped], [t.name for t in self.forced], [t.name for t in self.unstoppable])
+
+def _wait_for_threads(threads, end_time, start_time, durations, poll_interval):
+    """waits until all the given threads have stopped or end_time has passed, recording when each stopped in
+    durations. Returns the threads that are still alive"""
+    remaining_threads = list(threads)
+    while True:
+        now = time.time()
+        for thread in remaining_threads[:]:
+            if not thread.is_alive():
+                remaining_threads.remove(thread)
+                durations[thread] = now - start_time
+        if not remaining_threads or now >= end_time:
+            return remaining_threads
+        time.sleep(min(poll_interval, end_time - now))
+
+def graceful_stop_threads(threads, thread_wait=1.0):
+    """Raises SystemExit in all the given threads at once, then waits up to thread_wait seconds for them together.
+    Returns a dict of the seconds each thread that stopped took to stop"""
+    start_time = time.time()
+    for thread in threads:
+        if thread.is_alive():
+            try:
+                thread_async_raise(thread, SystemExit)
+            except Exception as e:
+                logger.info("Error trying to raise exit message in thread %s:\n%s", thread.name, _traceback_str())
+    durations = {}
+    _wait_for_threads(threads, start_time + thread_wait, start_time, durations, old_div(thread_wait, 50))
+    for thread in durations:
+        logger.info("Thread %s stopped gracefully", thread.name)
+    return durations
+
+def stop_threads_parallel(global_wait=2.0, thread_wait=1.0, exclude_threads=None, log_tracebacks=True, exclude_thread_fn=None, thread_class=threading.Thread):
+    """like stop_threads, but rather than stopping the remaining threads one at a time, this waits up to global_wait
+    seconds for them to stop by themselves, then raises SystemExit in all of them at once and waits up to thread_wait
+    seconds for them together before stopping the rest forcefully. Each wait ends as soon as the threads have stopped.
+    Returns a ThreadStopReport"""
+    current_thread = threading.current_thread()
+    report = ThreadStopReport()
+    threads_to_stop = _find_threads_to_stop(current_thread, exclude_threads, exclude_thread_fn)
+    if not threads_to_stop:
+        return report
+    start_time = time.time()
+    poll_interval = old_div(thread_wait, 50)
+    if log_tracebacks:
+        _log_thread_tracebacks_with_timeout(threads_to_stop, global_wait, thread_class)
+    try:
+        remaining_threads = _wait_for_threads(threads_to_stop, time.time() + global_wait, start_time, report.durations, poll_interval)
+        if remaining_threads:
+            raise_time = time.time()
+            for thread, duration in graceful_stop_threads(remaining_threads, thread_wait).items():
+                report.durations[thread] = raise_time - start_time + duration
+    except KeyboardInterrupt as e:
+        logger.warning("Keyboard Interrupt received while waiting for thread; abandoning civility and forcing them all to stop")
+    report.forced = [t for t in threads_to_stop if t.is_alive()]
+    for thread in report.forced:
+        forceful_stop_thread(thread)
+    report.unstoppable = _wait_for_threads(report.forced, time.time() + global_wait, start_time, report.durations, poll_interval)
+    report.stopped = [t for t in threads_to_stop if t not in report.forced]
+    if report.unstoppable:
+        logger.error("The following threads could not be stopped: %s", ", ".join(t.name for t in report.unstoppable))
+    return report
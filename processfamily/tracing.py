@@ -0,0 +1,88 @@
+# -*- coding: utf-8 -*-
+"""Lifecycle events for the children of a ProcessFamily, and exporting them as a Chrome trace event timeline"""
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+from __future__ import unicode_literals
+from future import standard_library
+standard_library.install_aliases()
+from builtins import *
+from builtins import object
+__author__ = 'matth'
+
+import json
+import os
+
+SPAWN_REQUESTED = "spawn_requested"
+POPEN_RETURNED = "popen_returned"
+AFFINITY_SET = "affinity_set"
+STARTUP_PING_SENT = "startup_ping_sent"
+READY = "ready"
+STOP_SENT = "stop_sent"
+STOP_ACKED = "stop_acked"
+EXITED = "exited"
+KILLED = "killed"
+
+#The spans shown in a trace, as (name, start event, end events); each ends at the first of its end events
+_SPANS = [
+    ("spawn", SPAWN_REQUESTED, (POPEN_RETURNED,)),
+    ("affinity", POPEN_RETURNED, (AFFINITY_SET,)),
+    ("startup", STARTUP_PING_SENT, (READY, EXITED)),
+    ("stop", STOP_SENT, (STOP_ACKED, EXITED, KILLED)),
+    ("shutdown", STOP_ACKED, (EXITED, KILLED)),
+]
+
+
+class LifecycleEvent(object):
+    """Something that happened to a child at a point in time (a time.time() timestamp)"""
+
+    def __init__(self, name, child_index, child_name, pid, timestamp):
+        self.name = name
+        self.child_index = child_index
+        self.child_name = child_name
+        self.pid = pid
+        self.timestamp = timestamp
+
+    def __repr__(self):
+        return "LifecycleEvent(%s, %s, pid=%s, %.6f)" % (self.name, self.child_name, self.pid, self.timestamp)
+
+
+def to_chrome_trace(events):
+    """Returns a dict in the Chrome trace event format (for chrome://tracing or Perfetto), with a track for each
+    child index, spans for the phases of starting and stopping each child, and a marker for each event"""
+    events = sorted(events, key=lambda e: e.timestamp)
+    start_time = events[0].timestamp if events else 0
+    parent_pid = os.getpid()
+
+    def ts(event):
+        return int(round((event.timestamp - start_time) * 1000000))
+
+    trace_events = []
+    child_names = {}
+    open_spans = {}
+    for event in events:
+        child_names.setdefault(event.child_index, event.child_name)
+        for span_name, start_name, end_names in _SPANS:
+            key = (event.child_index, span_name)
+            if event.name in end_names and key in open_spans:
+                start = open_spans.pop(key)
+                trace_events.append({
+                    "name": span_name, "cat": "lifecycle", "ph": "X", "pid": parent_pid, "tid": event.child_index,
+                    "ts": ts(start), "dur": ts(event) - ts(start), "args": {"pid": event.pid},
+                })
+            if event.name == start_name:
+                open_spans[key] = event
+        trace_events.append({
+            "name": event.name, "cat": "lifecycle", "ph": "i", "s": "t", "pid": parent_pid, "tid": event.child_index,
+            "ts": ts(event), "args": {"pid": event.pid},
+        })
+    for child_index, child_name in child_names.items():
+        trace_events.append({"name": "thread_name", "ph": "M", "pid": parent_pid, "tid": child_index,
+                             "args": {"name": child_name}})
+    return {"traceEvents": trace_events, "displayTimeUnit": "ms"}
+
+
+def write_chrome_trace(events, path):
+    """Writes the events to path as a Chrome trace event JSON file"""
+    with open(path, 'w') as f:
+        json.dump(to_chrome_trace(events), f)
@@ -0,0 +1,108 @@
+# -*- coding: utf-8 -*-
+"""Messages over a SOCK_SEQPACKET unix socket, with file descriptors passed alongside them (SCM_RIGHTS).
+
+Each message is sent as one or more packets of at most PACKET_SIZE bytes (so that a large message is not limited by
+the socket's buffer size), each starting with a byte saying whether more packets of the same message follow. Any file
+descriptors are attached to the first packet. Senders must not interleave the packets of different messages."""
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+from __future__ import unicode_literals
+from future import standard_library
+standard_library.install_aliases()
+from builtins import *
+from builtins import object
+__author__ = 'matth'
+
+import array
+import os
+import socket
+
+#The environment variable that tells a child which of its file descriptors is its end of the socket
+SOCKET_FD_ENV_VAR = "PROCESSFAMILY_SOCKET_FD"
+
+PACKET_SIZE = 65536
+MAX_FDS = 253  # SCM_MAX_FD on Linux
+
+_MORE = b'\x01'
+_LAST = b'\x00'
+
+
+def socketpair():
+    """Returns a connected pair of SOCK_SEQPACKET unix sockets"""
+    return socket.socketpair(socket.AF_UNIX, socket.SOCK_SEQPACKET)
+
+
+def send_message(sock, data, fds=()):
+    """Sends data (a bytes-like object) as a message, with the given file descriptors. The caller keeps its own copies
+    of the fds, which it can close once this returns"""
+    view = memoryview(data)
+    offset = 0
+    ancdata = [(socket.SOL_SOCKET, socket.SCM_RIGHTS, array.array('i', fds))] if fds else []
+    while True:
+        chunk = view[offset:offset + PACKET_SIZE - 1]
+        offset += len(chunk)
+        more = offset < len(view)
+        sock.sendmsg([_MORE if more else _LAST, chunk], ancdata)
+        if not more:
+            return
+        ancdata = []
+
+
+def recv_packet(sock, flags=0):
+    """Receives a packet, returning (packet, fds); the packet is empty at the end of the stream"""
+    fds = array.array('i')
+    packet, ancdata, msg_flags, addr = sock.recvmsg(PACKET_SIZE, socket.CMSG_SPACE(MAX_FDS * fds.itemsize), flags)
+    for cmsg_level, cmsg_type, cmsg_data in ancdata:
+        if cmsg_level == socket.SOL_SOCKET and cmsg_type == socket.SCM_RIGHTS:
+            fds.frombytes(cmsg_data[:len(cmsg_data) - (len(cmsg_data) % fds.itemsize)])
+    if msg_flags & (socket.MSG_TRUNC | socket.MSG_CTRUNC):
+        close_fds(fds)
+        raise IOError("Received a truncated packet")
+    return packet, list(fds)
+
+
+def close_fds(fds):
+    for fd in fds:
+        try:
+            os.close(fd)
+        except OSError:
+            pass
+
+
+class MessageAssembler(object):
+    """Puts the packets of each message back together"""
+
+    def __init__(self):
+        self._chunks = []
+        self._fds = []
+
+    def add_packet(self, packet, fds):
+        """Returns (data, fds) if the packet is the last of a message, and otherwise None"""
+        self._chunks.append(packet[1:])
+        self._fds.extend(fds)
+        if packet[:1] == _MORE:
+            return None
+        data = self._chunks[0] if len(self._chunks) == 1 else b''.join(self._chunks)
+        message = (data, self._fds)
+        self._chunks = []
+        self._fds = []
+        return message
+
+    def close(self):
+        """Closes the fds of a partly received message"""
+        close_fds(self._fds)
+        self._chunks = []
+        self._fds = []
+
+
+def recv_message(sock, assembler):
+    """Receives a message from a blocking socket, returning (data, fds), or None at the end of the stream"""
+    while True:
+        packet, fds = recv_packet(sock)
+        if not packet:
+            assembler.close()
+            return None
+        message = assembler.add_packet(packet, fds)
+        if message is not None:
+            return message
@@ -0,0 +1,87 @@
+# -*- coding: utf-8 -*-
+"""Detecting stalls in a process (e.g. a C extension holding the GIL) by measuring the scheduling latency of a
+heartbeat thread"""
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+from __future__ import unicode_literals
+from future import standard_library
+standard_library.install_aliases()
+from builtins import *
+from builtins import object
+__author__ = 'matth'
+
+import logging
+import threading
+import time
+import traceback
+
+from processfamily.threads import find_thread_frames
+
+logger = logging.getLogger("processfamily.watchdog")
+
+
+def _traceback_str():
+    return traceback.format_exc()
+
+
+def get_thread_stacks(exclude_thread=None):
+    """Returns a list of {"thread": name, "stack": formatted stack} for every thread except exclude_thread"""
+    stacks = []
+    for thread, frame in find_thread_frames():
+        if thread is not None and thread is exclude_thread:
+            continue
+        stacks.append({
+            "thread": thread.name if thread is not None else "unknown thread",
+            "stack": "".join(traceback.format_stack(frame)),
+        })
+    return stacks
+
+
+class StallWatchdog(object):
+    """
+    A heartbeat thread wakes every interval seconds; if it wakes more than stall_threshold seconds late, nothing in
+    this process could run in that time (e.g. because a thread held the GIL), and stall_callback(stall) is called with
+    a dict of the latency and the stacks of the other threads. As these are captured as soon as the heartbeat thread
+    can run again, a thread that was holding the GIL will be at (or just after) the call that held it.
+    """
+
+    def __init__(self, stall_callback, interval=0.1, stall_threshold=1.0):
+        self.stall_callback = stall_callback
+        self.interval = interval
+        self.stall_threshold = stall_threshold
+        self.stall_count = 0
+        self.max_latency = 0.0
+        self._stop_event = threading.Event()
+        self._thread = None
+
+    def start(self):
+        self._stop_event.clear()
+        self._thread = threading.Thread(target=self._thread_target, name="pf_watchdog")
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self):
+        self._stop_event.set()
+        if self._thread is not None and self._thread is not threading.current_thread():
+            self._thread.join()
+        self._thread = None
+
+    def _thread_target(self):
+        while True:
+            start_time = time.time()
+            if self._stop_event.wait(self.interval):
+                return
+            latency = max(0.0, time.time() - start_time - self.interval)
+            self.max_latency = max(self.max_latency, latency)
+            if latency <= self.stall_threshold:
+                continue
+            self.stall_count += 1
+            try:
+                self.stall_callback({
+                    "latency": latency,
+                    "threshold": self.stall_threshold,
+                    "threads": get_thread_stacks(exclude_thread=threading.current_thread()),
+                })
+            except Exception as e:
+                logger.error("Error reporting a stall of %.3fs: %s\n%s", latency, e, _traceback_str())